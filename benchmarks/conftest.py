@@ -0,0 +1,43 @@
+import pytest
+
+from pipeline.data.enums import Language
+from pipeline.data.jsonl import write_jsonl
+from pipeline.data.synthetic import synthetic_frame, synthetic_rows, synthetic_wura
+
+
+def pytest_addoption(parser):
+    parser.addoption("--bench-rows", type=int, default=10_000, help="The number of synthetic rows the benchmarks run on, e.g. 10k to 1M.")
+
+
+@pytest.fixture(scope="session")
+def num_rows(request):
+    return request.config.getoption("--bench-rows")
+
+
+@pytest.fixture(autouse=True)
+def record_rows(request, num_rows):
+    # Results are only comparable across commits for the same number of rows, it is saved with them.
+    if "benchmark" in request.fixturenames:
+        request.getfixturevalue("benchmark").extra_info["rows"] = num_rows
+
+
+@pytest.fixture(scope="session")
+def rows(num_rows):
+    return synthetic_rows(num_rows)
+
+
+@pytest.fixture(scope="session")
+def rows_path(rows, tmp_path_factory):
+    path = tmp_path_factory.mktemp("rows") / "hausa_train_dataset.jsonl"
+    write_jsonl(path, rows)
+    return path
+
+
+@pytest.fixture(scope="session")
+def wura(num_rows):
+    return synthetic_wura(num_rows, Language.yoruba)
+
+
+@pytest.fixture(scope="session")
+def collected_df(num_rows):
+    return synthetic_frame(num_rows, Language.yoruba)
@@ -0,0 +1,62 @@
+import pytest
+
+from pipeline.data.enums import Language
+from pipeline.data.jsonl import JsonlRows
+from pipeline.data.postprocess import fix_wiki_pos, postprocess_dataset, sample_data_by_language, sample_data_by_text_length
+from pipeline.data.synthetic import synthetic_audits
+from pipeline.data.train_data import make_train_dataset
+from pipeline.data.wura import prepare_wura, wura_remove_validation_rows
+
+pytest.importorskip("pytest_benchmark")
+
+# Rounds of the benchmarks whose inputs are modified in place, and rebuilt before every round.
+ROUNDS = 5
+# Rows drawn by the samplers, as in the translate pipeline.
+SAMPLE_SIZE = 2000
+
+
+def test_prepare_wura(benchmark, wura):
+    benchmark.group = "wura"
+    df = benchmark(prepare_wura, wura["train"])
+    assert 0 < len(df) < len(wura["train"])
+
+
+def test_wura_remove_validation_rows(benchmark, collected_df, wura):
+    benchmark.group = "wura"
+    df = benchmark(wura_remove_validation_rows, collected_df, wura["validation"])
+    assert len(df) == len(collected_df) - len(wura["validation"])
+
+
+def test_make_train_dataset(benchmark, collected_df, tmp_path):
+    benchmark.group = "train"
+    path = tmp_path / "train_dataset.jsonl"
+    # `make_train_dataset` renames the columns of the frame in place.
+    benchmark.pedantic(make_train_dataset, setup=lambda: ((collected_df.copy(),), {"filename": path}), rounds=ROUNDS)
+    assert len(JsonlRows(path)) == len(collected_df)
+
+
+def test_fix_wiki_pos(benchmark, rows):
+    benchmark.group = "postprocess"
+    wiki_rows = [row for row in rows if "wikipedia.org" in row["url"]]
+    fixed_rows = benchmark.pedantic(lambda rows: [fix_wiki_pos(row) for row in rows],
+                                    setup=lambda: (([dict(row) for row in wiki_rows],), {}), rounds=ROUNDS)
+    assert all(not row["pos"][0].startswith(row["query"]) for row in fixed_rows)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_postprocess_dataset(benchmark, rows_path, num_rows, workers):
+    benchmark.group = "postprocess"
+    # Hausa is only partly audited, the remaining Mato rows are kept without audits.
+    audits = synthetic_audits(int(num_rows * 0.8))
+    results = benchmark.pedantic(postprocess_dataset, setup=lambda: ((JsonlRows(rows_path), audits, Language.hausa), {"workers": workers}),
+                                 rounds=ROUNDS)
+    assert 0 < len(results) < num_rows
+
+
+@pytest.mark.parametrize("streaming", [False, True], ids=["in_memory", "streaming"])
+@pytest.mark.parametrize("sampler", [sample_data_by_text_length, sample_data_by_language], ids=["text_length", "language"])
+def test_samplers(benchmark, rows, sampler, streaming):
+    benchmark.group = "samplers"
+    # Iterators go through the single pass reservoir sampler.
+    sampled = benchmark.pedantic(sampler, setup=lambda: ((iter(rows) if streaming else rows, SAMPLE_SIZE), {}), rounds=ROUNDS)
+    assert len(sampled) == SAMPLE_SIZE
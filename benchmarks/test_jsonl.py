@@ -0,0 +1,34 @@
+import pytest
+
+from pipeline.data.jsonl import JsonlRows, write_jsonl
+from pipeline.data.utils import load_jsonl
+
+pytest.importorskip("pytest_benchmark")
+
+SUFFIXES = [".jsonl", ".jsonl.gz"]
+
+
+@pytest.mark.parametrize("suffix", SUFFIXES)
+def test_write_jsonl(benchmark, rows, tmp_path, suffix):
+    benchmark.group = "jsonl"
+    assert benchmark(write_jsonl, tmp_path / f"rows{suffix}", rows) == len(rows)
+
+
+@pytest.mark.parametrize("suffix", SUFFIXES)
+def test_load_jsonl(benchmark, rows, tmp_path, suffix):
+    benchmark.group = "jsonl"
+    path = tmp_path / f"rows{suffix}"
+    write_jsonl(path, rows)
+    assert len(benchmark(load_jsonl, path)) == len(rows)
+
+
+def test_jsonl_rows_random_access(benchmark, rows_path, num_rows):
+    benchmark.group = "jsonl"
+    # Indexing the lines, then reading rows spread over the whole file.
+    idxs = range(0, num_rows, max(num_rows // 1000, 1))
+
+    def read_rows():
+        jsonl_rows = JsonlRows(rows_path)
+        return [jsonl_rows[idx] for idx in idxs]
+
+    assert len(benchmark(read_rows)) == len(idxs)
@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from pipeline.data.jsonl import iter_jsonl, write_jsonl
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PARQUET_SUFFIX = ".parquet"
+ARROW_SUFFIX = ".arrow"
+COLUMNAR_SUFFIXES = [PARQUET_SUFFIX, ARROW_SUFFIX]
+# Text columns whose distinct values make up at most this share of the values are dictionary encoded,
+# e.g. the sources, or the negatives that repeat the positives of other rows.
+DICTIONARY_MAX_RATIO = 0.5
+# Parquet falls back to plain encoding once a dictionary page exceeds this size, the default 1 MiB is a few documents.
+PARQUET_DICTIONARY_PAGE_SIZE = 1 << 28
+PARQUET_ROW_GROUP_SIZE = 1 << 16
+PARQUET_COMPRESSION = "zstd"
+# Number of JSONL rows decoded into a table at a time by the converter.
+CONVERT_CHUNK_SIZE = 1 << 16
+
+
+def _is_text(data_type: pa.DataType) -> bool:
+    return pa.types.is_string(data_type) or pa.types.is_large_string(data_type)
+
+
+def _dictionary_encode(array: pa.Array, max_ratio: float) -> pa.Array:
+    if _is_text(array.type):
+        if len(array) and len(pc.unique(array)) <= max_ratio * len(array):
+            return array.dictionary_encode()
+    elif pa.types.is_list(array.type) and _is_text(array.type.value_type):
+        # The lists keep their offsets, only their values are encoded, e.g. the negatives of every row share a dictionary.
+        values = array.values
+        if len(values) and len(pc.unique(values)) <= max_ratio * len(values):
+            mask = array.is_null() if array.null_count else None
+            return pa.ListArray.from_arrays(array.offsets, values.dictionary_encode(), mask=mask)
+    return array
+
+
+def dictionary_encode_table(table: pa.Table, max_ratio: float = DICTIONARY_MAX_RATIO) -> pa.Table:
+    """
+    Dictionary encode the text columns with repeated values, and the values of the lists of texts with repeated values.
+
+    Args:
+        table: The table to encode.
+        max_ratio: The largest share of distinct values a column can have to be encoded.
+
+    Returns:
+        The table, with a single chunk per column.
+    """
+    table = table.combine_chunks()
+    columns = [
+        _dictionary_encode(column.chunk(0), max_ratio) if column.num_chunks == 1 else column
+        for column in table.columns
+    ]
+    return pa.table(columns, names=table.column_names)
+
+
+def to_table(rows) -> pa.Table:
+    """
+    Build a table from rows, a DataFrame or a table.
+
+    Args:
+        rows: The rows as dictionaries, a DataFrame, an `ArrowRows` view or a table.
+
+    Returns:
+        The table.
+    """
+    if isinstance(rows, pa.Table):
+        return rows
+    if isinstance(rows, ArrowRows):
+        return rows.table
+    if isinstance(rows, pd.DataFrame):
+        return pa.Table.from_pandas(rows, preserve_index=False)
+    return pa.Table.from_pylist(list(rows))
+
+
+def write_table(file_path: str | Path, rows) -> int:
+    """
+    Write rows into a Parquet or Arrow IPC file, with the repeated texts dictionary encoded.
+
+    Parquet files are compressed, they are the smaller format. Arrow IPC files are left uncompressed,
+    so that they can be memory mapped and read without copies.
+
+    Args:
+        file_path: The path of the file, its suffix picks the format.
+        rows: The rows to write, see `to_table`.
+
+    Returns:
+        The number of rows written.
+    """
+    file_path = Path(file_path)
+    table = dictionary_encode_table(to_table(rows))
+    # Writing a temporary file then renaming it, so readers never see a partially written file.
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.tmp")
+    if file_path.suffix == PARQUET_SUFFIX:
+        pq.write_table(table, tmp_path, compression=PARQUET_COMPRESSION, row_group_size=PARQUET_ROW_GROUP_SIZE,
+                       dictionary_pagesize_limit=PARQUET_DICTIONARY_PAGE_SIZE)
+    elif file_path.suffix == ARROW_SUFFIX:
+        with pa.OSFile(str(tmp_path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unsupported file format: {file_path}. Supported formats are {COLUMNAR_SUFFIXES}.")
+    os.replace(tmp_path, file_path)
+    return table.num_rows
+
+
+def read_table(file_path: str | Path, columns: list[str] | None = None) -> pa.Table:
+    """
+    Read a Parquet or Arrow IPC file, memory mapped.
+
+    Arrow IPC files are read without copies, the columns point into the memory map. Parquet files are decoded,
+    but only the requested columns are.
+
+    Args:
+        file_path: The path of the file.
+        columns: The columns to read, all of them when None.
+
+    Returns:
+        The table.
+    """
+    file_path = Path(file_path)
+    if file_path.suffix == PARQUET_SUFFIX:
+        return pq.read_table(file_path, columns=columns, memory_map=True)
+    elif file_path.suffix == ARROW_SUFFIX:
+        table = pa.ipc.open_file(pa.memory_map(str(file_path), "r")).read_all()
+        return table.select(columns) if columns is not None else table
+    raise ValueError(f"Unsupported file format: {file_path}. Supported formats are {COLUMNAR_SUFFIXES}.")
+
+
+def count_rows(file_path: str | Path) -> int:
+    """Count the rows of a Parquet or Arrow IPC file from its metadata."""
+    file_path = Path(file_path)
+    if file_path.suffix == PARQUET_SUFFIX:
+        return pq.ParquetFile(file_path).metadata.num_rows
+    return read_table(file_path, columns=[]).num_rows
+
+
+class ArrowRows(Sequence):
+    """
+    Lazy, read-only view over the rows of a table, the columnar counterpart of `JsonlRows`.
+
+    Rows are converted to dictionaries when they are accessed, and slicing returns another view without copying.
+
+    Example:
+        >>> rows = ArrowRows(read_table("yoruba_train_dataset.arrow"))
+        >>> rows[0]["query"]
+        >>> queries = rows.column("query")
+    """
+
+    # Number of rows converted to dictionaries at a time when iterating.
+    BATCH_SIZE = 1024
+
+    def __init__(self, table: pa.Table):
+        self.table = table
+
+    @property
+    def column_names(self) -> list[str]:
+        return self.table.column_names
+
+    def column(self, name: str) -> pa.ChunkedArray:
+        """Get a column, without converting it to Python objects."""
+        return self.table.column(name)
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                return ArrowRows(self.table.take(np.arange(start, stop, step)))
+            return ArrowRows(self.table.slice(start, max(stop - start, 0)))
+        if idx < -len(self) or idx >= len(self):
+            raise IndexError(f"Row index {idx} is out of range for {len(self)} rows.")
+        return self.table.slice(idx % len(self), 1).to_pylist()[0]
+
+    def __iter__(self) -> Iterator[dict]:
+        for batch in self.table.to_batches(max_chunksize=self.BATCH_SIZE):
+            yield from batch.to_pylist()
+
+    def __repr__(self) -> str:
+        return f"ArrowRows(columns={self.column_names}, rows={len(self)})"
+
+    def __getstate__(self) -> dict:
+        # Serializing through an IPC stream, so a slice only sends its own rows to other processes.
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, self.table.schema) as writer:
+            writer.write_table(self.table)
+        return {"ipc": sink.getvalue()}
+
+    def __setstate__(self, state: dict) -> None:
+        self.table = pa.ipc.open_stream(state["ipc"]).read_all()
+
+    def close(self) -> None:
+        # Dropping the table releases the memory map once no other view points into it.
+        self.table = self.table.schema.empty_table()
+
+    def __enter__(self) -> ArrowRows:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def text_word_counts(texts: pa.Array | pa.ChunkedArray) -> np.ndarray:
+    """
+    Count the words of a text column, the same as `len(text.split())` on each text, without converting the texts.
+
+    Args:
+        texts: The texts, or lists of texts whose first text is counted, e.g. the `pos` column.
+
+    Returns:
+        The word counts, 0 for missing texts.
+    """
+    if isinstance(texts, pa.ChunkedArray):
+        texts = texts.combine_chunks() if texts.num_chunks else pa.array([], type=texts.type)
+    if pa.types.is_list(texts.type):
+        texts = pc.list_element(texts, 0)
+    if pa.types.is_dictionary(texts.type):
+        texts = texts.dictionary_decode()
+    # Splitting keeps empty strings at the edges of the texts, so they are trimmed first.
+    trimmed = pc.utf8_trim_whitespace(texts)
+    counts = pc.list_value_length(pc.utf8_split_whitespace(trimmed))
+    counts = pc.if_else(pc.equal(pc.utf8_length(trimmed), 0), 0, counts)
+    return counts.fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+
+
+def convert_artefact(src: str | Path, dst: str | Path) -> int:
+    """
+    Convert an artefact between the JSONL, Parquet and Arrow IPC formats, e.g. existing JSONL artefacts to Parquet.
+
+    Args:
+        src: The path of the file to convert.
+        dst: The path of the converted file, its suffix picks the format.
+
+    Returns:
+        The number of rows converted.
+    """
+    src, dst = Path(src), Path(dst)
+    if src.suffix == ".jsonl":
+        # Building the table from the decoded rows, as the JSON block reader would turn date-like texts into timestamps.
+        rows = iter_jsonl(src)
+        chunks = [pa.Table.from_pylist(chunk) for chunk in iter(lambda: list(islice(rows, CONVERT_CHUNK_SIZE)), [])]
+        table = pa.concat_tables(chunks, promote_options="permissive") if chunks else pa.table({})
+    else:
+        table = read_table(src)
+
+    if dst.suffix == ".jsonl":
+        return write_jsonl(dst, ArrowRows(table))
+    return write_table(dst, table)
+
+
+def _iter_paths(paths: Iterable[str]) -> Iterator[Path]:
+    for path in paths:
+        path = Path(path)
+        yield from sorted(path.glob("*.jsonl")) if path.is_dir() else [path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert JSONL artefacts to Parquet or Arrow IPC files, next to them.")
+    parser.add_argument("paths", nargs="+", help="JSONL files, or directories whose JSONL files are converted.")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet", help="Format to convert to.")
+    args = parser.parse_args()
+
+    for path in _iter_paths(args.paths):
+        output = path.with_suffix(f".{args.format}")
+        count = convert_artefact(path, output)
+        logger.info(f"Converted {count} rows of {path} ({path.stat().st_size / 1e6:.1f} MB) "
+                    f"to {output} ({output.stat().st_size / 1e6:.1f} MB).")
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import logging
+import subprocess
+import sys
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from pathlib import Path
+
+from pipeline.constants import ARTEFACTS_DIR
+from pipeline.data.enums import ArtefactFormat, DataOperation, DataSplit, Language, NegativeSampling
+from pipeline.data.run import LLM_MODEL_NAME, stage_output
+from pipeline.data.stage_cache import StageCache
+from pipeline.data.translate import TRANSLATED_LANGUAGES
+from pipeline.data.utils import artefact_name
+from pipeline.llms.checkpoint import Checkpoint
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The Ollama model of the audit and translation LLM pipelines, the one the postprocess and translate operations read.
+LLM_MODEL = LLM_MODEL_NAME.replace("_", ":")
+# The languages the create, audit and postprocess stages run for, English is only derived by the translate stage.
+SOURCE_LANGUAGES = [Language.yoruba, Language.igbo, Language.hausa]
+# The stages of the graph, in pipeline order.
+AUDIT = "audit"
+TRANSLATION = "translation"
+STAGES = [DataOperation.create, AUDIT, DataOperation.postprocess, TRANSLATION, DataOperation.translate]
+# Resource shared by the LLM stages, as a single Ollama server runs them one at a time.
+OLLAMA_RESOURCE = "ollama"
+
+BUILT = "built"
+UP_TO_DATE = "up to date"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Node:
+    """
+    A stage of the pipeline for a language and split.
+
+    Args:
+        name: The name of the node, "<stage>:<language>:<split>".
+        action: The function building the output of the node.
+        deps: The names of the nodes whose outputs the node reads.
+        is_fresh: The function checking whether the output is up to date, the node always runs when None.
+        resource: A resource the node holds while running, nodes sharing a resource do not run at the same time.
+    """
+
+    def __init__(self, name: str, action: Callable[[], object], deps: Iterable[str] = (),
+                 is_fresh: Callable[[], bool] | None = None, resource: str | None = None):
+        self.name = name
+        self.action = action
+        self.deps = list(deps)
+        self.is_fresh = is_fresh
+        self.resource = resource
+
+    def run(self) -> str:
+        """Build the output of the node, unless it is up to date. Returns the status of the node."""
+        if self.is_fresh is not None and self.is_fresh():
+            return UP_TO_DATE
+        self.action()
+        return BUILT
+
+    def __repr__(self):
+        return f"Node({self.name})"
+
+
+def llm_results_fresh(input_path: str | Path, results_path: str | Path) -> bool:
+    """
+    Check whether an LLM pipeline has a result for every row of its input file.
+
+    Results started from a previous version of the input file are moved aside, so the pipeline starts over
+    instead of refusing to resume. Unchanged prompts are answered from the LLM response cache.
+
+    Args:
+        input_path: The input file of the pipeline.
+        results_path: The results file of the pipeline.
+
+    Returns:
+        Whether the results are complete.
+    """
+    if not Path(input_path).exists():
+        return False
+    checkpoint = Checkpoint(input_path, results_path)
+    if checkpoint.is_stale():
+        checkpoint.discard()
+        return False
+    return checkpoint.is_complete()
+
+
+def build_graph(negatives: str = NegativeSampling.random, workers: int = 1, no_cache: bool = False,
+                fmt: str = ArtefactFormat.jsonl, compression: str | None = None, num_shards: int = 1) -> dict[str, Node]:
+    """
+    Build the create -> audit -> postprocess -> translation -> translate graph of every language and split.
+
+    Every node runs its pipeline in a subprocess, with the same command as when it is run by hand.
+
+    Args:
+        negatives: How the negatives of the train rows are picked.
+        workers: Number of processes used by each postprocess node.
+        no_cache: Whether the data operations are rebuilt even when their outputs are up to date.
+        fmt: The format of the datasets written by the data operations.
+        compression: The compression of the JSONL datasets written by the data operations.
+        num_shards: The number of shards of the JSONL datasets written by the data operations.
+
+    Returns:
+        The nodes by name, in an order where every node comes after its dependencies.
+    """
+    stage_cache = StageCache(enabled=not no_cache)
+    model_name = LLM_MODEL.replace(":", "_")
+    graph = {}
+
+    def data_node(name, language, split, operation, deps):
+        command = [sys.executable, "-m", "pipeline.data.run", "--language", language, "--split", split,
+                   "--operation", operation, "--negatives", negatives, "--workers", str(workers), "--format", fmt,
+                   "--shards", str(num_shards)]
+        if compression is not None:
+            command.extend(["--compression", compression])
+        if no_cache:
+            command.append("--no-cache")
+        is_fresh = lambda: stage_cache.is_fresh(*stage_output(language, split, operation, negatives, fmt, compression, num_shards))
+        graph[name] = Node(name, partial(subprocess.run, command, check=True), deps, is_fresh)
+
+    def llm_node(name, language, split, module, input_path, results_path, deps):
+        command = [sys.executable, "-m", module, "--model", LLM_MODEL, "--language", language, "--split", split]
+        is_fresh = partial(llm_results_fresh, input_path, results_path)
+        graph[name] = Node(name, partial(subprocess.run, command, check=True), deps, is_fresh, resource=OLLAMA_RESOURCE)
+
+    for split in DataSplit:
+        for language in SOURCE_LANGUAGES:
+            # The test split is created after the eval split, so it reuses the Wura validation split prepared for it.
+            create_deps = [f"create:{language}:eval"] if split == DataSplit.test else []
+            data_node(f"create:{language}:{split}", language, split, DataOperation.create, create_deps)
+            llm_node(f"{AUDIT}:{language}:{split}", language, split, "pipeline.llms.ollama_audit",
+                     f"{ARTEFACTS_DIR}/{artefact_name(f'{language}_{split}_dataset', fmt, compression, num_shards)}",
+                     f"{ARTEFACTS_DIR}/{language}_{model_name}_{split}_results.jsonl",
+                     [f"create:{language}:{split}"])
+            data_node(f"postprocess:{language}:{split}", language, split, DataOperation.postprocess,
+                      [f"create:{language}:{split}", f"{AUDIT}:{language}:{split}"])
+        for language in TRANSLATED_LANGUAGES:
+            llm_node(f"{TRANSLATION}:{language}:{split}", language, split, "pipeline.llms.ollama_translation",
+                     f"{ARTEFACTS_DIR}/{artefact_name(f'filtered_{language}_{split}_dataset', fmt, compression, num_shards)}",
+                     f"{ARTEFACTS_DIR}/{language}_english_{model_name}_{split}_results.jsonl",
+                     [f"postprocess:{language}:{split}"])
+        translate_deps = [
+            f"{stage}:{language}:{split}" for language in TRANSLATED_LANGUAGES for stage in ("postprocess", TRANSLATION)
+        ]
+        data_node(f"translate:{Language.english}:{split}", Language.english, split, DataOperation.translate, translate_deps)
+
+    return dict(sorted(graph.items(), key=lambda item: STAGES.index(item[0].split(":")[0])))
+
+
+def select_nodes(graph: dict[str, Node], targets: Iterable[str] | None = None) -> list[str]:
+    """
+    Get the nodes needed to build the targets, with all of their dependencies.
+
+    Args:
+        graph: The nodes by name, see `build_graph`.
+        targets: Patterns of the nodes to build, "<stage>[:<language>[:<split>]]", e.g. "postprocess" or
+            "create:hausa:train". Every node is selected when None.
+
+    Returns:
+        The names of the selected nodes, in the order of the graph.
+    """
+    if targets is None:
+        return list(graph)
+
+    selected = set()
+    pending = []
+    for target in targets:
+        parts = target.lower().split(":")
+        matches = [name for name in graph if name.split(":")[:len(parts)] == parts]
+        if not matches:
+            raise ValueError(f"Target {target} matches no node, targets look like <stage>[:<language>[:<split>]] with stages {STAGES}.")
+        pending.extend(matches)
+
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(graph[name].deps)
+    return [name for name in graph if name in selected]
+
+
+def run_graph(graph: dict[str, Node], names: Iterable[str] | None = None, jobs: int = 4) -> dict[str, tuple[str, float]]:
+    """
+    Run the nodes of a graph, each as soon as its dependencies are done, with up to `jobs` nodes at a time.
+
+    Nodes whose outputs are up to date are not rebuilt, and the nodes depending on a failed node are skipped.
+
+    Args:
+        graph: The nodes by name, see `build_graph`.
+        names: The nodes to run, see `select_nodes`. Dependencies outside of them are assumed to be done.
+        jobs: The maximum number of nodes running at the same time.
+
+    Returns:
+        The status of every node and the seconds it took, in the order the nodes finished.
+    """
+    pending = list(graph) if names is None else list(names)
+    selected = set(pending)
+    results = {}
+    running = {}
+    busy_resources = set()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            for name in list(pending):
+                node = graph[name]
+                deps = [dep for dep in node.deps if dep in selected]
+                if any(results.get(dep, ("",))[0] in (FAILED, SKIPPED) for dep in deps):
+                    logger.warning(f"Skipping {name}, a node it depends on did not complete.")
+                    results[name] = (SKIPPED, 0.0)
+                    pending.remove(name)
+                elif len(running) < jobs and all(dep in results for dep in deps) and node.resource not in busy_resources:
+                    if node.resource is not None:
+                        busy_resources.add(node.resource)
+                    running[executor.submit(_timed_run, node)] = node
+                    pending.remove(name)
+
+            if not running:
+                if pending:
+                    raise RuntimeError(f"The nodes {pending} depend on each other, or on nodes missing from the graph.")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                busy_resources.discard(node.resource)
+                results[node.name] = future.result()
+                logger.info(f"{node.name}: {results[node.name][0]} in {results[node.name][1]:.1f}s.")
+    return results
+
+
+def _timed_run(node: Node) -> tuple[str, float]:
+    start = time.perf_counter()
+    try:
+        status = node.run()
+    except Exception as e:
+        logger.error(f"{node.name} failed: {e}")
+        status = FAILED
+    return status, time.perf_counter() - start
+
+
+def format_summary(results: dict[str, tuple[str, float]], elapsed: float) -> str:
+    """
+    Format the per node timings of a run.
+
+    Args:
+        results: The status of every node and the seconds it took, see `run_graph`.
+        elapsed: The wall time of the run in seconds.
+
+    Returns:
+        The summary table.
+    """
+    width = max((len(name) for name in results), default=4)
+    lines = [f"{'node':<{width}}  {'status':<10}  {'seconds':>9}"]
+    for name, (status, seconds) in results.items():
+        lines.append(f"{name:<{width}}  {status:<10}  {seconds:>9.1f}")
+    total = sum(seconds for _, seconds in results.values())
+    lines.append(f"{len(results)} nodes took {total:.1f}s of work in {elapsed:.1f}s.")
+    return "\n".join(lines)
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import hashlib
+from collections.abc import Iterable, Iterator
+from itertools import islice
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from pipeline.constants import SEED
+from pipeline.data.negatives import tokenize
+
+
+# Number of MinHash permutations, split into NUM_BANDS LSH bands of NUM_PERM // NUM_BANDS rows.
+NUM_PERM = 128
+NUM_BANDS = 16
+# Number of consecutive words in a shingle.
+SHINGLE_SIZE = 5
+# Estimated Jaccard similarity above which two documents are near-duplicates.
+JACCARD_THRESHOLD = 0.8
+# Number of documents tokenized together.
+MINHASH_BATCH_SIZE = 512
+# Number of shingles hashed together, bounding the (NUM_PERM, HASH_CHUNK_SIZE) hash matrix held in memory.
+HASH_CHUNK_SIZE = 1 << 17
+# Number of candidate pairs whose signatures are compared together.
+VERIFY_BATCH_SIZE = 1 << 16
+
+
+def _token_hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class MinHasher:
+    """
+    MinHash signatures of word shingles, hashed with numpy a batch of documents at a time.
+
+    The shingles of a document are its runs of `shingle_size` normalized words (see `pipeline.data.negatives.normalize_text`),
+    documents with fewer words have a single shingle made of all of them. Each shingle is hashed from the hashes of its
+    words, then `num_perm` multiply-shift hash functions are applied to all shingles of the batch at once.
+
+    Args:
+        num_perm: The number of hash functions, i.e. the length of the signatures.
+        shingle_size: The number of words in a shingle.
+        seed: The seed of the hash functions.
+    """
+
+    def __init__(self, num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed: int = SEED):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # Odd multipliers, as required by multiply-shift hashing.
+        self._a = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64)
+        self._shingle_mults = rng.integers(0, 1 << 63, size=shingle_size, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._token_hashes = {}
+
+    def _hash_tokens(self, tokens: list[str]) -> np.ndarray:
+        hashes = self._token_hashes
+        for token in set(tokens).difference(hashes):
+            hashes[token] = _token_hash(token)
+        return np.fromiter(map(hashes.__getitem__, tokens), dtype=np.uint64, count=len(tokens))
+
+    def _shingle_hashes(self, token_hashes: np.ndarray, doc_lens: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Get the shingle hashes of the concatenated token hashes of a batch, with the number of shingles per document."""
+        doc_ends = np.cumsum(doc_lens)
+        doc_starts = doc_ends - doc_lens
+        size = self.shingle_size
+        padded = np.concatenate([token_hashes, np.zeros(size, dtype=np.uint64)])
+        # Hashing the shingle starting at every token, including the ones running into the next document.
+        shingles = np.zeros(len(token_hashes), dtype=np.uint64)
+        for offset in range(size):
+            shingles += padded[offset:offset + len(token_hashes)] * self._shingle_mults[offset]
+
+        # Every document keeps the shingles starting at least `size` tokens before its end, or its first one if it is shorter.
+        shingle_counts = np.maximum(doc_lens - size + 1, np.minimum(doc_lens, 1))
+        shingle_offsets = np.cumsum(shingle_counts) - shingle_counts
+        positions = np.arange(shingle_counts.sum()) - np.repeat(shingle_offsets, shingle_counts)
+        shingles = shingles[np.repeat(doc_starts, shingle_counts) + positions]
+
+        # Rehashing the shingles of short documents from their own tokens only.
+        for doc_idx in np.flatnonzero((doc_lens > 0) & (doc_lens < size)):
+            start, end = doc_starts[doc_idx], doc_ends[doc_idx]
+            shingles[shingle_offsets[doc_idx]] = (token_hashes[start:end] * self._shingle_mults[:end - start]).sum(dtype=np.uint64)
+        return shingles, shingle_counts
+
+    def signatures(self, texts: Iterable[str | None], batch_size: int = MINHASH_BATCH_SIZE) -> np.ndarray:
+        """
+        Get the MinHash signatures of the texts.
+
+        Args:
+            texts: The texts, consumed lazily.
+            batch_size: The number of texts hashed together.
+
+        Returns:
+            An array of shape (len(texts), num_perm). Texts without words get the maximum value everywhere.
+        """
+        batches = []
+        iterator = iter(texts)
+        while batch := list(islice(iterator, batch_size)):
+            batches.append(self._batch_signatures(batch))
+        if not batches:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+        return np.concatenate(batches)
+
+    def _batch_signatures(self, texts: list[str | None]) -> np.ndarray:
+        tokens = [tokenize(text) for text in texts]
+        doc_lens = np.fromiter((len(doc_tokens) for doc_tokens in tokens), dtype=np.int64, count=len(tokens))
+        signatures = np.full((len(texts), self.num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        if not doc_lens.sum():
+            return signatures
+
+        token_hashes = self._hash_tokens([token for doc_tokens in tokens for token in doc_tokens])
+        shingles, shingle_counts = self._shingle_hashes(token_hashes, doc_lens)
+        shingle_ends = np.cumsum(shingle_counts)
+        shingle_starts = shingle_ends - shingle_counts
+        minimums = np.full((len(texts), self.num_perm), np.iinfo(np.uint64).max, dtype=np.uint64)
+        # Hashing HASH_CHUNK_SIZE shingles at a time, so very long documents do not blow up the hash matrix.
+        for start in range(0, len(shingles), HASH_CHUNK_SIZE):
+            end = min(start + HASH_CHUNK_SIZE, len(shingles))
+            # Multiply-shift hashing, keeping the 32 high bits of (a * x + b) mod 2 ** 64.
+            # The shift is monotonic, so it is applied to the minimums rather than to every hash.
+            hashes = self._a * shingles[None, start:end]
+            hashes += self._b
+            doc_idxs = np.arange(np.searchsorted(shingle_ends, start, side="right"), np.searchsorted(shingle_starts, end))
+            doc_idxs = doc_idxs[shingle_counts[doc_idxs] > 0]
+            offsets = np.maximum(shingle_starts[doc_idxs], start) - start
+            minimums[doc_idxs] = np.minimum(minimums[doc_idxs], np.minimum.reduceat(hashes, offsets, axis=1).T)
+
+        has_shingles = shingle_counts > 0
+        signatures[has_shingles] = (minimums[has_shingles] >> np.uint64(32)).astype(np.uint32)
+        return signatures
+
+
+def lsh_candidate_pairs(signatures: np.ndarray, num_bands: int = NUM_BANDS) -> np.ndarray:
+    """
+    Get the pairs of documents sharing at least one LSH band of their signatures.
+
+    Documents in the same bucket are paired with the first document of the bucket only, so a bucket of `m` documents
+    gives `m - 1` pairs rather than `m * (m - 1) / 2`. Near-duplicates are later grouped by connected components,
+    which still links all of them.
+
+    Args:
+        signatures: The MinHash signatures, of shape (num_docs, num_perm).
+        num_bands: The number of bands, it must divide num_perm.
+
+    Returns:
+        An array of shape (num_pairs, 2) of unique pairs (i, j) with i < j.
+    """
+    num_docs, num_perm = signatures.shape
+    if num_perm % num_bands:
+        raise ValueError(f"The number of bands must divide the signature length. Got {num_bands} bands for {num_perm}.")
+
+    # Documents without words have no shingles and match nothing.
+    doc_idxs = np.flatnonzero((signatures != np.iinfo(np.uint32).max).any(axis=1))
+    rows = num_perm // num_bands
+    mults = np.random.default_rng(SEED).integers(0, 1 << 63, size=rows, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    pairs = []
+    for band in range(num_bands):
+        band_signatures = signatures[doc_idxs, band * rows:(band + 1) * rows].astype(np.uint64)
+        keys = (band_signatures * mults).sum(axis=1, dtype=np.uint64)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        new_bucket = np.empty(len(keys), dtype=bool)
+        new_bucket[:1] = True
+        new_bucket[1:] = keys[1:] != keys[:-1]
+        # Position, in the sorted keys, of the first document of the bucket of every document.
+        firsts = np.maximum.accumulate(np.where(new_bucket, np.arange(len(keys)), 0))
+        members = ~new_bucket
+        pairs.append(np.stack([doc_idxs[order[firsts[members]]], doc_idxs[order[members]]], axis=1))
+
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+    pairs.sort(axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def similar_pairs(signatures: np.ndarray, pairs: np.ndarray, threshold: float = JACCARD_THRESHOLD) -> np.ndarray:
+    """
+    Keep the candidate pairs whose estimated Jaccard similarity is at least `threshold`.
+
+    Args:
+        signatures: The MinHash signatures.
+        pairs: The candidate pairs.
+        threshold: The minimum estimated Jaccard similarity.
+
+    Returns:
+        The near-duplicate pairs.
+    """
+    keep = np.zeros(len(pairs), dtype=bool)
+    for start in range(0, len(pairs), VERIFY_BATCH_SIZE):
+        batch = pairs[start:start + VERIFY_BATCH_SIZE]
+        agreement = (signatures[batch[:, 0]] == signatures[batch[:, 1]]).mean(axis=1)
+        keep[start:start + VERIFY_BATCH_SIZE] = agreement >= threshold
+    return pairs[keep]
+
+
+def find_near_duplicates(texts: Iterable[str | None], reference_texts: Iterable[str | None] = (),
+                         threshold: float = JACCARD_THRESHOLD, num_perm: int = NUM_PERM, num_bands: int = NUM_BANDS,
+                         shingle_size: int = SHINGLE_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the near-duplicates among the texts, and the texts that are near-duplicates of a reference text.
+
+    Only the MinHash signatures are kept in memory, (len(texts) + len(reference_texts)) x num_perm x 4 bytes,
+    so the texts can be streamed from disk.
+
+    Args:
+        texts: The texts to deduplicate, e.g. the positives of the train split.
+        reference_texts: The texts that must not be duplicated, e.g. the positives of the eval and test splits.
+        threshold: The minimum estimated Jaccard similarity of near-duplicates.
+        num_perm: The number of MinHash permutations.
+        num_bands: The number of LSH bands.
+        shingle_size: The number of words in a shingle.
+
+    Returns:
+        Two arrays over the texts:
+            - duplicate_of: The index of the first text of the group of near-duplicates of each text, -1 for the first text of a group and for unique texts.
+            - leaked: Whether each text is in a group of near-duplicates holding a reference text.
+
+    Example:
+        >>> duplicate_of, leaked = find_near_duplicates(train_texts, eval_texts)
+        >>> keep = (duplicate_of == -1) & ~leaked
+    """
+    hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+    signatures = hasher.signatures(texts)
+    num_texts = len(signatures)
+    reference_signatures = hasher.signatures(reference_texts)
+    if len(reference_signatures):
+        signatures = np.concatenate([signatures, reference_signatures])
+
+    pairs = similar_pairs(signatures, lsh_candidate_pairs(signatures, num_bands), threshold)
+    num_docs = len(signatures)
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(num_docs, num_docs))
+    _, groups = connected_components(graph, directed=False)
+
+    # The first index of every group, reference texts come after all of the texts.
+    group_firsts = np.full(groups.max() + 1 if num_docs else 0, num_docs, dtype=np.int64)
+    np.minimum.at(group_firsts, groups, np.arange(num_docs))
+    leaked_groups = np.zeros(len(group_firsts), dtype=bool)
+    leaked_groups[groups[num_texts:]] = True
+
+    groups = groups[:num_texts]
+    duplicate_of = group_firsts[groups]
+    duplicate_of[duplicate_of == np.arange(num_texts)] = -1
+    return duplicate_of, leaked_groups[groups]
+
+
+def _pos_texts(rows: Iterable[dict]) -> Iterator[str | None]:
+    for row in rows:
+        yield row["pos"][0] if isinstance(row["pos"], list) else row["pos"]
+
+
+def deduplicate(rows: list[dict], reference_rows: Iterable[dict] = (), threshold: float = JACCARD_THRESHOLD,
+                drop: bool = True) -> tuple[list[dict], list[dict]]:
+    """
+    Find the near-duplicate positives of the rows, within the rows and against the reference rows.
+
+    Args:
+        rows: The rows to deduplicate, e.g. the rows of the train split.
+        reference_rows: The rows whose positives must not appear in `rows`, e.g. the rows of the eval and test splits.
+        threshold: The minimum estimated Jaccard similarity of near-duplicates.
+        drop: Whether to drop the duplicates, otherwise all rows are returned.
+
+    Returns:
+        The rows, and a report of the dropped (or duplicate) rows: their index, the index of the row they duplicate
+        (None when they only match a reference row) and whether they match a reference row.
+    """
+    duplicate_of, leaked = find_near_duplicates(_pos_texts(rows), _pos_texts(reference_rows), threshold=threshold)
+    duplicate_idxs = np.flatnonzero((duplicate_of >= 0) | leaked)
+    report = [
+        {"idx": idx, "duplicate_of": int(duplicate_of[idx]) if duplicate_of[idx] >= 0 else None, "leaked": bool(leaked[idx])}
+        for idx in duplicate_idxs.tolist()
+    ]
+
+    if not drop:
+        return rows, report
+
+    keep = np.ones(len(duplicate_of), dtype=bool)
+    keep[duplicate_idxs] = False
+    return [row for row, keep_row in zip(rows, keep.tolist()) if keep_row], report
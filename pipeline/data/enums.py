@@ -39,6 +39,31 @@ class DataOperation(StrEnum, metaclass=StrEnumMeta):
     create = "create"
     postprocess = "postprocess"
     translate = "translate"
+    dedup = "dedup"
+
+    def __repr__(self):
+        return self.value
+
+class NegativeSampling(StrEnum, metaclass=StrEnumMeta):
+    random = "random"
+    hard = "hard"
+
+    def __repr__(self):
+        return self.value
+
+class ArtefactFormat(StrEnum, metaclass=StrEnumMeta):
+    jsonl = "jsonl"
+    # Compressed columnar files, with the repeated texts dictionary encoded.
+    parquet = "parquet"
+    # Uncompressed Arrow IPC files, memory mapped and read without copies.
+    arrow = "arrow"
+
+    def __repr__(self):
+        return self.value
+
+class Compression(StrEnum, metaclass=StrEnumMeta):
+    gzip = "gzip"
+    zstd = "zstd"
 
     def __repr__(self):
         return self.value
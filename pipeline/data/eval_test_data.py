@@ -9,20 +9,30 @@ from pipeline.data.wura import prepare_wura
 from pipeline.constants import SEED
 from pipeline.data.enums import Language
 from pipeline.data.constants import WURA_LANG_ID_MAP
+from pipeline.data.stage_cache import StageCache, module_dependencies, stage_key
+from pipeline.data.utils import write_artefact
+
+
+# The modules `prepare_wura` is implemented in, with the modules they import, a change to them invalidates the cached prepared frames.
+PREPARE_WURA_MODULES = module_dependencies(["pipeline.data.wura"])
 
 
 if TYPE_CHECKING:
     import pandas as pd
 
 
-def make_eval_test_dataset(language: str | Language, eval_filename: str = "eval_dataset.jsonl", test_filename: str = "test_dataset.jsonl") -> dict[str, pd.DataFrame]:
+def make_eval_test_dataset(language: str | Language, eval_filename: str = "eval_dataset.jsonl", test_filename: str = "test_dataset.jsonl",
+                           stage_cache: StageCache | None = None, num_shards: int = 1, compression: str | None = None) -> dict[str, pd.DataFrame]:
     """
     Extract the validation split from the WURA dataset, then split it into eval and test sets.
 
     Args:
         language: The language to extract the validation split from.
-        eval_filename: The filename to save the eval set to.
-        test_filename: The filename to save the test set to.
+        eval_filename: The filename to save the eval set to, its suffix picks the format.
+        test_filename: The filename to save the test set to, its suffix picks the format.
+        stage_cache: The cache of the prepared validation split, it is prepared on every call when None.
+        num_shards: The number of shards of the sets, when their filenames are manifests, see `write_artefact`.
+        compression: The compression of the shards of the sets.
 
     Returns:
         A dictionary with the eval and test sets.
@@ -31,28 +41,35 @@ def make_eval_test_dataset(language: str | Language, eval_filename: str = "eval_
         >>> make_eval_test_dataset("hausa")
         {'eval': <pandas.DataFrame>, 'test': <pandas.DataFrame>}
     """
-    if language.lower() not in Language:
+    if language.lower() not in list(Language):
         raise ValueError(f"Language must be one of {language}.")
     wura_lang = WURA_LANG_ID_MAP.get(language.lower())
     if not wura_lang:
         raise ValueError(f"Language {language} not found in WURA_LANG_ID_MAP.")
     
-    dataset = load_dataset("castorini/wura", wura_lang, level="document", trust_remote_code=True)
-    validation_data = dataset.get("validation")
+    def prepare_validation_data():
+        dataset = load_dataset("castorini/wura", wura_lang, level="document", trust_remote_code=True)
+        validation_data = dataset.get("validation")
 
-    if not validation_data:
-        raise ValueError(f"Dataset {wura_lang} does not have a validation split. Only found {dataset.keys()} splits.")
-    
-    lang_df = prepare_wura(validation_data)
+        if not validation_data:
+            raise ValueError(f"Dataset {wura_lang} does not have a validation split. Only found {dataset.keys()} splits.")
+        return prepare_wura(validation_data)
+
+    if stage_cache is not None:
+        # The eval and test sets are drawn from the same prepared frame, it is only prepared once for both.
+        key = stage_key("prepare_wura", {"dataset": "castorini/wura", "config": wura_lang, "split": "validation"}, modules=PREPARE_WURA_MODULES)
+        lang_df = stage_cache.frame("prepare_wura", key, prepare_validation_data)
+    else:
+        lang_df = prepare_validation_data()
     lang_df.rename(columns={"text": "pos", "title": "query"}, inplace=True)
     eval_df, test_df = train_test_split(lang_df, test_size=0.4, random_state=SEED, shuffle=True)
     split_dfs = {}
     if eval_filename:
-        eval_df.to_json(eval_filename, orient="records", lines=True)
+        write_artefact(eval_filename, eval_df, num_shards=num_shards, compression=compression)
         split_dfs["eval"] = eval_df
 
     if test_filename:
-        test_df.to_json(test_filename, orient="records", lines=True)
+        write_artefact(test_filename, test_df, num_shards=num_shards, compression=compression)
         split_dfs["test"] = test_df
     
     return split_dfs
@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+try:
+    # orjson is not a hard requirement, it is only used as a faster backend when installed.
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+# Size of the blocks read when scanning a file for line offsets.
+INDEX_BLOCK_SIZE = 1 << 24
+# Number of encoded lines buffered by the writer before hitting the file.
+WRITE_BUFFER_LINES = 1024
+# Size of the blocks read from compressed files.
+READ_BLOCK_SIZE = 1 << 20
+# Compression codecs of JSONL files, picked from their suffix. The streams are handled by pyarrow.
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+MANIFEST_SUFFIX = ".manifest.json"
+
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(line: bytes | str):
+    """
+    Decode a single JSON value.
+
+    Args:
+        line: The encoded JSON value.
+
+    Returns:
+        The decoded value.
+    """
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def dumps(obj) -> bytes:
+    """
+    Encode a single JSON value, using compact separators and keeping non-ASCII characters as is.
+
+    Args:
+        obj: The value to encode.
+
+    Returns:
+        The encoded value, as UTF-8 bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _JSON_ENCODER.encode(obj).encode("utf-8")
+
+
+def index_lines(buffer) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the start and end offsets of the non-empty lines in the buffer.
+
+    Args:
+        buffer: A bytes-like object, usually a memory map of a JSONL file.
+
+    Returns:
+        The start offsets and the end offsets (exclusive, without the newline) of the lines.
+    """
+    size = len(buffer)
+    view = np.frombuffer(buffer, dtype=np.uint8) if size else np.empty(0, dtype=np.uint8)
+    newlines = [
+        np.flatnonzero(view[start:start + INDEX_BLOCK_SIZE] == ord("\n")) + start
+        for start in range(0, size, INDEX_BLOCK_SIZE)
+    ]
+    ends = np.concatenate(newlines).astype(np.int64) if newlines else np.empty(0, dtype=np.int64)
+    # Lines are only ended by a newline, the last one might not have it.
+    if size and (not len(ends) or ends[-1] != size - 1):
+        ends = np.append(ends, size)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64) if len(ends) else ends.copy()
+    del view
+
+    non_empty = ends > starts
+    return starts[non_empty], ends[non_empty]
+
+
+class JsonlRows(Sequence):
+    """
+    Lazy, read-only view over the rows of a JSONL file.
+
+    Only the line offsets are held in memory, rows are decoded when they are accessed.
+    Integer indexing decodes a single line, while slicing returns another lazy view.
+    As every access decodes afresh, changes made to a returned row are not kept by the view.
+
+    Example:
+        >>> rows = JsonlRows("yoruba_train_dataset.jsonl")
+        >>> rows[0]["query"]
+        >>> for row in rows[1000:2000]:
+        ...     ...
+    """
+
+    def __init__(self, path: str | Path, starts: np.ndarray | None = None, ends: np.ndarray | None = None):
+        self.path = Path(path)
+        self._mmap = None
+        if starts is None or ends is None:
+            starts, ends = index_lines(self._buffer())
+        self._starts = starts
+        self._ends = ends
+
+    def _buffer(self):
+        if self._mmap is None:
+            with open(self.path, "rb") as f_:
+                if f_.seek(0, 2) == 0:
+                    return b""
+                self._mmap = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def line(self, idx: int) -> bytes:
+        """
+        Get the raw bytes of a line, without decoding it.
+
+        Args:
+            idx: The index of the line.
+
+        Returns:
+            The line bytes.
+        """
+        return self._buffer()[self._starts[idx]:self._ends[idx]]
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return JsonlRows(self.path, self._starts[idx], self._ends[idx])
+        if idx < -len(self) or idx >= len(self):
+            raise IndexError(f"Row index {idx} is out of range for {len(self)} rows.")
+        return loads(self.line(idx))
+
+    def __iter__(self) -> Iterator:
+        buffer = self._buffer()
+        for start, end in zip(self._starts.tolist(), self._ends.tolist()):
+            yield loads(buffer[start:end])
+
+    def __repr__(self) -> str:
+        return f"JsonlRows(path={str(self.path)!r}, rows={len(self)})"
+
+    def __getstate__(self) -> dict:
+        # The memory map cannot be pickled, it is reopened lazily on the other side.
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        return state
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self) -> JsonlRows:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def jsonl_compression(file_path: str | Path) -> str | None:
+    """Get the compression codec of a JSONL file from its suffix, e.g. "zstd" for "rows.jsonl.zst"."""
+    return COMPRESSION_SUFFIXES.get(Path(file_path).suffix)
+
+
+def _iter_lines(file_path: str | Path) -> Iterator[bytes]:
+    compression = jsonl_compression(file_path)
+    if compression is None:
+        with open(file_path, "rb") as f_:
+            yield from f_
+        return
+
+    # Compressed streams do not support reading lines, so the lines are split out of blocks.
+    with pa.input_stream(str(file_path), compression=compression) as f_:
+        rest = b""
+        while block := f_.read(READ_BLOCK_SIZE):
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            yield from lines
+        if rest:
+            yield rest
+
+
+def iter_jsonl(file_path: str | Path) -> Iterator:
+    """
+    Stream the rows of a JSONL file, one decoded row at a time.
+
+    Empty lines are skipped and `null` lines are returned as None. Files ending in ".gz" or ".zst" are decompressed.
+
+    Args:
+        file_path: The path of the JSONL file.
+
+    Returns:
+        An iterator over the rows.
+    """
+    for line in _iter_lines(file_path):
+        if line.strip():
+            yield loads(line)
+
+
+def _open_for_writing(file_path: str | Path, mode: str):
+    compression = jsonl_compression(file_path)
+    if compression is None:
+        return open(file_path, mode + "b")
+    if mode != "w":
+        raise ValueError(f"Compressed files cannot be appended to, got {file_path}.")
+    return pa.output_stream(str(file_path), compression=compression)
+
+
+def write_jsonl(file_path: str | Path, rows: Iterable, mode: str = "w") -> int:
+    """
+    Stream rows into a JSONL file, compressed when its suffix is ".gz" (gzip) or ".zst" (zstd).
+
+    Args:
+        file_path: The path of the JSONL file.
+        rows: The rows to write, any iterable including generators and `JsonlRows` views.
+        mode: "w" to overwrite the file, "a" to append to it. Compressed files can only be overwritten.
+
+    Returns:
+        The number of rows written.
+    """
+    if mode not in {"w", "a"}:
+        raise ValueError(f"Unsupported mode: {mode}. Supported modes are 'w' and 'a'.")
+
+    count = 0
+    rows = iter(rows)
+    with _open_for_writing(file_path, mode) as f_:
+        for block in iter(lambda: [dumps(row) for row in islice(rows, WRITE_BUFFER_LINES)], []):
+            f_.write(b"\n".join(block) + b"\n")
+            count += len(block)
+    return count
+
+
+def shard_paths(manifest_path: str | Path, num_shards: int, compression: str | None = None) -> list[Path]:
+    """
+    Get the paths of the shards of a sharded JSONL file, e.g. "rows-00000-of-00004.jsonl.zst" for "rows.manifest.json".
+
+    Args:
+        manifest_path: The path of the manifest of the shards.
+        num_shards: The number of shards.
+        compression: The compression codec of the shards, "gzip", "zstd" or None.
+
+    Returns:
+        The paths of the shards.
+    """
+    manifest_path = Path(manifest_path)
+    stem = manifest_path.name.removesuffix(MANIFEST_SUFFIX)
+    suffix = ".jsonl" + {codec: suffix for suffix, codec in COMPRESSION_SUFFIXES.items()}.get(compression, "")
+    return [manifest_path.with_name(f"{stem}-{idx:05d}-of-{num_shards:05d}{suffix}") for idx in range(num_shards)]
+
+
+def write_jsonl_shards(manifest_path: str | Path, rows: Iterable, num_shards: int, compression: str | None = None) -> int:
+    """
+    Stream rows into JSONL shards, then write a manifest listing them.
+
+    Blocks of `WRITE_BUFFER_LINES` rows go to the shards in turn, so the shards are balanced without knowing the number
+    of rows upfront, and can be read in parallel, e.g. by dataloader workers. `iter_jsonl_shards` reads the rows back
+    in their original order. The manifest is written last, atomically, so it only ever lists complete shards.
+
+    Args:
+        manifest_path: The path of the manifest, it must end with ".manifest.json".
+        rows: The rows to write.
+        num_shards: The number of shards.
+        compression: The compression codec of the shards, "gzip", "zstd" or None.
+
+    Returns:
+        The number of rows written.
+    """
+    manifest_path = Path(manifest_path)
+    if not manifest_path.name.endswith(MANIFEST_SUFFIX):
+        raise ValueError(f"The manifest path must end with {MANIFEST_SUFFIX}, got {manifest_path}.")
+    if compression not in {None, *COMPRESSION_SUFFIXES.values()}:
+        raise ValueError(f"Unsupported compression: {compression}. Supported codecs are {list(COMPRESSION_SUFFIXES.values())}.")
+
+    paths = shard_paths(manifest_path, num_shards, compression)
+    counts = [0] * num_shards
+    # Hashing the uncompressed content, so that the manifest changes whenever the rows do.
+    digests = [hashlib.sha256() for _ in paths]
+    files = [_open_for_writing(path, "w") for path in paths]
+    rows = iter(rows)
+    try:
+        blocks = iter(lambda: [dumps(row) for row in islice(rows, WRITE_BUFFER_LINES)], [])
+        for idx, block in enumerate(blocks):
+            data = b"\n".join(block) + b"\n"
+            files[idx % num_shards].write(data)
+            digests[idx % num_shards].update(data)
+            counts[idx % num_shards] += len(block)
+    finally:
+        for f_ in files:
+            f_.close()
+
+    stale_paths = set()
+    if manifest_path.exists():
+        stale_paths = {manifest_path.with_name(shard["path"]) for shard in json.loads(manifest_path.read_text())["shards"]}
+    manifest = {
+        "num_rows": sum(counts),
+        "block_rows": WRITE_BUFFER_LINES,
+        "compression": compression,
+        "shards": [
+            {"path": path.name, "rows": count, "sha256": digest.hexdigest()}
+            for path, count, digest in zip(paths, counts, digests)
+        ],
+    }
+    tmp_path = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, manifest_path)
+    for path in stale_paths - set(paths):
+        path.unlink(missing_ok=True)
+    return sum(counts)
+
+
+def read_manifest(manifest_path: str | Path) -> dict:
+    """Read the manifest of a sharded JSONL file, see `write_jsonl_shards`."""
+    return json.loads(Path(manifest_path).read_text())
+
+
+def iter_jsonl_shards(manifest_path: str | Path) -> Iterator:
+    """
+    Stream the rows of a sharded JSONL file in the order they were written, taking blocks from the shards in turn.
+
+    Args:
+        manifest_path: The path of the manifest of the shards.
+
+    Returns:
+        An iterator over the rows.
+    """
+    manifest_path = Path(manifest_path)
+    manifest = read_manifest(manifest_path)
+    shards = [iter_jsonl(manifest_path.with_name(shard["path"])) for shard in manifest["shards"]]
+    while shards:
+        for shard in list(shards):
+            block = list(islice(shard, manifest["block_rows"]))
+            if len(block) < manifest["block_rows"]:
+                shards.remove(shard)
+            yield from block
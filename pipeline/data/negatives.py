@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import os
+import re
+import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pipeline.constants import SEED
+from pipeline.data.enums import NegativeSampling
+from pipeline.data.utils import NUM_NEGATIVES, add_negatives, sample_negative_idxs
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+COMBINING_MARKS_PATTERN = re.compile(r"[\u0300-\u036f]")
+# Terms appearing in more than this share of the documents (and in more than MIN_DOC_FREQ_CUTOFF documents)
+# are dropped from the index. They carry almost no BM25 weight but their postings dominate scoring time.
+MAX_DOC_FREQ_RATIO = 0.1
+MIN_DOC_FREQ_CUTOFF = 1000
+# Number of queries scored together by a worker.
+MINING_BATCH_SIZE = 512
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize the text for lexical matching.
+
+    Lowercases the text and removes the combining marks, so tones and under dots used in Yoruba and Igbo
+    (e.g. "Ọ̀rọ̀" and "oro") match. Hausa hooked letters (ɓ, ɗ, ƙ, ƴ) are distinct letters and are kept.
+
+    Args:
+        text: The text to normalize.
+
+    Returns:
+        The normalized text.
+    """
+    text = unicodedata.normalize("NFD", text.lower())
+    return unicodedata.normalize("NFC", COMBINING_MARKS_PATTERN.sub("", text))
+
+
+def tokenize(text: str | None) -> list[str]:
+    """
+    Split the text into normalized word tokens.
+
+    Args:
+        text: The text to tokenize.
+
+    Returns:
+        The tokens.
+    """
+    return TOKEN_PATTERN.findall(normalize_text(text)) if text else []
+
+
+class BM25Index:
+    """
+    BM25 inverted index over a list of documents.
+
+    Postings are stored in CSR form: the postings of term `t` are `doc_ids[offsets[t]:offsets[t + 1]]`,
+    with the matching precomputed BM25 term weights in `weights`, so scoring a query is a gather and a sum.
+
+    Args:
+        docs: The documents to index.
+        k1: The BM25 term frequency saturation parameter.
+        b: The BM25 length normalization parameter.
+        max_doc_freq_ratio: Terms appearing in more than this share of the documents are not indexed, unless they appear in fewer than MIN_DOC_FREQ_CUTOFF documents.
+    """
+
+    def __init__(self, docs: list[str], k1: float = 1.2, b: float = 0.75, max_doc_freq_ratio: float = MAX_DOC_FREQ_RATIO):
+        self.vocab = {}
+        term_ids, doc_ids, term_freqs = [], [], []
+        doc_lens = np.zeros(len(docs), dtype=np.float32)
+        for doc_id, doc in enumerate(docs):
+            tokens = tokenize(doc)
+            doc_lens[doc_id] = len(tokens)
+            for term, freq in Counter(tokens).items():
+                term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+                doc_ids.append(doc_id)
+                term_freqs.append(freq)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        term_freqs = np.asarray(term_freqs, dtype=np.float32)
+
+        num_docs = max(len(docs), 1)
+        doc_freqs = np.bincount(term_ids, minlength=len(self.vocab))
+        idf = np.log1p((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        avg_doc_len = max(float(doc_lens.mean()) if len(docs) else 0.0, 1.0)
+        norms = k1 * (1 - b + b * doc_lens / avg_doc_len)
+        weights = idf[term_ids] * term_freqs * (k1 + 1) / (term_freqs + norms[doc_ids])
+
+        keep = doc_freqs[term_ids] <= max(max_doc_freq_ratio * num_docs, MIN_DOC_FREQ_CUTOFF)
+        term_ids, doc_ids, weights = term_ids[keep], doc_ids[keep], weights[keep]
+        order = np.argsort(term_ids, kind="stable")
+        self.doc_ids = doc_ids[order]
+        self.weights = weights[order].astype(np.float32)
+        self.offsets = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self.vocab)), out=self.offsets[1:])
+        self.num_docs = len(docs)
+
+    def query_term_ids(self, query: str) -> np.ndarray:
+        """Get the unique ids of the indexed terms in the query."""
+        term_ids = {self.vocab[term] for term in tokenize(query) if term in self.vocab}
+        return np.fromiter(term_ids, dtype=np.int64, count=len(term_ids))
+
+    def search(self, queries: list[str], k: int | None = None) -> list[np.ndarray]:
+        """
+        Get the top scoring documents for each of the queries.
+
+        Only the postings of the query terms are touched, so the cost follows the postings length and not the number of documents.
+        With `k`, only the documents scoring at least as high as the k-th one are sorted.
+
+        Args:
+            queries: The queries to search for.
+            k: The maximum number of documents to return per query, all matching documents are returned when None.
+
+        Returns:
+            The document ids of each query, best first and by id on ties. Queries with fewer than `k` matching documents get fewer ids.
+        """
+        results = [np.empty(0, dtype=np.int64) for _ in queries]
+        for query_idx, query in enumerate(queries):
+            term_ids = self.query_term_ids(query)
+            if not len(term_ids):
+                continue
+            starts, ends = self.offsets[term_ids], self.offsets[term_ids + 1]
+            posting_idxs = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+            if not len(posting_idxs):
+                continue
+
+            # Summing the weights of the postings of the same document.
+            doc_ids, inverse = np.unique(self.doc_ids[posting_idxs], return_inverse=True)
+            scores = np.bincount(inverse, weights=self.weights[posting_idxs])
+            if k is not None and len(doc_ids) > k:
+                # Keeping the ties of the k-th score, so the ids picked among them do not depend on the partition.
+                kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+                top = scores >= kth_score
+                doc_ids, scores = doc_ids[top], scores[top]
+            results[query_idx] = doc_ids[np.lexsort((doc_ids, -scores))][:k].astype(np.int64)
+        return results
+
+
+_worker_state = {}
+
+
+def _init_worker(index: BM25Index, doc_groups: np.ndarray) -> None:
+    _worker_state["index"] = index
+    _worker_state["doc_groups"] = doc_groups
+    _worker_state["group_sizes"] = np.bincount(doc_groups)
+
+
+def _mine_batch(start: int, queries: list[str], size: int) -> tuple[int, list[np.ndarray]]:
+    index, doc_groups, group_sizes = _worker_state["index"], _worker_state["doc_groups"], _worker_state["group_sizes"]
+    # Enough candidates for `size` negatives once the positive and its copies are dropped.
+    k = size + int(group_sizes[doc_groups[start:start + len(queries)]].max())
+    results = []
+    for query_idx, candidates in enumerate(index.search(queries, k=k), start=start):
+        # The positive of query `i` is document `i`, copies of it are not negatives either.
+        candidates = candidates[doc_groups[candidates] != doc_groups[query_idx]]
+        results.append(candidates[:size])
+    return start, results
+
+
+def mine_hard_negatives(queries: list[str], docs: list[str], size: int = NUM_NEGATIVES, seed: int = SEED,
+                        workers: int | None = None, batch_size: int = MINING_BATCH_SIZE) -> np.ndarray:
+    """
+    Mine the indexes of the hard negatives of every query with BM25.
+
+    The positive of the query at index `i` is the document at index `i`. The negatives are the highest scoring
+    documents that are not the positive nor a copy of it. Queries matching fewer than `size` documents
+    are completed with random negatives.
+
+    Args:
+        queries: The queries to mine negatives for.
+        docs: The positive documents of the queries, they are also the pool of negatives.
+        size: The number of negatives per query.
+        seed: The seed of the random negatives used to complete the hard ones.
+        workers: The number of processes to mine with, defaults to the number of CPUs.
+        batch_size: The number of queries scored together.
+
+    Returns:
+        An array of shape (len(queries), size) holding the negative indexes.
+    """
+    if len(queries) != len(docs):
+        raise ValueError(f"Every query needs a positive document. Got {len(queries)} queries and {len(docs)} documents.")
+
+    neg_idxs = sample_negative_idxs(len(docs), size=size, seed=seed)
+    index = BM25Index(docs)
+    # Documents with the same text share a group id.
+    doc_hashes = np.fromiter((hash(doc) for doc in docs), dtype=np.int64, count=len(docs))
+    _, doc_groups = np.unique(doc_hashes, return_inverse=True)
+
+    batches = [(start, queries[start:start + batch_size], size) for start in range(0, len(queries), batch_size)]
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index, doc_groups)) as executor:
+            mined = list(executor.map(_mine_batch, *zip(*batches)))
+    else:
+        _init_worker(index, doc_groups)
+        mined = [_mine_batch(*batch) for batch in batches]
+        _worker_state.clear()
+
+    for start, results in mined:
+        for query_idx, hard_idxs in enumerate(results, start=start):
+            if len(hard_idxs) == size:
+                neg_idxs[query_idx] = hard_idxs
+            elif len(hard_idxs):
+                # Filling up with the random picks that are not already part of the hard negatives.
+                random_idxs = neg_idxs[query_idx][~np.isin(neg_idxs[query_idx], hard_idxs)]
+                neg_idxs[query_idx] = np.concatenate([hard_idxs, random_idxs])[:size]
+    return neg_idxs
+
+
+def add_hard_negatives(rows: list[dict], size: int = NUM_NEGATIVES, query_key: str = "query", workers: int | None = None) -> list[dict]:
+    """
+    Add BM25 mined negative samples to all of the rows.
+
+    Args:
+        rows: The rows to add the negatives to, they are updated in place.
+        size: The number of negatives per row.
+        query_key: The key of the text used to mine the negatives.
+        workers: The number of processes to mine with.
+
+    Returns:
+        The rows.
+    """
+    if not rows:
+        return rows
+
+    docs = [row["pos"][0] if isinstance(row["pos"], list) else row["pos"] for row in rows]
+    neg_idxs = mine_hard_negatives([row[query_key] for row in rows], docs, size=size, workers=workers)
+    for row, row_neg_idxs in zip(rows, neg_idxs.tolist()):
+        row["neg"] = [docs[i] for i in row_neg_idxs]
+    return rows
+
+
+def assign_negatives(rows: list[dict], negatives: str | NegativeSampling = NegativeSampling.random, query_key: str = "query") -> list[dict]:
+    """
+    Add negative samples to all of the rows, using the given sampling method.
+
+    Args:
+        rows: The rows to add the negatives to, they are updated in place.
+        negatives: The negative sampling method.
+        query_key: The key of the text used to mine hard negatives.
+
+    Returns:
+        The rows.
+    """
+    if NegativeSampling(negatives) == NegativeSampling.hard:
+        return add_hard_negatives(rows, query_key=query_key)
+    return add_negatives(rows)
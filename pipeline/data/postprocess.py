@@ -1,15 +1,142 @@
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable, Sequence
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from functools import reduce
-import math
 import re
 import warnings
 
 import numpy as np
 
-from pipeline.data.enums import DataSource, Language
-from pipeline.constants import SEED
+from pipeline.data.enums import DataSource, Language, NegativeSampling
 from pipeline.text_utils import skip_doc_body
-from pipeline.data.utils import extract_domain_name, fix_negatives, load_artefact
+from pipeline.data.negatives import assign_negatives
+from pipeline.data.columnar import ArrowRows
+from pipeline.data.sampling import (TEXT_LENGTH_BINS, is_in_memory, nested_quotas, reservoir_sample, stratified_sample,
+                                    take_rows, text_length_bins, text_lengths)
+from pipeline.data.utils import extract_domain_name, load_artefact
+
+
+class _QuerySentenceMatcher:
+    r"""
+    Finds the sentences of a document that contain the query words, in order, with up to two words between them.
+
+    This is a linear time replacement for substituting the following regex, built from the query words w1, w2, ...:
+
+        [^\.]*w1\s*([^\s]+\s*){,2}w2\s*([^\s]+\s*){,2}w3...[^\.]*.
+
+    The regex backtracks over every starting position of a sentence that does not contain the query, which is
+    quadratic on long documents. The matcher walks the same candidates in the same order as the regex engine,
+    so it removes the exact same spans, but only starts from the positions where the first query word occurs,
+    and remembers the positions a query word has already failed from.
+
+    Args:
+        text: The document.
+        query: The query.
+    """
+
+    def __init__(self, text: str, query: str):
+        self.text = text
+        self.words = [re.compile(re.escape(word), re.IGNORECASE) for word in query.split()]
+        # The whitespace separated tokens of the document, found once.
+        tokens = [match.span() for match in re.finditer(r"[^\s]+", text)]
+        self.token_starts = [start for start, _ in tokens]
+        self.token_ends = [end for _, end in tokens]
+        self.dots = [idx for idx, char in enumerate(text) if char == "."]
+        last_char = len(text.rstrip("\n")) - 1
+        self.last_non_newline = last_char if last_char >= 0 else None
+        self.failed = set()
+
+    def _next_dot(self, pos: int) -> int | None:
+        idx = bisect_left(self.dots, pos)
+        return self.dots[idx] if idx < len(self.dots) else None
+
+    def _sentence_end(self, pos: int) -> int | None:
+        # Equivalent to matching `[^\.]*.` at `pos`.
+        dot = self._next_dot(pos)
+        if dot is not None:
+            return dot + 1
+        if self.last_non_newline is not None and self.last_non_newline >= pos:
+            return self.last_non_newline + 1
+        return None
+
+    def _gap_candidates(self, pos: int) -> list[int]:
+        # Positions matched by `\s*([^\s]+\s*){,2}` at `pos`, in the order the regex engine tries them i.e. farthest first.
+        token_idx = bisect_right(self.token_starts, pos) - 1
+        if token_idx >= 0 and self.token_ends[token_idx] > pos:
+            first_start, first_end = pos, self.token_ends[token_idx]
+        elif token_idx + 1 < len(self.token_starts):
+            token_idx += 1
+            first_start, first_end = self.token_starts[token_idx], self.token_ends[token_idx]
+        else:
+            return []
+
+        candidates = []
+        if token_idx + 1 < len(self.token_starts):
+            second_start, second_end = self.token_starts[token_idx + 1], self.token_ends[token_idx + 1]
+            if token_idx + 2 < len(self.token_starts):
+                candidates.append(self.token_starts[token_idx + 2])
+            candidates.extend(range(second_end - 1, second_start - 1, -1))
+        candidates.extend(range(first_end - 1, first_start - 1, -1))
+        return candidates
+
+    def _match_words(self, word_idx: int, pos: int) -> int | None:
+        # Returns the end of the sentence when the query words from `word_idx` match from `pos`.
+        if (word_idx, pos) in self.failed:
+            return None
+
+        match = self.words[word_idx].match(self.text, pos)
+        end = None
+        if match and word_idx == len(self.words) - 1:
+            end = self._sentence_end(match.end())
+        elif match:
+            for candidate in self._gap_candidates(match.end()):
+                end = self._match_words(word_idx + 1, candidate)
+                if end is not None:
+                    break
+
+        if end is None:
+            self.failed.add((word_idx, pos))
+        return end
+
+    def remove_sentences(self) -> str:
+        """Remove the sentences where the query appears, returning the rest of the document."""
+        if not self.words:
+            return self.text
+
+        first_word_starts = [match.start() for match in re.finditer(f"(?={self.words[0].pattern})", self.text, re.IGNORECASE)]
+        pieces = []
+        pos = 0
+        while pos < len(self.text):
+            # A sentence spans from `pos` to the next dot, the query can start anywhere in it.
+            dot = self._next_dot(pos)
+            sentence_last = dot if dot is not None else len(self.text) - 1
+            lower, upper = bisect_left(first_word_starts, pos), bisect_right(first_word_starts, sentence_last)
+            end = None
+            for start in reversed(first_word_starts[lower:upper]):
+                end = self._match_words(0, start)
+                if end is not None:
+                    break
+
+            if end is None:
+                pieces.append(self.text[pos:sentence_last + 1])
+                pos = sentence_last + 1
+            else:
+                pos = end
+        return "".join(pieces)
+
+
+def remove_query_sentences(text: str, query: str) -> str:
+    """
+    Remove the sentences of the text where the query words appear in order, allowing up to two words between them.
+
+    Args:
+        text: The text to remove the sentences from.
+        query: The query.
+
+    Returns:
+        The text without the matching sentences.
+    """
+    return _QuerySentenceMatcher(text, query).remove_sentences()
 
 
 def fix_wiki_pos(row: dict) -> dict:
@@ -37,19 +164,7 @@ def fix_wiki_pos(row: dict) -> dict:
     substring = f"{query}\n\n"
     pos = pos[len(substring):] if pos.startswith(substring) else pos
     # Remove the query when it somewhere in the actual text, the provided url above also shows this.
-    query_split = [re.escape(q) for q in query.split()]
-    re_pattern = reduce(lambda a, b:
-                        a +
-                        r"\s*" + # Mandatory space after each word
-                        r"([^\s]+\s*){,2}" + # Potential for 0 to 2 words appearing between query words.
-                        b, query_split)
-    re_sentence = r"[^\.]*" + re_pattern + r"[^\.]*." # Matches the sentence where the pattern appears
-    try:
-        re_obj = re.compile(re_sentence, re.IGNORECASE)
-    except Exception as exc:
-        print("Error compiling the regex pattern: ", re_sentence)
-        raise exc
-    pos = re_obj.sub("", pos).strip()
+    pos = remove_query_sentences(pos, query).strip()
 
     pos = "" if "plánẹ́tì kékeré" in pos else pos # Weird text appearing in Yoruba wiki
     row["pos"] = [pos] if pos_is_list else pos
@@ -88,152 +203,161 @@ def get_audits(filename: str, n: int = 100, categories: list[str] = ["X", "NLC"]
             break
     return lines
 
-def postprocess_dataset(rows: list[dict], audits: list[dict], language: str | Language) -> list[dict]:
+# Number of rows handled by a worker at a time when postprocessing in parallel.
+POSTPROCESS_CHUNK_SIZE = 2000
+# The languages balanced by `sample_data_by_language`.
+SAMPLED_LANGUAGES = [Language.yoruba, Language.igbo, Language.hausa]
+
+
+def _process_row(row: dict) -> dict:
+    domain_name = extract_domain_name(row["url"])
+    row = fix_wiki_pos(row) if domain_name.endswith("wikipedia.org") else row
+    row["domain"] = domain_name
+    return row
+
+
+def _postprocess_chunk(rows: list[dict], categories: list[str] | None) -> list[dict]:
+    """
+    Postprocess a chunk of rows.
+
+    Args:
+        rows: The rows to postprocess.
+        categories: The audit categories of the rows. When None, the rows are unaudited and only the Mato rows are kept.
+
+    Returns:
+        The rows that are kept, in order.
+    """
+    results = []
+    for i, row in enumerate(rows):
+        if categories is None and row["source"] != DataSource.mato:
+            continue
+
+        row = _process_row(row)
+        text = row["pos"][0] if isinstance(row["pos"], list) else row["pos"]
+
+        if not text or skip_doc_body(text, row["query"]):
+            continue
+
+        if categories is None or categories[i] not in ["NLC", "SKIP", "EMPTYTEXT"]:
+            results.append(row)
+    return results
+
+
+def postprocess_dataset(rows: list[dict], audits: list[dict], language: str | Language,
+                        negatives: str | NegativeSampling = NegativeSampling.random, workers: int = 1) -> list[dict]:
     """
     Postprocess the dataset. This returns the final dataset that is used for training and evaluation.
 
+    With more than one worker, the rows are postprocessed in chunks across a process pool and merged back in order,
+    so the result is the same as the serial one. Slices of a `JsonlRows` view only carry line offsets, and slices of an
+    `ArrowRows` view only their own rows, so passing the rows as loaded by `load_artefact` keeps what is sent to the workers small.
+
     Args:
         rows: The rows to postprocess.
         audits: The audits to use.
         language: The language of the dataset.
+        negatives: How the negatives of the rows are picked, when the rows have negatives.
+        workers: The number of processes to postprocess the rows with.
 
     Returns:
         The final dataset.
     """
     language = language.lower()
-    if language not in Language:
+    if language not in list(Language):
         raise ValueError(f"Language must be one of {Language}")
     
     language = Language(language)
 
-    def process_row(row):
-        domain_name = extract_domain_name(row["url"])
-        row = fix_wiki_pos(row) if domain_name.endswith("wikipedia.org") else row
-        row["domain"] = domain_name
-        return row
-
     if language != Language.hausa:
         assert len(rows) == len(audits), f"{len(rows)} != {len(audits)}"
 
-    results = []
-    for i in range(len(audits)):
-        row = rows[i]
-        row = process_row(row)
-        text = row["pos"][0] if isinstance(row["pos"], list) else row["pos"]
-
-        if not text or skip_doc_body(text, row["query"]):
-            continue
-
-        if audits[i]["category"] not in ["NLC", "SKIP", "EMPTYTEXT"]:
-            results.append(row)
-
+    categories = [audit["category"] for audit in audits]
+    chunks = [
+        (rows[start:min(start + POSTPROCESS_CHUNK_SIZE, len(audits))], categories[start:start + POSTPROCESS_CHUNK_SIZE])
+        for start in range(0, len(audits), POSTPROCESS_CHUNK_SIZE)
+    ]
     # Hausa does not have all the audits done, so we add the remaining rows to the results.
     # Only adding the rows from the Mato datasource as we trust that source more than the other sources, so auditing can be skipped.
     if language == Language.hausa:
-        for row in rows[len(audits):]:
-            if row["source"] != DataSource.mato:
-                continue
-
-            row = process_row(row)
-            text = row["pos"][0] if isinstance(row["pos"], list) else row["pos"]
-
-            if not text or skip_doc_body(text, row["query"]):
-                continue
-
-            results.append(row)
+        chunks.extend(
+            (rows[start:start + POSTPROCESS_CHUNK_SIZE], None)
+            for start in range(len(audits), len(rows), POSTPROCESS_CHUNK_SIZE)
+        )
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_results = list(executor.map(_postprocess_chunk, *zip(*chunks)))
+    else:
+        chunk_results = [_postprocess_chunk(*chunk) for chunk in chunks]
+    results = [row for chunk_result in chunk_results for row in chunk_result]
   
     if "neg" in rows[0]:
-        rng = np.random.default_rng(SEED)
-        results = [fix_negatives(row_idx, results, rng) for row_idx in range(len(results))]
+        results = assign_negatives(results, negatives)
             
     return results
 
 
-def sample_data_by_text_length(rows: list[dict], n: int = 2000) -> list[dict]:
+def sample_data_by_text_length(rows: Iterable[dict], n: int = 2000) -> list[dict]:
     """
     Sample the data from the rows.
 
     Attempts to balance the samples across the text length buckets: 512, 1024, 2048, greater than 2048.
+    Buckets with fewer rows than their share are taken whole, and the rest is spread evenly across the other buckets.
+    Rows that cannot be indexed, e.g. a generator over a file too large for memory, are sampled in a single pass,
+    drawing the same samples as with the rows in memory.
 
     Args:
         rows: The rows to sample from.
         n: The number of rows to sample.
 
     Returns:
-        The sampled rows.
+        The sampled rows, in their original order.
     """
+    num_bins = len(TEXT_LENGTH_BINS) + 1
+    if not is_in_memory(rows):
+        return reservoir_sample(rows, lambda chunk: text_length_bins(text_lengths(chunk)), num_bins, n)
+
     if n > len(rows):
         warning_msg = f"All rows were returned at `sample_data` function call. Total number of rows are {len(rows)}, requested to sample {n}"
         warnings.warn(warning_msg)
         return rows
 
     # Creating a bin based on text length, so we sample from them equally.
-    idx_bins = [set(), set(), set(), set()]
-    for idx, line in enumerate(rows):
-        text = line["pos"][0] if isinstance(line["pos"], list) else line["pos"]
-        token_size = len(text.split())
-        if token_size <= 512:
-            idx_bins[0].add(idx)
-        elif token_size <= 1024:
-            idx_bins[1].add(idx)
-        elif token_size <= 2048:
-            idx_bins[2].add(idx)
-        else:
-            idx_bins[3].add(idx)
-
-    sample_idxs = set()
-    attempt = 0
-    rng = np.random.default_rng(SEED)
-    while len(sample_idxs) < n:
-        # In the case where some bins are exhausted earlier than others
-        # the desired min is updated based on the remaining number of bins.
-        desired_min = math.ceil((n - len(sample_idxs)) / len(idx_bins))
-        idx = attempt % len(idx_bins)
-        if len(idx_bins[idx]) > desired_min:
-            # NB: Converting to a tuple and then to a set is inefficient, but works for now.
-            choices = set(rng.choice(tuple(idx_bins[idx]), desired_min, replace=False))
-            sample_idxs.update(choices)
-            idx_bins[idx] = idx_bins[idx] - choices
-        else:
-            sample_idxs.update(idx_bins[idx])
-            idx_bins.pop(idx)
-        attempt += 1
-    samples = [rows[i] for i in sample_idxs]
-    return samples[:n]
+    idxs = stratified_sample(text_length_bins(text_lengths(rows)), num_bins, n)
+    return take_rows(rows, idxs)
+
+
+def _language_strata(rows: Sequence[dict]) -> np.ndarray:
+    # Every language has its own text length bins, the stratum of a row is language index * bins + bin.
+    if isinstance(rows, ArrowRows):
+        languages = rows.column("root_query_language").to_pylist()
+    else:
+        languages = [row["root_query_language"] for row in rows]
+    language_idxs = np.array([SAMPLED_LANGUAGES.index(language) for language in languages], dtype=np.int64)
+    return language_idxs * (len(TEXT_LENGTH_BINS) + 1) + text_length_bins(text_lengths(rows))
+
 
+def _language_quotas(counts: np.ndarray, n: int) -> np.ndarray:
+    return nested_quotas(counts.reshape(len(SAMPLED_LANGUAGES), -1), n)
 
-def sample_data_by_language(rows: list[dict], n: int = 2000) -> list[dict]:
+
+def sample_data_by_language(rows: Iterable[dict], n: int = 2000) -> list[dict]:
     """
     Sample the data from the rows.
 
     Attempts to balance the samples across the languages. It then tries to balance the samples across text length buckets within each language.
+    Like `sample_data_by_text_length`, rows that cannot be indexed are sampled in a single pass.
 
     Args:
         rows: The rows to sample from.
         n: The number of rows to sample.
 
+    Returns:
+        The sampled rows, in their original order.
     """
-    lang_to_idx = {
-        Language.yoruba: 0,
-        Language.igbo: 1,
-        Language.hausa: 2
-    }
-    language_rows = [[], [], []]
-    language_row_counts = [0, 0, 0]
-
-    for row in rows:
-        language_rows[lang_to_idx[row["root_query_language"]]].append(row)
-        language_row_counts[lang_to_idx[row["root_query_language"]]] += 1
-
-    sorted_indices = sorted(range(len(language_rows)), key=lambda x: language_row_counts[x])
-    # Attempt to get a balanced sample per language
-    sampled_rows = []
-    for idx, lang_idx in enumerate(sorted_indices):
-        remaining_rows = n - len(sampled_rows)
-        desired_minimum_rows = math.ceil(remaining_rows / (len(sorted_indices) - idx))
-        if language_row_counts[lang_idx] <= desired_minimum_rows:
-            sampled_rows.extend(language_rows[lang_idx])
-        else:
-            sampled_rows.extend(sample_data_by_text_length(language_rows[lang_idx], n=desired_minimum_rows))
+    num_strata = len(SAMPLED_LANGUAGES) * (len(TEXT_LENGTH_BINS) + 1)
+    if not is_in_memory(rows):
+        return reservoir_sample(rows, _language_strata, num_strata, n, quota_fn=_language_quotas)
 
-    return sampled_rows[:n]
\ No newline at end of file
+    idxs = stratified_sample(_language_strata(rows), num_strata, n, quota_fn=_language_quotas)
+    return take_rows(rows, idxs)
\ No newline at end of file
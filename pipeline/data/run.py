@@ -1,14 +1,19 @@
 import argparse
 import logging
-import jsonlines
+import sys
+import time
+from itertools import chain
 
-from pipeline.data.utils import load_artefact
-from pipeline.data.enums import Language, DataSplit, DataOperation
+from pipeline.data.dedup import deduplicate
+from pipeline.data.jsonl import MANIFEST_SUFFIX, read_manifest, write_jsonl
+from pipeline.data.utils import artefact_name, find_artefact, load_artefact, write_artefact
+from pipeline.data.enums import ArtefactFormat, Compression, Language, DataSplit, DataOperation, NegativeSampling
 from pipeline.constants import ARTEFACTS_DIR
-from pipeline.data.train_data import make_hausa_df, make_igbo_df, make_yoruba_df, make_train_dataset
+from pipeline.data.stage_cache import StageCache, module_dependencies, stage_key
+from pipeline.data.train_data import SOURCE_ARTEFACTS, make_hausa_df, make_igbo_df, make_yoruba_df, make_train_dataset
 from pipeline.data.eval_test_data import make_eval_test_dataset
 from pipeline.data.postprocess import get_audits, postprocess_dataset, sample_data_by_text_length, sample_data_by_language
-from pipeline.data.translate import make_english_dataset
+from pipeline.data.translate import TRANSLATED_LANGUAGES, make_english_dataset
 
 
 logging.basicConfig(level=logging.INFO)
@@ -16,9 +21,62 @@ logger = logging.getLogger(__name__)
 
 EVAL_TEST_ROW_COUNT = 2000
 
+# The modules each operation is implemented in, with the modules they import, a change to them invalidates the results
+# built by the operation.
+CREATE_MODULES = module_dependencies(["pipeline.data.train_data", "pipeline.data.eval_test_data"])
+POSTPROCESS_MODULES = module_dependencies(["pipeline.data.postprocess"])
+TRANSLATE_MODULES = module_dependencies(["pipeline.data.translate", "pipeline.data.postprocess"])
+# The LLM whose audit and translation results the postprocess and translate operations read.
+LLM_MODEL_NAME = "gemma3_27b"
+
+
+def stage_output(language, split, operation, negatives=NegativeSampling.random, fmt=ArtefactFormat.jsonl, compression=None, num_shards=1):
+    """
+    Get the output file of an operation, and the key of everything it is built from.
+
+    Args:
+        language: The language of the dataset.
+        split: The split of the dataset.
+        operation: The create, postprocess or translate operation.
+        negatives: How the negatives of the train rows are picked.
+        fmt: The format of the output file.
+        compression: The compression of JSONL output files.
+        num_shards: The number of shards of JSONL output files, the path of their manifest is returned when more than 1.
+
+    Returns:
+        The path of the output file and the key of the operation, see `stage_key`.
+    """
+    params = {"language": language, "split": split, "negatives": negatives}
+    if operation == DataOperation.create:
+        filepath = f"{ARTEFACTS_DIR}/{artefact_name(f'{language}_{split}_dataset', fmt, compression, num_shards)}"
+        source_files = SOURCE_ARTEFACTS[language] if split == DataSplit.train else []
+        return filepath, stage_key("create", params, files=source_files, modules=CREATE_MODULES)
+    elif operation == DataOperation.postprocess:
+        filepath = f"{ARTEFACTS_DIR}/{artefact_name(f'filtered_{language}_{split}_dataset', fmt, compression, num_shards)}"
+        input_files = [find_artefact(f"{language}_{split}_dataset"), f"{language}_{LLM_MODEL_NAME}_{split}_results.jsonl"]
+        return filepath, stage_key("postprocess", params, files=input_files, modules=POSTPROCESS_MODULES)
+    elif operation == DataOperation.translate:
+        filepath = f"{ARTEFACTS_DIR}/{artefact_name(f'filtered_{language}_{split}_dataset', fmt, compression, num_shards)}"
+        input_files = [
+            filename
+            for source_language in TRANSLATED_LANGUAGES
+            for filename in (find_artefact(f"filtered_{source_language}_{split}_dataset"), f"{source_language}_english_{LLM_MODEL_NAME}_{split}_results.jsonl")
+        ]
+        params.pop("language")
+        return filepath, stage_key("translate", params, files=input_files, modules=TRANSLATE_MODULES)
+    raise ValueError(f"The {operation} operation has no tracked output.")
+
+
 def main(args):
+    """
+    Run a data operation.
+
+    Returns:
+        Whether an output was built, False when it was already up to date.
+    """
     language = args.language.lower()
     language = Language(language)
+    stage_cache = StageCache(enabled=not args.no_cache)
     if args.operation == "create":
         if language == Language.english:
             raise ValueError("English dataset is not supported for the create operation. Use 'translate' operation instead.")
@@ -29,73 +87,151 @@ def main(args):
             Language.hausa: make_hausa_df,
         }
 
+        filepath, key = stage_output(language, args.split, args.operation, args.negatives, args.format, args.compression, args.shards)
+        if stage_cache.is_fresh(filepath, key):
+            logger.info(f"{filepath} is up to date, use --no-cache to recreate it.")
+            return False
+
         # Not doing the try and catch here because the data used here are primitive datasets that should always exist.
         if args.split == DataSplit.train:
-            make_train_dataset(processors.get(language)(), filename=f"{ARTEFACTS_DIR}/{language}_train_dataset.jsonl")
-            logger.info(f"Train dataset created for {language} and saved to {ARTEFACTS_DIR}/{language}_train_dataset.jsonl")
+            aligned_key = stage_key("align_with_wura", {"language": language}, files=SOURCE_ARTEFACTS[language], modules=CREATE_MODULES)
+            df = stage_cache.frame(f"{language}_aligned", aligned_key, processors.get(language))
+            make_train_dataset(df, filename=filepath, negatives=args.negatives, num_shards=args.shards, compression=args.compression)
+            logger.info(f"Train dataset created for {language} and saved to {filepath}")
         elif args.split == DataSplit.eval:
-            make_eval_test_dataset(language, eval_filename=f"{ARTEFACTS_DIR}/{language}_eval_dataset.jsonl", test_filename=None)
-            logger.info(f"Eval dataset created for {language} and saved to {ARTEFACTS_DIR}/{language}_eval_dataset.jsonl")
+            make_eval_test_dataset(language, eval_filename=filepath, test_filename=None, stage_cache=stage_cache,
+                                   num_shards=args.shards, compression=args.compression)
+            logger.info(f"Eval dataset created for {language} and saved to {filepath}")
         elif args.split == DataSplit.test:
-            make_eval_test_dataset(language, eval_filename=None, test_filename=f"{ARTEFACTS_DIR}/{language}_test_dataset.jsonl")
-            logger.info(f"Test dataset created for {language} and saved to {ARTEFACTS_DIR}/{language}_test_dataset.jsonl")
+            make_eval_test_dataset(language, eval_filename=None, test_filename=filepath, stage_cache=stage_cache,
+                                   num_shards=args.shards, compression=args.compression)
+            logger.info(f"Test dataset created for {language} and saved to {filepath}")
         else:
             raise ValueError(f"Invalid split. Choose from {DataSplit}.")
+        stage_cache.mark_fresh(filepath, key)
+    elif args.operation == "dedup":
+        if language == Language.english:
+            raise ValueError("English dataset is not supported for the dedup operation, it is derived from the deduplicated datasets.")
+
+        filename = find_artefact(f"{language}_{args.split}_dataset")
+        try:
+            rows = load_artefact(filename)
+        except ValueError as e:
+            msg = f"Could not load dataset for {language} and split {args.split}. "
+            msg += "Ensure the dataset exists before deduplicating, perhaps you need to run the create operation first."
+            raise RuntimeError(msg) from e
+
+        # Train rows must not duplicate eval or test rows, and test rows must not duplicate eval rows.
+        reference_splits = {DataSplit.train: [DataSplit.eval, DataSplit.test], DataSplit.test: [DataSplit.eval]}.get(args.split, [])
+        reference_rows = []
+        for split in reference_splits:
+            try:
+                reference_rows.append(load_artefact(find_artefact(f"{language}_{split}_dataset")))
+            except ValueError:
+                logger.warning(f"The {split} dataset for {language} does not exist, {args.split} rows are not checked against it.")
+
+        kept_rows, report = deduplicate(rows, chain.from_iterable(reference_rows), drop=args.drop_duplicates)
+        report_path = f"{ARTEFACTS_DIR}/{language}_{args.split}_duplicates.jsonl"
+        write_jsonl(report_path, report)
+        leaked = sum(entry["leaked"] for entry in report)
+        logger.info(f"Found {len(report)} near-duplicate rows out of {len(rows)} in {filename}, {leaked} of them matching "
+                    f"{'/'.join(reference_splits) or 'no'} rows. The report is saved to {report_path}.")
+        if args.drop_duplicates:
+            # The rows are read from the file being rewritten, which keeps its format.
+            if hasattr(rows, "close"):
+                rows.close()
+            layout = read_manifest(f"{ARTEFACTS_DIR}/{filename}") if filename.endswith(MANIFEST_SUFFIX) else {"shards": [None], "compression": None}
+            write_artefact(f"{ARTEFACTS_DIR}/{filename}", kept_rows, num_shards=len(layout["shards"]), compression=layout["compression"])
+            logger.info(f"Dropped the near-duplicate rows, {len(kept_rows)} rows are left in {ARTEFACTS_DIR}/{filename}.")
     elif args.operation == "postprocess":
         if language == Language.english:
             raise ValueError("English dataset is not supported for the postprocess operation. Use 'translate' operation instead.")
         
+        model_name = LLM_MODEL_NAME
+        filepath, key = stage_output(language, args.split, args.operation, args.negatives, args.format, args.compression, args.shards)
+        if stage_cache.is_fresh(filepath, key):
+            logger.info(f"{filepath} is up to date, use --no-cache to recreate it.")
+            return False
+
         try:
-            rows = load_artefact(f"{args.language}_{args.split}_dataset.jsonl")
+            rows = load_artefact(find_artefact(f"{args.language}_{args.split}_dataset"))
         except ValueError as e:
             msg = f"Could not load dataset for {args.language} and split {args.split}. "
             msg += "Ensure the dataset exists before postprocessing, perhaps you need to run the create operation first."
             raise RuntimeError(msg) from e
         
         try:
-            model_name = "gemma3_27b"
             audits = get_audits(f"{args.language}_{model_name}_{args.split}_results.jsonl", n=None)
         except ValueError as e:
             msg = f"Could not load audit results for {args.language}, model {model_name} and split {args.split}. "
             msg += "Ensure the audit results exist before postprocessing, perhaps you need to run the pipeline.llms.ollama_audit pipeline first."
             raise RuntimeError(msg) from e
         
-        filtered_lines = postprocess_dataset(rows, audits, args.language)
-        filepath = f"{ARTEFACTS_DIR}/filtered_{args.language}_{args.split}_dataset.jsonl"
-        with jsonlines.open(filepath, "w") as f_:
-            if DataSplit.test in filepath or DataSplit.eval in filepath:
-                f_.write_all(sample_data_by_text_length(filtered_lines, n=EVAL_TEST_ROW_COUNT))
-            else:
-                f_.write_all(filtered_lines)
+        filtered_lines = postprocess_dataset(rows, audits, args.language, negatives=args.negatives, workers=args.workers)
+        if DataSplit.test in filepath or DataSplit.eval in filepath:
+            write_artefact(filepath, sample_data_by_text_length(filtered_lines, n=EVAL_TEST_ROW_COUNT), num_shards=args.shards, compression=args.compression)
+        else:
+            write_artefact(filepath, filtered_lines, num_shards=args.shards, compression=args.compression)
+        stage_cache.mark_fresh(filepath, key)
         logger.info(f"Filtered dataset created for {args.language} and saved to {filepath}.")
     elif args.operation == "translate":
         if language != Language.english:
             raise ValueError("Translate operation is only supported for English dataset.")
         
+        filepath, key = stage_output(language, args.split, args.operation, args.negatives, args.format, args.compression, args.shards)
+        if stage_cache.is_fresh(filepath, key):
+            logger.info(f"{filepath} is up to date, use --no-cache to recreate it.")
+            return False
+
         try:
-            rows = make_english_dataset(args.split)
+            rows = make_english_dataset(args.split, negatives=args.negatives)
         except ValueError as e:
             msg = f"Could not create English dataset for split {args.split}. "
             msg += "Ensure the translated datasets exist before creating the English dataset, perhaps you need to run the pipeline.llms.ollama_translation pipeline first."
             raise RuntimeError(msg) from e
         
-        filepath = f"{ARTEFACTS_DIR}/filtered_{args.language}_{args.split}_dataset.jsonl"
-        with jsonlines.open(filepath, "w") as f_:
-            if DataSplit.test in filepath or DataSplit.eval in filepath:
-                # Using language aware sampling because the English dataset is a combination of all languages.
-                f_.write_all(sample_data_by_language(rows, n=EVAL_TEST_ROW_COUNT))
-            else:
-                f_.write_all(rows)
+        if DataSplit.test in filepath or DataSplit.eval in filepath:
+            # Using language aware sampling because the English dataset is a combination of all languages.
+            write_artefact(filepath, sample_data_by_language(rows, n=EVAL_TEST_ROW_COUNT), num_shards=args.shards, compression=args.compression)
+        else:
+            write_artefact(filepath, rows, num_shards=args.shards, compression=args.compression)
+        stage_cache.mark_fresh(filepath, key)
         logger.info(f"Filtered dataset translated for {args.language} and saved to {filepath}.")
     else:
-        raise ValueError("Invalid operation. Choose from 'creation' or 'postprocess'.")
+        raise ValueError(f"Invalid operation. Choose from {DataOperation}.")
+    return True
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--language", choices=Language, type=str.lower, required=True, help="Language to use for the dataset.")
-    parser.add_argument("--split", choices=DataSplit, type=str.lower, default=DataSplit.train, help="Dataset split to postprocess.")
-    parser.add_argument("--operation", choices=DataOperation, type=str.lower, default=DataOperation.create, help="Data operation to perform.")
+    parser.add_argument("--language", choices=list(Language), type=str.lower, help="Language to use for the dataset.")
+    parser.add_argument("--split", choices=list(DataSplit), type=str.lower, default=DataSplit.train, help="Dataset split to postprocess.")
+    parser.add_argument("--operation", choices=list(DataOperation), type=str.lower, default=DataOperation.create, help="Data operation to perform.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used by the postprocess operation.")
+    parser.add_argument("--no-cache", action="store_true", help="Recompute every stage, instead of reusing the cached results of unchanged stages.")
+    parser.add_argument("--drop-duplicates", action="store_true", help="Drop the near-duplicate rows found by the dedup operation, instead of only reporting them.")
+    parser.add_argument("--negatives", choices=list(NegativeSampling), type=str.lower, default=NegativeSampling.random, help="How negatives are picked: BM25 mined (hard) or uniformly at random.")
+    parser.add_argument("--format", choices=list(ArtefactFormat), type=str.lower, default=ArtefactFormat.jsonl, help="Format of the datasets written by the operations.")
+    parser.add_argument("--compression", choices=list(Compression), type=str.lower, default=None, help="Compression of the JSONL datasets written by the operations.")
+    parser.add_argument("--shards", type=int, default=1, help="Number of files the JSONL datasets written by the operations are split into, next to a manifest listing them.")
+    parser.add_argument("--all", action="store_true", help="Build every dataset, running the create, audit, postprocess and translate stages as a dependency graph.")
+    parser.add_argument("--targets", nargs="+", help="Build these nodes of the graph and their dependencies, e.g. postprocess:hausa or translate:english:test.")
+    parser.add_argument("--jobs", type=int, default=4, help="Number of graph nodes run at the same time by --all and --targets.")
     args = parser.parse_args()
 
-    main(args)
+    if args.all or args.targets:
+        # Imported here as the graph runs the operations of this module through it.
+        from pipeline.data.dag import build_graph, format_summary, run_graph, select_nodes, FAILED, SKIPPED
+
+        graph = build_graph(negatives=args.negatives, workers=args.workers, no_cache=args.no_cache, fmt=args.format,
+                            compression=args.compression, num_shards=args.shards)
+        names = select_nodes(graph, None if args.all else args.targets)
+        start = time.perf_counter()
+        results = run_graph(graph, names, jobs=args.jobs)
+        print(format_summary(results, time.perf_counter() - start))
+        if any(status in (FAILED, SKIPPED) for status, _ in results.values()):
+            sys.exit(1)
+    elif args.language is None:
+        parser.error("--language is required, unless --all or --targets is given.")
+    else:
+        main(args)
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable, Sequence, Sized
+from itertools import islice
+
+import numpy as np
+
+from pipeline.constants import SEED
+from pipeline.data.columnar import ArrowRows, text_word_counts
+
+
+# Upper bounds (inclusive) of the text length bins, in words: 512, 1024, 2048 and greater than 2048.
+TEXT_LENGTH_BINS = np.array([512, 1024, 2048])
+# Rows read at a time by the streaming samplers.
+STREAM_CHUNK_SIZE = 1 << 14
+
+
+def text_lengths(rows: Sequence[dict]) -> np.ndarray:
+    """
+    Count the words of the positive document of every row.
+
+    Args:
+        rows: The rows, the word counts of `ArrowRows` views are computed on their `pos` column without converting it.
+
+    Returns:
+        The word counts.
+    """
+    if isinstance(rows, ArrowRows):
+        return text_word_counts(rows.column("pos"))
+    return np.fromiter(
+        (len((row["pos"][0] if isinstance(row["pos"], list) else row["pos"]).split()) for row in rows),
+        dtype=np.int64, count=len(rows),
+    )
+
+
+def text_length_bins(lengths: np.ndarray) -> np.ndarray:
+    """Get the text length bin of every word count, see `TEXT_LENGTH_BINS`."""
+    return np.digitize(lengths, TEXT_LENGTH_BINS, right=True)
+
+
+def allocate_quotas(counts: np.ndarray, n: int, weights: np.ndarray | None = None) -> np.ndarray:
+    """
+    Split `n` draws across strata in proportion to their weights, without exceeding their sizes.
+
+    Strata too small for their share are taken whole, and what they leave is reallocated to the other strata in
+    proportion to their weights, until the shares fit. Shares are rounded with the largest remainder method,
+    ties going to the earlier strata, so the quotas are deterministic.
+
+    Args:
+        counts: The number of rows of every stratum.
+        n: The number of draws.
+        weights: The weights of the strata, equal when None.
+
+    Returns:
+        The number of rows drawn from every stratum.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    weights = np.ones(len(counts)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if n >= counts.sum():
+        return counts.copy()
+
+    quotas = np.zeros_like(counts)
+    active = (counts > 0) & (weights > 0)
+    remaining = n
+    while remaining > 0 and active.any():
+        shares = np.where(active, remaining * weights / weights[active].sum(), 0.0)
+        capped = active & (counts <= shares)
+        if capped.any():
+            quotas[capped] = counts[capped]
+            remaining -= counts[capped].sum()
+            active &= ~capped
+            continue
+
+        floors = np.floor(shares).astype(np.int64)
+        remainders = np.where(active, shares - floors, -1.0)
+        order = np.lexsort((np.arange(len(counts)), -remainders))
+        floors[order[:remaining - floors.sum()]] += 1
+        quotas += floors
+        break
+    return quotas
+
+
+def nested_quotas(counts: np.ndarray, n: int) -> np.ndarray:
+    """
+    Allocate draws across the rows of a strata matrix first, then across the columns within every row.
+
+    Args:
+        counts: The number of rows of every stratum, e.g. of every language (rows) and text length bin (columns).
+        n: The number of draws.
+
+    Returns:
+        The number of rows drawn from every stratum, shaped like `counts`.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    outer = allocate_quotas(counts.sum(axis=1), n)
+    return np.stack([allocate_quotas(row_counts, quota) for row_counts, quota in zip(counts, outer)])
+
+
+def stratified_sample_idxs(strata: np.ndarray, quotas: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """
+    Draw the rows of every stratum with the smallest random keys, as many as the quota of the stratum.
+
+    Args:
+        strata: The stratum of every row.
+        quotas: The number of rows drawn from every stratum.
+        keys: A uniform random key for every row.
+
+    Returns:
+        The indices of the drawn rows, in increasing order.
+    """
+    order = np.lexsort((keys, strata))
+    sorted_strata = strata[order]
+    starts = np.searchsorted(sorted_strata, np.arange(len(quotas)))
+    ranks = np.arange(len(order)) - starts[sorted_strata]
+    return np.sort(order[ranks < quotas[sorted_strata]])
+
+
+def stratified_sample(strata: np.ndarray, num_strata: int, n: int, quota_fn: Callable[[np.ndarray, int], np.ndarray] = allocate_quotas,
+                      seed: int = SEED) -> np.ndarray:
+    """
+    Draw a stratified sample of rows in one shot.
+
+    Args:
+        strata: The stratum of every row, from 0 to `num_strata` - 1.
+        num_strata: The number of strata.
+        n: The number of rows to draw.
+        quota_fn: The function splitting the draws across strata from their sizes, e.g. `allocate_quotas`.
+        seed: The seed of the random keys.
+
+    Returns:
+        The indices of the drawn rows, in increasing order.
+    """
+    keys = np.random.default_rng(seed).random(len(strata))
+    counts = np.bincount(strata, minlength=num_strata)
+    quotas = np.asarray(quota_fn(counts, n)).reshape(-1)
+    return stratified_sample_idxs(strata, quotas, keys)
+
+
+def reservoir_sample(rows: Iterable, strata_fn: Callable[[list], np.ndarray], num_strata: int, n: int,
+                     quota_fn: Callable[[np.ndarray, int], np.ndarray] = allocate_quotas, seed: int = SEED,
+                     chunk_size: int = STREAM_CHUNK_SIZE) -> list:
+    """
+    Draw a stratified sample from a stream of rows, holding at most about `2 * n` rows per stratum.
+
+    Every stratum keeps the rows with the smallest random keys seen so far. The keys are drawn in the same order as by
+    `stratified_sample`, so the sample is the same as the one drawn with all the rows in memory.
+
+    Args:
+        rows: The rows, any iterable.
+        strata_fn: The function getting the strata of a chunk of rows.
+        num_strata: The number of strata.
+        n: The number of rows to draw.
+        quota_fn: The function splitting the draws across strata from their sizes, e.g. `allocate_quotas`.
+        seed: The seed of the random keys.
+        chunk_size: The number of rows processed at a time.
+
+    Returns:
+        The drawn rows, in their order in the stream.
+    """
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(num_strata, dtype=np.int64)
+    # The candidate keys, stream positions and rows of every stratum.
+    reservoirs = [(np.empty(0), np.empty(0, dtype=np.int64), []) for _ in range(num_strata)]
+    rows = iter(rows)
+    position = 0
+    for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+        keys = rng.random(len(chunk))
+        strata = np.asarray(strata_fn(chunk))
+        counts += np.bincount(strata, minlength=num_strata)
+        positions = np.arange(position, position + len(chunk))
+        position += len(chunk)
+        for stratum in np.unique(strata):
+            members = np.flatnonzero(strata == stratum)
+            old_keys, old_positions, old_rows = reservoirs[stratum]
+            new_keys = np.concatenate([old_keys, keys[members]])
+            new_positions = np.concatenate([old_positions, positions[members]])
+            new_rows = old_rows + [chunk[i] for i in members]
+            if len(new_keys) > 2 * n:
+                # Pruning to the n smallest keys once the reservoir doubles, as no stratum is drawn more than n times.
+                kept = np.sort(np.argpartition(new_keys, n)[:n])
+                new_keys, new_positions, new_rows = new_keys[kept], new_positions[kept], [new_rows[i] for i in kept]
+            reservoirs[stratum] = (new_keys, new_positions, new_rows)
+
+    quotas = np.asarray(quota_fn(counts, n)).reshape(-1)
+    drawn = []
+    for (keys, positions, stratum_rows), quota in zip(reservoirs, quotas):
+        for i in np.argsort(keys, kind="stable")[:quota]:
+            drawn.append((positions[i], stratum_rows[i]))
+    return [row for _, row in sorted(drawn, key=lambda item: item[0])]
+
+
+def take_rows(rows: Sequence, idxs: np.ndarray) -> list:
+    """Get the rows at the given indices, taking them from the table of `ArrowRows` views in one go."""
+    if isinstance(rows, ArrowRows):
+        return list(ArrowRows(rows.table.take(idxs)))
+    return [rows[i] for i in idxs.tolist()]
+
+
+def is_in_memory(rows) -> bool:
+    """Check whether the rows can be indexed, rather than only streamed."""
+    return isinstance(rows, Sized) and hasattr(rows, "__getitem__")
@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import ast
+import hashlib
+import importlib
+import json
+import logging
+import os
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+from pipeline.constants import ARTEFACTS_DIR
+from pipeline.data.constants import DRIVE_IDS
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGE_CACHE_DIR = ARTEFACTS_DIR / "stage_cache"
+# Number of bytes read at a time when hashing files.
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_fingerprint(key: str | Path) -> str:
+    """
+    Fingerprint an input file from its content.
+
+    Artefacts that are not downloaded yet are fingerprinted by their drive id, as the content of a drive file does not change.
+
+    Args:
+        key: The path of the file, or the name of an artefact.
+
+    Returns:
+        The fingerprint.
+    """
+    path = Path(key) if Path(key).is_absolute() else ARTEFACTS_DIR / key
+    if not path.exists():
+        return f"drive:{DRIVE_IDS[str(key)]}" if str(key) in DRIVE_IDS else "missing"
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f_:
+        while block := f_.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _module_path(module: str) -> Path | None:
+    # The source file of a module of the repository, found without importing it. None for anything else, e.g. a function.
+    path = Path(__file__).parents[2].joinpath(*module.split("."))
+    for candidate in (path.with_suffix(".py"), path / "__init__.py"):
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+def module_dependencies(modules: Iterable[str], package: str = "pipeline") -> list[str]:
+    """
+    Get the modules, and every module of the package they import directly or not.
+
+    The imports are read from the source code, including the ones inside functions, so the modules are not run.
+
+    Args:
+        modules: The names of the modules.
+        package: The package whose modules are followed.
+
+    Returns:
+        The names of the modules, sorted.
+
+    Example:
+        >>> module_dependencies(["pipeline.data.postprocess"])
+        ['pipeline', 'pipeline.constants', 'pipeline.data', 'pipeline.data.columnar', ..., 'pipeline.text_utils']
+    """
+    seen = set()
+    pending = list(modules)
+    while pending:
+        module = pending.pop()
+        if module in seen:
+            continue
+        seen.add(module)
+        for node in ast.walk(ast.parse(_module_path(module).read_bytes())):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module, *(f"{node.module}.{alias.name}" for alias in node.names)]
+            else:
+                continue
+            # Parent packages run on import, so they are dependencies too.
+            names = [".".join(name.split(".")[:end]) for name in names for end in range(1, name.count(".") + 2)]
+            pending.extend(name for name in names if name.split(".")[0] == package and _module_path(name) is not None)
+    return sorted(seen)
+
+
+def code_version(modules: Iterable[str]) -> str:
+    """
+    Fingerprint the source code of the modules.
+
+    Args:
+        modules: The names of the modules.
+
+    Returns:
+        The fingerprint.
+    """
+    digest = hashlib.sha256()
+    for module in sorted(modules):
+        digest.update(module.encode())
+        digest.update(Path(importlib.import_module(module).__file__).read_bytes())
+    return digest.hexdigest()
+
+
+def stage_key(stage: str, params: dict | None = None, files: Iterable[str | Path] = (), modules: Iterable[str] = ()) -> str:
+    """
+    Fingerprint a stage from everything its result depends on.
+
+    Args:
+        stage: The name of the stage.
+        params: The parameters of the stage, they must be JSON serializable.
+        files: The input files of the stage.
+        modules: The modules implementing the stage.
+
+    Returns:
+        The key of the stage.
+    """
+    fingerprint = {
+        "stage": stage,
+        "params": params or {},
+        "files": {str(file): file_fingerprint(file) for file in files},
+        "code": code_version(modules),
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageCache:
+    """
+    Memoizes the results of the pipeline stages.
+
+    Intermediate DataFrames are stored as Parquet files named after the key of the stage, and the keys the final
+    output files were built from are recorded, so an unchanged stage is a lookup.
+
+    Args:
+        cache_dir: The directory of the cached results.
+        enabled: Whether results are cached, stages are always recomputed otherwise.
+
+    Example:
+        >>> stage_cache = StageCache()
+        >>> key = stage_key("create", {"language": "hausa"}, files=["hausa_mato_81k.tsv"], modules=["pipeline.data.train_data"])
+        >>> df = stage_cache.frame("create", key, make_hausa_df)
+    """
+
+    def __init__(self, cache_dir: str | Path = STAGE_CACHE_DIR, enabled: bool = True):
+        self.cache_dir = Path(cache_dir)
+        self.enabled = enabled
+
+    def frame(self, stage: str, key: str, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Get the DataFrame of a stage, computing and caching it when it is not cached.
+
+        Args:
+            stage: The name of the stage.
+            key: The key of the stage, see `stage_key`.
+            compute: The function computing the DataFrame.
+
+        Returns:
+            The DataFrame.
+        """
+        if not self.enabled:
+            return compute()
+
+        path = self.cache_dir / f"{stage}-{key[:16]}.parquet"
+        if path.exists():
+            logger.info(f"Loading the cached result of the {stage} stage from {path}.")
+            return pd.read_parquet(path)
+
+        df = compute()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            df.to_parquet(tmp_path)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            logger.warning(f"Could not cache the result of the {stage} stage: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return df
+        os.replace(tmp_path, path)
+        return df
+
+    def _output_key_path(self, output: str | Path) -> Path:
+        # One file per output, so that stages running in parallel processes do not overwrite each other's records.
+        name = hashlib.sha256(str(Path(output).resolve()).encode()).hexdigest()[:32]
+        return self.cache_dir / "outputs" / f"{name}.key"
+
+    def is_fresh(self, output: str | Path, key: str) -> bool:
+        """Check whether the output file exists and was built by a stage with the given key."""
+        if not self.enabled or not Path(output).exists():
+            return False
+        key_path = self._output_key_path(output)
+        return key_path.exists() and key_path.read_text() == key
+
+    def mark_fresh(self, output: str | Path, key: str) -> None:
+        """Record that the output file was built by a stage with the given key."""
+        if not self.enabled:
+            return
+        key_path = self._output_key_path(output)
+        key_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = key_path.with_name(f"{key_path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(key)
+        os.replace(tmp_path, key_path)
@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import unicodedata
+from collections.abc import Iterator, Sequence
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from datasets import Dataset, DatasetDict
+
+from pipeline.constants import ARTEFACTS_DIR, SEED
+from pipeline.data.enums import DataSource, Language
+from pipeline.data.utils import write_artefact
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The languages of the synthetic rows, weighted like the collected datasets: mostly Hausa, then Yoruba, few Igbo.
+SYNTHETIC_LANGUAGES = [Language.yoruba, Language.igbo, Language.hausa]
+LANGUAGE_WEIGHTS = [0.3, 0.1, 0.6]
+# Consonants and vowels the words of every language are built from, tone marks are added to the Yoruba and Igbo vowels.
+ALPHABETS = {
+    Language.yoruba: (["b", "d", "f", "g", "gb", "h", "j", "k", "l", "m", "n", "p", "r", "s", "ṣ", "t", "w", "y", ""],
+                      ["a", "e", "ẹ", "i", "o", "ọ", "u"]),
+    Language.igbo: (["b", "ch", "d", "f", "g", "gb", "gh", "gw", "h", "j", "k", "kp", "kw", "l", "m", "n", "nw", "ny", "r", "s", "sh", "t", "v", "w", "y", "z", ""],
+                    ["a", "e", "i", "ị", "o", "ọ", "u", "ụ"]),
+    Language.hausa: (["b", "ɓ", "c", "d", "ɗ", "f", "g", "h", "j", "k", "ƙ", "l", "m", "n", "r", "s", "sh", "t", "ts", "w", "y", "ƴ", "z"],
+                     ["a", "e", "i", "o", "u", "aa", "ai", "au"]),
+}
+TONE_MARKS = {Language.yoruba: ["", "́", "̀"], Language.igbo: ["", "", "", "́", "̀"], Language.hausa: [""]}
+# News sites of every language, the first ones publishing the most.
+NEWS_DOMAINS = {
+    Language.yoruba: ["www.bbc.com/yoruba", "alaroye.org", "von.gov.ng/yoruba", "yoruba.legit.ng"],
+    Language.igbo: ["www.bbc.com/igbo", "von.gov.ng/igbo", "igbo.legit.ng"],
+    Language.hausa: ["www.bbc.com/hausa", "www.voahausa.com", "hausa.legit.ng", "www.premiumtimesng.com/hausa", "aminiya.ng",
+                     "katsinapost.com.ng", "fimmagazine.com", "von.gov.ng/hausa"],
+}
+WIKI_DOMAINS = {Language.yoruba: "yo.wikipedia.org", Language.igbo: "ig.wikipedia.org", Language.hausa: "ha.wikipedia.org"}
+# Fraction of the rows scraped from Wikipedia, their documents start with the query as a header and repeat it in a sentence.
+WIKI_FRACTION = 0.2
+# Fraction of the rows from sites too rare for `prepare_wura` to keep, and from jw.org which it drops.
+RARE_DOMAIN_FRACTION = 0.02
+JW_FRACTION = 0.01
+SOURCES = [DataSource.mato, DataSource.wura, DataSource.masakhanews]
+SOURCE_WEIGHTS = [0.5, 0.4, 0.1]
+CATEGORIES = ["politics", "sport", "entertainment", "business", "health", "religion", None]
+AUDIT_CATEGORIES = ["X", "NLC", "SKIP", "EMPTYTEXT"]
+AUDIT_WEIGHTS = [0.85, 0.08, 0.05, 0.02]
+# The number of sentences of a document is log-normal, the median document has about 250 words and about 1% have more than 2048.
+DOC_MEDIAN_SENTENCES = 18
+DOC_SIGMA = 0.9
+MAX_DOC_SENTENCES = 800
+SENTENCE_WORDS = (4, 25)
+QUERY_WORDS = (3, 13)
+LEXICON_SIZE = 8192
+SENTENCE_POOL_SIZE = 1 << 14
+# Rows generated at a time, the rows only depend on the seed and their position, not on the number of rows asked for.
+GENERATE_CHUNK_SIZE = 1 << 14
+
+
+def _capitalize(text: str) -> str:
+    return text[:1].upper() + text[1:]
+
+
+def _slug(text: str) -> str:
+    ascii_text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return "-".join(ascii_text.lower().split())
+
+
+def _word_frequencies() -> np.ndarray:
+    # The Zipf frequencies of the words of a lexicon, by rank.
+    frequencies = 1 / (np.arange(LEXICON_SIZE) + 2.7)
+    return frequencies / frequencies.sum()
+
+
+@lru_cache(maxsize=None)
+def _language_pools(language: Language, seed: int) -> tuple[list[str], list[str]]:
+    # The lexicon of the language, and a pool of sentences documents are made of.
+    rng = np.random.default_rng([seed, SYNTHETIC_LANGUAGES.index(language)])
+    consonants, vowels = ALPHABETS[language]
+    tones = TONE_MARKS[language]
+    words = set()
+    while len(words) < LEXICON_SIZE:
+        syllables = [
+            consonants[rng.integers(len(consonants))] + vowels[rng.integers(len(vowels))] + tones[rng.integers(len(tones))]
+            for _ in range(int(rng.integers(1, 5)))
+        ]
+        words.add(unicodedata.normalize("NFC", "".join(syllables)))
+    lexicon = sorted(words)
+    rng.shuffle(lexicon)
+
+    sentence_lengths = rng.integers(*SENTENCE_WORDS, size=SENTENCE_POOL_SIZE)
+    word_idxs = np.split(rng.choice(LEXICON_SIZE, size=int(sentence_lengths.sum()), p=_word_frequencies()), np.cumsum(sentence_lengths)[:-1])
+    sentences = [_capitalize(" ".join(lexicon[idx] for idx in idxs)) + "." for idxs in word_idxs]
+    return lexicon, sentences
+
+
+def _generate_chunk(chunk_idx: int, size: int, languages: Sequence[Language], language_weights: np.ndarray,
+                    wiki_fraction: float, seed: int) -> list[dict]:
+    # Everything is drawn at once for a whole chunk, even the last, partial one, so the queries, documents and urls of
+    # the first rows do not depend on the number of rows.
+    rng = np.random.default_rng([seed, chunk_idx])
+    start = chunk_idx * GENERATE_CHUNK_SIZE
+    row_languages = rng.choice(len(languages), size=GENERATE_CHUNK_SIZE, p=language_weights)
+    is_wiki = rng.random(GENERATE_CHUNK_SIZE) < wiki_fraction
+    sources = rng.choice(len(SOURCES), size=GENERATE_CHUNK_SIZE, p=SOURCE_WEIGHTS)
+    categories = rng.choice(len(CATEGORIES), size=GENERATE_CHUNK_SIZE)
+    num_sentences = rng.lognormal(np.log(DOC_MEDIAN_SENTENCES), DOC_SIGMA, size=GENERATE_CHUNK_SIZE)
+    num_sentences = np.clip(np.rint(num_sentences), 1, MAX_DOC_SENTENCES).astype(np.int64)
+    sentence_idxs = np.split(rng.integers(SENTENCE_POOL_SIZE, size=int(num_sentences.sum())), np.cumsum(num_sentences)[:-1])
+    # Wikipedia titles have 1 to 3 words, and are the subject of an extra first sentence.
+    query_lengths = np.where(is_wiki, rng.integers(1, 4, size=GENERATE_CHUNK_SIZE), rng.integers(*QUERY_WORDS, size=GENERATE_CHUNK_SIZE))
+    query_word_idxs = rng.choice(LEXICON_SIZE, size=(GENERATE_CHUNK_SIZE, QUERY_WORDS[1]), p=_word_frequencies())
+    first_sentence_idxs = rng.integers(SENTENCE_POOL_SIZE, size=GENERATE_CHUNK_SIZE)
+    domain_kinds = rng.random(GENERATE_CHUNK_SIZE)
+    news_domain_ranks = rng.zipf(1.5, size=GENERATE_CHUNK_SIZE) - 1
+    rare_domain_ids = rng.integers(1 << 20, size=GENERATE_CHUNK_SIZE)
+    is_http = rng.random(GENERATE_CHUNK_SIZE) < 0.2
+    has_trailing_slash = rng.random(GENERATE_CHUNK_SIZE) < 0.5
+    neg_offsets = rng.integers(1, GENERATE_CHUNK_SIZE, size=GENERATE_CHUNK_SIZE)
+
+    rows = []
+    for offset in range(size):
+        idx = start + offset
+        language = languages[row_languages[offset]]
+        lexicon, sentences = _language_pools(language, seed)
+        text = " ".join([sentences[sentence_idx] for sentence_idx in sentence_idxs[offset].tolist()])
+        query_words = [lexicon[word_idx] for word_idx in query_word_idxs[offset, :query_lengths[offset]].tolist()]
+        if is_wiki[offset]:
+            query = " ".join(_capitalize(word) for word in query_words)
+            # Like the Wikipedia articles, the title is a header and the subject of the first sentence.
+            text = f"{query}\n\n{query} {sentences[first_sentence_idxs[offset]].lower()} {text}"
+            url = f"https://{WIKI_DOMAINS[language]}/wiki/{query.replace(' ', '_')}"
+        else:
+            query = _capitalize(" ".join(query_words))
+            if domain_kinds[offset] < JW_FRACTION:
+                domain = "www.jw.org/" + language.value[:2]
+            elif domain_kinds[offset] < JW_FRACTION + RARE_DOMAIN_FRACTION:
+                domain = f"blog{rare_domain_ids[offset]}.com.ng"
+            else:
+                domains = NEWS_DOMAINS[language]
+                domain = domains[min(news_domain_ranks[offset], len(domains) - 1)]
+            # Scheme and trailing slash variants, as they appear in the collected datasets.
+            url = f"{'http' if is_http[offset] else 'https'}://{domain}/{_slug(query)}-{idx}{'/' if has_trailing_slash[offset] else ''}"
+        rows.append({
+            "query": query,
+            "pos": [text],
+            "url": url,
+            "source": SOURCES[sources[offset]].value,
+            "category": CATEGORIES[categories[offset]],
+            "root_query_language": language.value,
+        })
+    # The negatives are the documents of other rows of the chunk, shared rather than copied.
+    for offset, row in enumerate(rows):
+        row["neg"] = [rows[(offset + neg_offsets[offset]) % size]["pos"][0]]
+    return rows
+
+
+def iter_synthetic_rows(num_rows: int, languages: Sequence[str | Language] = SYNTHETIC_LANGUAGES, wiki_fraction: float = WIKI_FRACTION,
+                        seed: int = SEED) -> Iterator[dict]:
+    """
+    Generate training rows in Yoruba, Igbo and Hausa-like languages, a chunk at a time.
+
+    The words are made of the letters and tone marks of each language, with Zipf frequencies. The documents have a log-normal
+    number of sentences, spreading them over all of the text length bins of `pipeline.data.sampling`. Wikipedia rows start with
+    their title as a header, the news rows have scheme and trailing slash url variants, some of them from rare domains and jw.org.
+
+    Args:
+        num_rows: The number of rows.
+        languages: The languages of the rows, weighted like the collected datasets.
+        wiki_fraction: The fraction of Wikipedia rows.
+        seed: The seed, the same seed always gives the same rows.
+
+    Returns:
+        An iterator over the rows, with the "query", "pos", "neg", "url", "source", "category" and "root_query_language" keys.
+    """
+    languages = [Language(language) for language in languages]
+    language_weights = np.array([LANGUAGE_WEIGHTS[SYNTHETIC_LANGUAGES.index(language)] for language in languages])
+    for chunk_idx, start in enumerate(range(0, num_rows, GENERATE_CHUNK_SIZE)):
+        size = min(GENERATE_CHUNK_SIZE, num_rows - start)
+        yield from _generate_chunk(chunk_idx, size, languages, language_weights / language_weights.sum(), wiki_fraction, seed)
+
+
+def synthetic_rows(num_rows: int, **kwargs) -> list[dict]:
+    """Generate a list of training rows, see `iter_synthetic_rows`."""
+    return list(iter_synthetic_rows(num_rows, **kwargs))
+
+
+def synthetic_frame(num_rows: int, language: str | Language = Language.yoruba, seed: int = SEED) -> pd.DataFrame:
+    """
+    Generate a collected dataset of a language, as read from the .tsv files before `unify_datasources`.
+
+    Args:
+        num_rows: The number of rows.
+        language: The language.
+        seed: The seed.
+
+    Returns:
+        The dataset, with the "title", "text", "url", "source", "category" and "sub_topic" columns.
+    """
+    rows = synthetic_rows(num_rows, languages=[language], wiki_fraction=0, seed=seed)
+    rng = np.random.default_rng(seed)
+    has_sub_topic = rng.random(num_rows) < 0.2
+    return pd.DataFrame({
+        "title": [row["query"] for row in rows],
+        "text": [row["pos"][0] for row in rows],
+        "url": [row["url"] for row in rows],
+        "source": [row["source"] for row in rows],
+        "category": [row["category"] for row in rows],
+        "sub_topic": [row["query"].split()[0] if keep else None for row, keep in zip(rows, has_sub_topic.tolist())],
+    })
+
+
+def synthetic_wura(num_rows: int, language: str | Language = Language.yoruba, validation_fraction: float = 0.1,
+                   seed: int = SEED) -> DatasetDict:
+    """
+    Generate a Wura dataset of a language, with rows `prepare_wura` filters out.
+
+    Some headlines are missing or a single word and some urls are missing or too short, like in the Wura dataset. The validation
+    urls are those of the first rows of the collected dataset `synthetic_frame` generates with the same seed, as scheme and
+    "www." variants.
+
+    Args:
+        num_rows: The number of rows of the train split.
+        language: The language.
+        validation_fraction: The size of the validation split, as a fraction of the train split.
+        seed: The seed.
+
+    Returns:
+        The "train" and "validation" splits, with the "headline", "content", "category" and "url" columns.
+    """
+    rows = synthetic_rows(num_rows, languages=[language], wiki_fraction=0, seed=seed + 1)
+    rng = np.random.default_rng(seed + 1)
+    damage = rng.random(num_rows)
+    headlines = [row["query"] for row in rows]
+    urls = [row["url"] for row in rows]
+    for idx in np.flatnonzero(damage < 0.01).tolist():
+        headlines[idx] = None
+    for idx in np.flatnonzero((damage >= 0.01) & (damage < 0.03)).tolist():
+        headlines[idx] = headlines[idx].split()[0]
+    for idx in np.flatnonzero((damage >= 0.03) & (damage < 0.035)).tolist():
+        urls[idx] = None if idx % 2 else "n/a"
+    train = Dataset.from_dict({
+        "headline": headlines,
+        "content": [row["pos"][0] for row in rows],
+        "category": [row["category"] for row in rows],
+        "url": urls,
+    })
+
+    collected_rows = iter_synthetic_rows(int(num_rows * validation_fraction), languages=[language], wiki_fraction=0, seed=seed)
+    validation_urls = [
+        row["url"].replace("https://", "http://", 1) if idx % 2 else row["url"].replace("http://", "https://", 1)
+        for idx, row in enumerate(collected_rows)
+    ]
+    validation = Dataset.from_dict({
+        "headline": ["Labarai"] * len(validation_urls),
+        "content": [""] * len(validation_urls),
+        "category": [None] * len(validation_urls),
+        "url": validation_urls,
+    })
+    return DatasetDict({"train": train, "validation": validation})
+
+
+def synthetic_audits(num_rows: int, seed: int = SEED) -> list[dict]:
+    """Generate the audits of the rows, mostly kept ("X") with some "NLC", "SKIP" and "EMPTYTEXT" ones."""
+    categories = np.random.default_rng(seed).choice(len(AUDIT_CATEGORIES), size=num_rows, p=AUDIT_WEIGHTS)
+    return [{"category": AUDIT_CATEGORIES[category]} for category in categories.tolist()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic Yoruba, Igbo and Hausa-like training dataset, e.g. to benchmark the pipelines.")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--languages", nargs="+", choices=SYNTHETIC_LANGUAGES, default=SYNTHETIC_LANGUAGES, type=str.lower)
+    parser.add_argument("--wiki-fraction", type=float, default=WIKI_FRACTION)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", type=str, default=None, help="The artefact to write, in any format of `write_artefact`.")
+    args = parser.parse_args()
+
+    output = args.output or ARTEFACTS_DIR / f"synthetic_{args.rows}_train_dataset.jsonl"
+    count = write_artefact(output, iter_synthetic_rows(args.rows, args.languages, args.wiki_fraction, args.seed))
+    logger.info(f"Wrote {count} synthetic rows to {output}.")
@@ -1,20 +1,28 @@
 import pandas as pd
-import numpy as np
 from datasets import load_dataset, dataset_dict
 
 from pipeline.constants import SEED
-from pipeline.data.enums import DataSource
+from pipeline.data.enums import DataSource, Language, NegativeSampling
+from pipeline.data.negatives import mine_hard_negatives
 from pipeline.data.wura import align_with_wura
-from pipeline.data.utils import load_artefact
+from pipeline.data.utils import load_artefact, sample_negative_idxs, write_artefact
 
 
-def unify_datasources(dfs: list[pd.DataFrame], wura_data: dataset_dict.DatasetDict) -> pd.DataFrame:
+# The collected datasets of every language, combined with Wura by the `make_*_df` functions.
+SOURCE_ARTEFACTS = {
+    Language.hausa: ["hausa_mato_81k.tsv"],
+    Language.yoruba: ["alaroye_mato_10k.tsv", "von_mato_6k.tsv", "masakhanews_1k.tsv"],
+    Language.igbo: ["igbo_mato_3k.tsv"],
+}
+
+def unify_datasources(dfs: list[pd.DataFrame], wura_data: dataset_dict.DatasetDict, language: Language) -> pd.DataFrame:
     """
     Unify the datasources.
 
     Args:
         dfs: The list of dataframes to unify.
         wura_data: The wura data.
+        language: The language of the datasources.
 
     Returns:
         The unified dataframe.
@@ -25,7 +33,7 @@ def unify_datasources(dfs: list[pd.DataFrame], wura_data: dataset_dict.DatasetDi
             df["sub_topic"] = None
 
     df = pd.concat(dfs)
-    df = align_with_wura(df, wura_data)
+    df = align_with_wura(df, wura_data, language)
 
     # dropna for title and text columns
     key_columns = ["title", "text"]
@@ -33,32 +41,15 @@ def unify_datasources(dfs: list[pd.DataFrame], wura_data: dataset_dict.DatasetDi
     return df
 
 
-def make_train_dataset(df: pd.DataFrame, duplicate_rows=False, filename="train_dataset.jsonl") -> None:
+def make_train_dataset(df: pd.DataFrame, duplicate_rows=False, filename="train_dataset.jsonl", negatives=NegativeSampling.random,
+                       num_shards=1, compression=None) -> None:
     """In this version of make dataset, no longer split into train and eval, because eval and test datasets are currently gotten from wura."""
-    df_count = len(df)
-    df["neg"] = None
-
-    rng = np.random.default_rng(SEED)
-    def pick_negative_values(row):
-        picked = False
-        neg = row.neg
-        if not neg:
-            size = 7
-            neg = []
-        else:
-            neg = [neg]
-            size = 6
-
-        while not picked:
-            indexes = rng.choice(df_count, size=size, replace=False)
-            if row.name not in indexes:
-                picked = True
-
-        new_neg = neg + df.iloc[indexes].pos.tolist()
-        return new_neg
-
     df.rename(columns={"text": "pos", "title": "query"}, inplace=True)
-    df["neg"] = df.apply(lambda row: pick_negative_values(row), axis=1)
+    if NegativeSampling(negatives) == NegativeSampling.hard:
+        neg_idxs = mine_hard_negatives(df["query"].tolist(), df["pos"].tolist())
+    else:
+        neg_idxs = sample_negative_idxs(len(df))
+    df["neg"] = df["pos"].to_numpy(dtype=object)[neg_idxs].tolist()
     # Extracting subtopics and using them as a query in duplicate rows
     rows_wo_subtopic = df["sub_topic"].isna()
     if duplicate_rows:
@@ -72,7 +63,8 @@ def make_train_dataset(df: pd.DataFrame, duplicate_rows=False, filename="train_d
     df["pos"] = df["pos"].apply(lambda x: [x])
     df = df.loc[:, ["query", "pos", "neg", "url", "source"]]
     df = df.sample(frac=1, random_state=SEED).reset_index(drop=True)
-    df.to_json(filename, orient="records", lines=True)
+    # Streaming the rows in chunks, instead of encoding the whole frame at once.
+    write_artefact(filename, df, num_shards=num_shards, compression=compression)
 
 
 def make_hausa_df():
@@ -85,7 +77,7 @@ def make_hausa_df():
     df1 = df1.drop_duplicates(["link"])
     df1.rename(columns={"link": "url"}, inplace=True)
     df1["source"] = DataSource.mato
-    df = unify_datasources([df1], wura_data)
+    df = unify_datasources([df1], wura_data, Language.hausa)
 
     return df
 
@@ -109,7 +101,7 @@ def make_yoruba_df():
     dfs = [df1, df2, df3]
     dfs = [df.drop_duplicates(["url"]) for df in dfs]
 
-    return unify_datasources(dfs, wura_data)
+    return unify_datasources(dfs, wura_data, Language.yoruba)
 
 
 def make_igbo_df():
@@ -118,6 +110,6 @@ def make_igbo_df():
     df1 = load_artefact("igbo_mato_3k.tsv")
     df1["source"] = DataSource.mato
     df1.rename(columns={"link": "url"}, inplace=True)
-    df = unify_datasources([df1], wura_data)
+    df = unify_datasources([df1], wura_data, Language.igbo)
 
     return df
@@ -1,21 +1,20 @@
 from copy import deepcopy
 
-import numpy as np
+from pipeline.data.utils import find_artefact, load_artefact
+from pipeline.data.negatives import assign_negatives
+from pipeline.data.enums import Language, DataSplit, NegativeSampling
 
-from pipeline.constants import SEED
-from pipeline.data.utils import load_artefact
-from pipeline.data.utils import fix_negatives
-from pipeline.data.enums import Language, DataSplit
 
+# The languages whose queries are translated into English.
+TRANSLATED_LANGUAGES = [Language.hausa, Language.igbo, Language.yoruba]
 
-def make_english_dataset(split):
-    if split not in DataSplit:
+def make_english_dataset(split, negatives=NegativeSampling.random):
+    if split not in list(DataSplit):
         raise ValueError(f"Split must be one of {DataSplit}.")
     
     all_translated_data = []
-    languages = [Language.hausa, Language.igbo, Language.yoruba]
-    for language in languages:
-        rows = load_artefact(f"filtered_{language}_{split}_dataset.jsonl")
+    for language in TRANSLATED_LANGUAGES:
+        rows = load_artefact(find_artefact(f"filtered_{language}_{split}_dataset"))
         translated_rows = load_artefact(f"{language}_english_gemma3_27b_{split}_results.jsonl")
 
         new_translated_data = []
@@ -33,8 +32,8 @@ def make_english_dataset(split):
             new_data.pop("neg", None)
             new_translated_data.append(new_data)
 
-        rng = np.random.default_rng(SEED)
-        new_translated_data = [fix_negatives(row_idx, new_translated_data, rng) for row_idx in range(len(new_translated_data))]
+        # Hard negatives are mined with the original queries, as the documents are not in English.
+        new_translated_data = assign_negatives(new_translated_data, negatives, query_key="root_query_text")
         all_translated_data.extend(new_translated_data)
 
     return all_translated_data
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import pandas as pd
+
+from pipeline.data.enums import DataSource, Language
+
+
+URL_INDEX_COLUMNS = ["key", "url", "source", "split", "language", "category"]
+URL_SCHEME_PATTERN = r"^[A-Za-z][A-Za-z0-9+.\-]*://"
+
+
+def canonicalize_urls(urls: pd.Series) -> pd.Series:
+    """
+    Format a column of urls the way they are stored in the datasets, with a single trailing slash.
+
+    Args:
+        urls: The urls, missing urls become empty strings.
+
+    Returns:
+        The formatted urls.
+    """
+    formatted = urls.astype("str").str.strip("/") + "/"
+    return formatted.where(urls.notna(), "")
+
+
+def url_keys(urls: pd.Series) -> pd.Series:
+    """
+    Get the join keys of a column of urls, equal for urls pointing to the same page.
+
+    The key drops the scheme, a leading "www." and the fragment, lowercases the host and strips the slashes at the end,
+    so "https://www.BBC.com/yoruba/123/" and "http://bbc.com/yoruba/123" share the key "bbc.com/yoruba/123".
+
+    Args:
+        urls: The urls, missing urls get an empty key.
+
+    Returns:
+        The keys.
+    """
+    urls = urls.astype("str").where(urls.notna(), "").str.strip()
+    parts = urls.str.replace(URL_SCHEME_PATTERN, "", regex=True).str.extract(r"^(?P<host>[^/?#]*)(?P<rest>[^#]*)")
+    hosts = parts["host"].str.lower().str.removeprefix("www.")
+    return (hosts + parts["rest"].str.rstrip("/")).fillna("")
+
+
+class UrlIndex:
+    """
+    In-memory index of the urls of sources, splits and languages.
+
+    Lookups are hash joins on the `url_keys` of the urls, so checking a whole column costs one pass over it.
+
+    Example:
+        >>> url_index = UrlIndex()
+        >>> url_index.add(wura_df["url"], DataSource.wura, "train", Language.yoruba, categories=wura_df["category"])
+        >>> df["category"] = url_index.lookup(df["url"], "category", source=DataSource.wura)
+    """
+
+    def __init__(self):
+        self.df = pd.DataFrame({column: pd.Series(dtype="str") for column in URL_INDEX_COLUMNS})
+
+    def add(self, urls, source: str | DataSource, split: str, language: str | Language, categories=None) -> None:
+        """
+        Set the urls of a source, split and language, replacing the ones previously added.
+
+        Args:
+            urls: The urls.
+            source: The source of the urls.
+            split: The split the urls belong to, e.g. "train" or "validation" for Wura.
+            language: The language of the urls.
+            categories: The categories of the urls, if known.
+        """
+        urls = pd.Series(urls, dtype="str")
+        entries = pd.DataFrame({
+            "key": url_keys(urls).to_numpy(),
+            "url": canonicalize_urls(urls).to_numpy(),
+            "source": str(source),
+            "split": str(split),
+            "language": str(language),
+            "category": pd.Series(categories, dtype="str").to_numpy() if categories is not None else None,
+        }, columns=URL_INDEX_COLUMNS)
+        entries = entries[entries["key"] != ""].drop_duplicates("key")
+
+        entries = entries.astype(self.df.dtypes.to_dict())
+        replaced = (self.df["source"] == str(source)) & (self.df["split"] == str(split)) & (self.df["language"] == str(language))
+        self.df = pd.concat([self.df[~replaced], entries], ignore_index=True)
+
+    def select(self, source: str | None = None, split: str | None = None, language: str | None = None) -> pd.DataFrame:
+        """Get the entries of the given source, split and language, all of them when None."""
+        mask = pd.Series(True, index=self.df.index)
+        for column, value in (("source", source), ("split", split), ("language", language)):
+            if value is not None:
+                mask &= self.df[column] == str(value)
+        return self.df[mask]
+
+    def contains(self, urls: pd.Series, **filters) -> pd.Series:
+        """
+        Check which urls are in the index.
+
+        Args:
+            urls: The urls to check.
+            filters: The source, split and language the urls are looked up in, see `select`.
+
+        Returns:
+            A boolean mask aligned with `urls`.
+        """
+        keys = url_keys(urls)
+        return keys.isin(pd.Index(self.select(**filters)["key"])) & (keys != "")
+
+    def lookup(self, urls: pd.Series, column: str, **filters) -> pd.Series:
+        """
+        Get a column of the index entries of the urls.
+
+        Args:
+            urls: The urls to look up.
+            column: The column of the entries to get.
+            filters: The source, split and language the urls are looked up in, see `select`.
+
+        Returns:
+            The values aligned with `urls`, missing for urls that are not in the index.
+        """
+        entries = self.select(**filters).drop_duplicates("key").set_index("key")[column]
+        return url_keys(urls).map(entries)
+
@@ -1,25 +1,31 @@
 from __future__ import annotations
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlparse
-from typing import TYPE_CHECKING
 
 import gdown
-import jsonlines
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from pipeline.data.constants import DRIVE_IDS
-from pipeline.constants import ARTEFACTS_DIR
-
-
-if TYPE_CHECKING:
-    import numpy as np
+from pipeline.data.columnar import COLUMNAR_SUFFIXES, ArrowRows, count_rows, read_table, write_table
+from pipeline.data.enums import ArtefactFormat, Compression
+from pipeline.data.jsonl import (COMPRESSION_SUFFIXES, MANIFEST_SUFFIX, JsonlRows, iter_jsonl, iter_jsonl_shards, read_manifest,
+                                 write_jsonl, write_jsonl_shards)
+from pipeline.constants import ARTEFACTS_DIR, SEED
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The network location of urls `urlparse` splits the same way: a scheme followed by "//" and printable ASCII characters
+# other than "/?#[]", up to the path, query, fragment or end of the url.
+URL_NETLOC_PATTERN = r"^[A-Za-z][A-Za-z0-9+.\-]*://(?P<netloc>[!-\"$-.0->@-Z\\^-~]*)(?:[/?#]|$)"
+
 
 def extract_domain_name(url: str) -> str | None:
     """
@@ -37,21 +43,96 @@ def extract_domain_name(url: str) -> str | None:
     try:
         parsed_url = urlparse(url)
         netloc = str(parsed_url.netloc)
-        return netloc.strip("www.")
+        return netloc.removeprefix("www.")
     except ValueError:
         return None
+
+
+def extract_domain_names(urls: pa.Array | pa.ChunkedArray) -> pa.Array:
+    """
+    Extract the domain names of a column of urls, giving the same results as `extract_domain_name` on each url.
+
+    The network locations are extracted with a regex kernel. Urls the regex cannot parse the way `urlparse` does
+    (e.g. with whitespace, brackets or non ASCII characters in the network location) go through `extract_domain_name`.
+
+    Args:
+        urls: The urls to extract the domain names from.
+
+    Returns:
+        The domain names.
+    """
+    if isinstance(urls, pa.ChunkedArray):
+        urls = urls.combine_chunks()
+    netlocs = pc.struct_field(pc.extract_regex(urls, URL_NETLOC_PATTERN), "netloc")
+    domains = pc.replace_substring_regex(netlocs, r"^www\.", "")
+
+    fallback = pc.and_(pc.is_null(netlocs), pc.not_equal(urls, "")).fill_null(False)
+    if pc.any(fallback).as_py():
+        fallback_urls = pc.filter(urls, fallback).to_pylist()
+        domains = pc.replace_with_mask(domains, fallback, pa.array([extract_domain_name(url) for url in fallback_urls], type=pa.string()))
+    return domains
     
 
 def load_jsonl(file_path):
-    lines = []
-    with jsonlines.open(file_path, 'r') as f_:
-        for line in f_.iter(allow_none=True):
-            lines.append(line)
-    return lines
+    return list(iter_jsonl(file_path))
+
+
+# Rows of DataFrames converted to dictionaries at a time by the writers.
+FRAME_CHUNK_ROWS = 1 << 14
+# The suffixes artefacts can be written with, see `artefact_name`.
+ARTEFACT_SUFFIXES = [".jsonl", ".jsonl.gz", ".jsonl.zst", MANIFEST_SUFFIX, *COLUMNAR_SUFFIXES]
 
 
-def load_artefact(key):
-    """Loads data."""
+def artefact_name(stem: str, fmt: str = ArtefactFormat.jsonl, compression: str | None = None, num_shards: int = 1) -> str:
+    """
+    Get the file name of an artefact written in the given format.
+
+    Args:
+        stem: The name of the artefact without its suffix, e.g. "filtered_hausa_train_dataset".
+        fmt: The format of the artefact.
+        compression: The compression of JSONL artefacts, Parquet files are always compressed.
+        num_shards: The number of shards of JSONL artefacts, the name of their manifest is returned when more than 1.
+
+    Returns:
+        The file name.
+    """
+    if fmt != ArtefactFormat.jsonl:
+        if compression is not None or num_shards > 1:
+            raise ValueError(f"Only JSONL artefacts can be compressed or sharded, got the {fmt} format.")
+        return f"{stem}.{fmt}"
+    if num_shards > 1:
+        return f"{stem}{MANIFEST_SUFFIX}"
+    suffixes = {codec: suffix for suffix, codec in COMPRESSION_SUFFIXES.items()}
+    return f"{stem}.jsonl{suffixes[Compression(compression)] if compression is not None else ''}"
+
+
+def find_artefact(stem: str) -> str:
+    """
+    Get the file name of an artefact in the format it was last written in.
+
+    Args:
+        stem: The name of the artefact without its suffix, e.g. "filtered_hausa_test_dataset".
+
+    Returns:
+        The file name of the most recently written format, the JSONL one when none exists.
+    """
+    names = [f"{stem}{suffix}" for suffix in ARTEFACT_SUFFIXES]
+    existing = [name for name in names if (Path(ARTEFACTS_DIR) / name).exists()]
+    if not existing:
+        return names[0]
+    return max(existing, key=lambda name: (Path(ARTEFACTS_DIR) / name).stat().st_mtime_ns)
+
+
+def load_artefact(key, columns: list[str] | None = None):
+    """
+    Loads data.
+
+    JSONL files are returned as a lazy `JsonlRows` view, rows are only decoded when accessed.
+    Compressed JSONL files (".jsonl.gz", ".jsonl.zst") and sharded ones (".manifest.json") are decoded into a list.
+    Parquet and Arrow IPC files are memory mapped and returned as a lazy `ArrowRows` view, and only their `columns`
+    are read, e.g. `["query", "pos"]` to skip the negatives. Every column of JSONL files is decoded.
+    Use `list(...)` on the result when the rows need to be mutated in place.
+    """
     path = Path(key) if Path(key).is_absolute() else Path(ARTEFACTS_DIR) / key
     if not path.exists() and key not in DRIVE_IDS:
         raise ValueError(f"Key {key} not found on disk. It also does not exist in DRIVE_IDS. Either provide a valid path or drive id."
@@ -60,37 +141,159 @@ def load_artefact(key):
         path = Path(gdown.download(id=DRIVE_IDS[key], output=f"{ARTEFACTS_DIR}/", quiet=True))
 
     if path.suffix == ".jsonl":
-        return load_jsonl(path)
+        return JsonlRows(path)
+    elif path.name.endswith(MANIFEST_SUFFIX):
+        return list(iter_jsonl_shards(path))
+    elif path.suffix in COMPRESSION_SUFFIXES:
+        return list(iter_jsonl(path))
+    elif path.suffix in COLUMNAR_SUFFIXES:
+        return ArrowRows(read_table(path, columns=columns))
     elif path.suffix == ".tsv":
         return pd.read_csv(path, delimiter="\t")
     else:
-        raise ValueError(f"Unsupported file format: {path}. Supported formats are .jsonl and .tsv.")
+        raise ValueError(f"Unsupported file format: {path}. Supported formats are {ARTEFACT_SUFFIXES} and .tsv.")
+
+
+def iter_frame_rows(df: pd.DataFrame, chunk_rows: int = FRAME_CHUNK_ROWS):
+    """
+    Stream the rows of a DataFrame as dictionaries, converting a chunk of rows at a time.
+
+    Missing values become None, the way `to_json` writes them as null.
+
+    Args:
+        df: The DataFrame.
+        chunk_rows: The number of rows converted at a time.
+
+    Returns:
+        An iterator over the rows.
+    """
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].astype(object)
+        yield from chunk.where(chunk.notna(), None).to_dict("records")
+
+
+def write_artefact(file_path, rows, num_shards: int = 1, compression: str | None = None) -> int:
+    """
+    Write rows in the format of the file suffix, streaming them.
+
+    Args:
+        file_path: The path of the file, see `artefact_name`. Sharded JSONL files are written for ".manifest.json".
+        rows: The rows to write, an iterable of dictionaries or a DataFrame.
+        num_shards: The number of shards of sharded JSONL files.
+        compression: The compression of the shards of sharded JSONL files, other files are compressed by suffix.
+
+    Returns:
+        The number of rows written.
+    """
+    file_path = Path(file_path)
+    if file_path.suffix in COLUMNAR_SUFFIXES:
+        return write_table(file_path, rows)
+    if isinstance(rows, pd.DataFrame):
+        rows = iter_frame_rows(rows)
+    if file_path.name.endswith(MANIFEST_SUFFIX):
+        return write_jsonl_shards(file_path, rows, num_shards, compression)
+    elif file_path.suffix == ".jsonl" or file_path.suffix in COMPRESSION_SUFFIXES:
+        return write_jsonl(file_path, rows)
+    raise ValueError(f"Unsupported file format: {file_path}. Supported formats are {ARTEFACT_SUFFIXES}.")
+
+
+def iter_artefact(file_path):
+    """
+    Stream the rows of an artefact in any of the formats written by `write_artefact`.
+
+    Args:
+        file_path: The path of the file.
+
+    Returns:
+        An iterator over the rows.
+    """
+    file_path = Path(file_path)
+    if file_path.name.endswith(MANIFEST_SUFFIX):
+        return iter_jsonl_shards(file_path)
+    elif file_path.suffix in COLUMNAR_SUFFIXES:
+        return iter(ArrowRows(read_table(file_path)))
+    return iter_jsonl(file_path)
+
+
+def count_artefact_rows(file_path) -> int:
+    """Count the rows of an artefact in any of the formats written by `write_artefact`, from the metadata when there is some."""
+    file_path = Path(file_path)
+    if file_path.name.endswith(MANIFEST_SUFFIX):
+        return read_manifest(file_path)["num_rows"]
+    elif file_path.suffix in COLUMNAR_SUFFIXES:
+        return count_rows(file_path)
+    return sum(1 for _ in iter_jsonl(file_path))
+
+
+NUM_NEGATIVES = 7
+# Rows handled by each spawned random generator. Kept independent of the number of workers,
+# so that the sampled negatives only depend on the seed.
+NEGATIVES_CHUNK_SIZE = 1 << 16
+
+
+def _sample_negative_chunk(start: int, stop: int, num_rows: int, size: int, seed_seq: np.random.SeedSequence) -> np.ndarray:
+    rng = np.random.default_rng(seed_seq)
+    row_idxs = np.arange(start, stop)[:, None]
+    neg_idxs = rng.integers(0, num_rows, size=(stop - start, size))
+    while True:
+        # Only the rows that picked themselves or picked a document twice are drawn again.
+        sorted_idxs = np.sort(neg_idxs, axis=1)
+        redraw = (neg_idxs == row_idxs).any(axis=1) | (sorted_idxs[:, 1:] == sorted_idxs[:, :-1]).any(axis=1)
+        redraw_count = int(redraw.sum())
+        if not redraw_count:
+            return neg_idxs
+        neg_idxs[redraw] = rng.integers(0, num_rows, size=(redraw_count, size))
+
+
+def sample_negative_idxs(num_rows: int, size: int = NUM_NEGATIVES, seed: int = SEED, workers: int = 1) -> np.ndarray:
+    """
+    Sample the indexes of the negative rows for every row at once.
+
+    Each row gets `size` distinct indexes that never include the row itself.
+    The rows are split into fixed size chunks, each with its own generator spawned from `seed`,
+    so the result is the same for a given seed regardless of the number of workers.
+
+    Args:
+        num_rows: The number of rows to sample negatives for.
+        size: The number of negatives per row.
+        seed: The seed to spawn the random generators from.
+        workers: The number of threads to sample the chunks with.
+
+    Returns:
+        An array of shape (num_rows, size) holding the negative indexes.
+    """
+    if num_rows <= size:
+        raise ValueError(f"At least {size + 1} rows are needed to sample {size} negatives per row. Got {num_rows} rows.")
+
+    starts = range(0, num_rows, NEGATIVES_CHUNK_SIZE)
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(starts))
+    args = [(start, min(start + NEGATIVES_CHUNK_SIZE, num_rows), num_rows, size, seed_seq) for start, seed_seq in zip(starts, seed_seqs)]
+    if workers > 1 and len(args) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(lambda arg: _sample_negative_chunk(*arg), args))
+    else:
+        chunks = [_sample_negative_chunk(*arg) for arg in args]
+    return np.concatenate(chunks)
 
 
-def fix_negatives(row_idx: int, rows: list[dict], rng: np.random.Generator) -> dict:
+def add_negatives(rows: list[dict], size: int = NUM_NEGATIVES, seed: int = SEED, workers: int = 1) -> list[dict]:
     """
-    Add the desired number of negative samples to the row.
+    Add the desired number of negative samples to all of the rows, never picking a row's own document.
 
     Args:
-        row_idx: The index of the row to fix.
-        rows: The rows to fix the negatives for.
-        rng: The random number generator to use.
+        rows: The rows to add the negatives to, they are updated in place.
+        size: The number of negatives per row.
+        seed: The seed to sample the negatives with.
+        workers: The number of threads to sample with.
 
     Returns:
-        The fixed row.
-    """
-    picked = False
-    size = 7
-
-    while not picked:
-        neg_idxs = rng.choice(len(rows), size=size, replace=False)
-        if row_idx not in neg_idxs:
-            picked = True
-
-    row = rows[row_idx]
-    row["neg"] = [
-        rows[i]["pos"][0]
-        if isinstance(rows[i]["pos"], list) else rows[i]["pos"]
-        for i in neg_idxs
-    ]
-    return row
+        The rows.
+    """
+    if not rows:
+        return rows
+
+    neg_idxs = sample_negative_idxs(len(rows), size=size, seed=seed, workers=workers)
+    docs = [row["pos"][0] if isinstance(row["pos"], list) else row["pos"] for row in rows]
+    for row, row_neg_idxs in zip(rows, neg_idxs.tolist()):
+        row["neg"] = [docs[i] for i in row_neg_idxs]
+    return rows
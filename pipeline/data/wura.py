@@ -1,14 +1,19 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from datasets import arrow_dataset, dataset_dict
 
-from pipeline.data.utils import extract_domain_name
-from pipeline.data.enums import DataSource
+from pipeline.data.urls import UrlIndex, canonicalize_urls, url_keys
+from pipeline.data.utils import extract_domain_names
+from pipeline.data.enums import DataSource, DataSplit, Language
 
 
 def prepare_wura(dataset: arrow_dataset.Dataset) -> pd.DataFrame:
     """
     Prepare the wura dataset, filtering out rows that are not valid.
 
+    The rows are filtered with pyarrow compute kernels on the columns of the dataset, rows are never turned into Python objects.
+
     Args:
         dataset: The wura dataset.
 
@@ -23,41 +28,44 @@ def prepare_wura(dataset: arrow_dataset.Dataset) -> pd.DataFrame:
     if missing_columns:
         raise ValueError(f"The dataset must contain all of the following features: {expected_columns}. Missing features: {missing_columns}")
 
-    domain_counts = {}
-    for row in dataset:
-        domain = extract_domain_name(row["url"])
-        domain_counts[domain] = domain_counts.get(domain, 0) + 1
+    table = dataset.select_columns(["headline", "content", "category", "url"]).with_format("arrow")[:]
+    urls = table["url"].combine_chunks()
+    domains = extract_domain_names(urls)
+    domain_counts = pc.value_counts(domains)
 
     invalid_domains = {
         "jw.org" # Has really weird links, for example:  https://www.jw.org/yo/elerii-jehofa/kan-si-wa/venezuela/, https://www.jw.org/yo/elerii-jehofa/kan-si-wa/tonga/, https://www.jw.org/yo/elerii-jehofa/kan-si-wa/taiwan/ all have the title "Kan Si Wa"
     }
-
-    is_headline_valid = lambda value: len((value or " ").split()) > 1
-    is_url_valid = lambda value: len((value or " ").strip()) > 5
-    is_domain_valid = lambda value: domain_counts[value] > 10 and not value in invalid_domains # If the domain does not appear enough times that is a sign that the site is not committed to publishing in the language. So it is probably a weird url or the English was translated using Google translate e.g. https://downloadfacetime.com/facetime/facetime-for-ipad/
-
-    data = []
-    for row in dataset:
-        if not (is_headline_valid(row["headline"]) \
-                and is_url_valid(row["url"]) \
-                and is_domain_valid(extract_domain_name(row["url"]))):
-            continue
-
-        data.append({
-            "title": row["headline"],
-            "url": row["url"].strip("/") + "/", "text": row["content"],
-            "category": row["category"],
-            "source": DataSource.wura,
-        })
-
-    wura_df = pd.DataFrame(data)
+    # If the domain does not appear enough times that is a sign that the site is not committed to publishing in the language. So it is probably a weird url or the English was translated using Google translate e.g. https://downloadfacetime.com/facetime/facetime-for-ipad/
+    valid_domains = pc.filter(domain_counts.field("values"), pc.greater(domain_counts.field("counts"), 10))
+    # Null domains (urls `urlparse` rejects) are counted and kept like any other domain.
+    valid_domains = pc.filter(valid_domains, pc.invert(pc.is_in(valid_domains, value_set=pa.array(list(invalid_domains)), skip_nulls=False)))
+
+    # Trimming first, as unlike `str.split` the split kernel keeps the empty strings around leading and trailing whitespace.
+    headlines = pc.utf8_trim_whitespace(pc.fill_null(table["headline"], " "))
+    is_headline_valid = pc.greater(pc.list_value_length(pc.utf8_split_whitespace(headlines)), 1)
+    is_url_valid = pc.greater(pc.utf8_length(pc.utf8_trim_whitespace(pc.fill_null(urls, " "))), 5)
+    is_domain_valid = pc.is_in(domains, value_set=valid_domains, skip_nulls=False)
+    is_valid = pc.and_(pc.and_(is_headline_valid, is_url_valid), is_domain_valid).fill_null(False)
+
+    table = table.filter(is_valid)
+    wura_df = pa.table({
+        "title": table["headline"],
+        "url": pc.binary_join_element_wise(pc.utf8_trim(table["url"], "/"), "/", ""),
+        "text": table["content"],
+        "category": table["category"],
+    }).to_pandas()
+    wura_df["source"] = DataSource.wura
     return wura_df
 
 
 def wura_remove_validation_rows(df: pd.DataFrame, wura_validation_dataset) -> pd.DataFrame:
     """
     Checks for rows in df that exist in wura_ds, using the url, then drops them.
-    
+
+    The urls are compared by their `url_keys` with a hash join, so "http://" and "https://" or "www." variants of a
+    validation url are dropped too.
+
     Args:
         df: The dataframe to modify
         wura_validation_dataset: The wura validation dataset.
@@ -65,42 +73,36 @@ def wura_remove_validation_rows(df: pd.DataFrame, wura_validation_dataset) -> pd
     Returns:
         The modified dataframe.
     """
-    wura_val_urls = wura_validation_dataset["url"]
-    wura_val_urls = {url.strip("/") + "/" for url in wura_val_urls}
-
-    def format_url(row):
-        if pd.isna(row.url):
-            row.url = ""
-            return row
-        else:
-            row.url = row.url.strip("/") + "/"
-            return row
-
-    df = df.apply(lambda row: format_url(row), axis=1)
-    df = df[~df.url.isin(wura_val_urls)].reset_index(drop=True)
-
-    return df
+    df = df.assign(url=canonicalize_urls(df["url"]))
+    validation_keys = url_keys(pd.Series(wura_validation_dataset["url"], dtype="str"))
+    keys = url_keys(df["url"])
+    is_validation = keys.isin(pd.Index(validation_keys[validation_keys != ""]))
+    return df[~is_validation.to_numpy()].reset_index(drop=True)
 
 
-def align_with_wura(df: pd.DataFrame, wura_data: dataset_dict.DatasetDict) -> pd.DataFrame:
+def align_with_wura(df: pd.DataFrame, wura_data: dataset_dict.DatasetDict, language: str | Language) -> pd.DataFrame:
     """
     Align the dataframe with the wura dataset, removing duplicates and adding missing categories.
+
+    The categories are back-filled from a url index of the wura train split.
+
     Args:
         df: The dataframe to align.
         wura_data: The wura dataset.
-        
-    Returns: 
+        language: The language of the datasets.
+
+    Returns:
         The aligned dataframe.
     """
     df = wura_remove_validation_rows(df, wura_data["validation"])
     # Combined collected dataset with Wura train dataset
     wura_df = prepare_wura(wura_data["train"])
+    url_index = UrlIndex()
+    url_index.add(wura_df["url"], DataSource.wura, DataSplit.train, language, categories=wura_df["category"])
 
-    df_urls = set(df.url)
-    seen_rows = wura_df.url.isin(df_urls)
-    new_wura_df = wura_df[~seen_rows]
-    old_wura_df = wura_df[seen_rows]
+    seen_rows = url_keys(wura_df["url"]).isin(pd.Index(url_keys(df["url"])))
+    new_wura_df = wura_df[~seen_rows.to_numpy()]
     df = pd.concat([df, new_wura_df])
     # Extracting the category data available in Wura, so we don't miss out on that data
-    df["category"] = df["url"].map(old_wura_df.set_index("url")["category"])
+    df["category"] = url_index.lookup(df["url"], "category", source=DataSource.wura, split=DataSplit.train, language=language).to_numpy()
     return df
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import time
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.constants import ARTEFACTS_DIR
+from pipeline.data.columnar import COLUMNAR_SUFFIXES, ArrowRows, read_table
+from pipeline.data.utils import count_artefact_rows, iter_artefact
+from pipeline.embed_cache import EMBEDDING_CACHE_DIR, CachedEncoder, EmbeddingCache, model_fingerprint
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "abdulmatinomotoso/bge-finetuned"
+# The maximum lengths, in tokens, the model was finetuned with.
+QUERY_MAX_LENGTH = 512
+PASSAGE_MAX_LENGTH = 2048
+# Padded tokens per forward pass, i.e. batch size times the longest input of the batch.
+MAX_BATCH_TOKENS = 1 << 14
+MAX_BATCH_SIZE = 256
+# Rows read from an artefact at a time. Inputs are sorted by length within a chunk, so larger chunks pad less.
+EMBED_CHUNK_SIZE = 1 << 14
+
+
+def token_budget_batches(lengths: np.ndarray, max_tokens: int = MAX_BATCH_TOKENS,
+                         max_batch_size: int = MAX_BATCH_SIZE) -> list[np.ndarray]:
+    """
+    Group inputs of similar lengths into batches whose padded size fits in a token budget.
+
+    The inputs are sorted from the longest, so every batch is padded to its first input and the batches holding the
+    longest inputs, the most likely to run out of memory, come first. An input longer than the budget is a batch on its own.
+
+    Args:
+        lengths: The number of tokens of every input.
+        max_tokens: The largest number of padded tokens in a batch.
+        max_batch_size: The largest number of inputs in a batch.
+
+    Returns:
+        The indices of the inputs of every batch.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind="stable")
+    batches = []
+    start = 0
+    while start < len(order):
+        size = max(1, min(max_batch_size, max_tokens // max(int(lengths[order[start]]), 1)))
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+def padding_ratio(lengths: np.ndarray, batches: list[np.ndarray]) -> float:
+    """Get the share of the padded tokens of the batches that are padding."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    padded = sum(int(lengths[batch].max()) * len(batch) for batch in batches if len(batch))
+    return 1 - lengths.sum() / padded if padded else 0.0
+
+
+class DenseEncoder:
+    """
+    Batch encoder for the dense embeddings of the BGE-M3 model: the normalized CLS vectors of the last hidden states.
+
+    Inputs are tokenized once, then encoded in token budgeted batches of inputs of similar lengths, see
+    `token_budget_batches`, so little compute is spent on padding. The embeddings are returned in the order of the inputs.
+    A local directory of the model is loaded without network access.
+
+    Example:
+        >>> encoder = DenseEncoder("./bge-m3", max_length=QUERY_MAX_LENGTH)
+        >>> embeddings = encoder.encode(["Eyi jẹ́ gbolohun àpẹẹrẹ", "Wannan jimla ce ta misali"])
+    """
+
+    def __init__(self, model_name_or_path: str = MODEL_NAME, max_length: int = PASSAGE_MAX_LENGTH, device: str = "cpu",
+                 fp16: bool = False, max_tokens: int = MAX_BATCH_TOKENS, max_batch_size: int = MAX_BATCH_SIZE):
+        # transformers and the model runtime are only needed to run the model, the batching above works without them.
+        from transformers import AutoTokenizer
+
+        self.model_name_or_path = str(model_name_or_path)
+        self.max_length = max_length
+        self.device = device
+        self.fp16 = fp16
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+
+        self.local_files_only = Path(model_name_or_path).is_dir()
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name_or_path, local_files_only=self.local_files_only)
+        self.load_model()
+
+    def load_model(self) -> None:
+        """Load the model, overridden by the encoders of other runtimes, see `pipeline.export`."""
+        import torch
+        from transformers import AutoModel
+
+        self.torch = torch
+        dtype = torch.float16 if self.fp16 else torch.float32
+        self.model = AutoModel.from_pretrained(self.model_name_or_path, local_files_only=self.local_files_only, torch_dtype=dtype)
+        self.model.to(self.device).eval()
+
+    @property
+    def dim(self) -> int:
+        return self.model.config.hidden_size
+
+    @property
+    def model_id(self) -> str:
+        """The id of the model and of how it is run, the embeddings of different ids are not interchangeable."""
+        return model_fingerprint(self.model_name_or_path) + ("+fp16" if self.fp16 else "")
+
+    def tokenize(self, texts: list[str], max_length: int | None = None) -> list[list[int]]:
+        """Tokenize the texts, truncated to the maximum length of the encoder unless another is given, without padding them."""
+        return self.tokenizer(list(texts), truncation=True, max_length=max_length or self.max_length)["input_ids"]
+
+    def encode_batch(self, input_ids: list[list[int]]) -> np.ndarray:
+        """
+        Encode a batch of tokenized inputs.
+
+        Args:
+            input_ids: The token ids of the inputs.
+
+        Returns:
+            The normalized dense embeddings, as float32.
+        """
+        batch = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+        batch = {name: tensor.to(self.device) for name, tensor in batch.items()}
+        with self.torch.inference_mode():
+            cls = self.model(**batch).last_hidden_state[:, 0]
+            cls = self.torch.nn.functional.normalize(cls.float(), dim=-1)
+        return cls.cpu().numpy()
+
+    def encode(self, texts: list[str], max_length: int | None = None) -> np.ndarray:
+        """
+        Encode texts into their normalized dense embeddings.
+
+        Args:
+            texts: The texts to encode.
+            max_length: The maximum number of tokens of a text, the one of the encoder when None, e.g. `QUERY_MAX_LENGTH`
+                to encode queries with an encoder built for passages.
+
+        Returns:
+            The embeddings, shaped (len(texts), dim) in the order of `texts`.
+        """
+        input_ids = self.tokenize(texts, max_length=max_length)
+        lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+        embeddings = np.empty((len(input_ids), self.dim), dtype=np.float32)
+        for batch in token_budget_batches(lengths, self.max_tokens, self.max_batch_size):
+            embeddings[batch] = self.encode_batch([input_ids[i] for i in batch.tolist()])
+        return embeddings
+
+
+def row_text(row: dict, field: str) -> str:
+    """Get the text of a row to embed, the first text of list fields such as "pos"."""
+    value = row[field]
+    if isinstance(value, list):
+        value = value[0] if value else ""
+    return value or ""
+
+
+def iter_texts(file_path: str | Path, field: str) -> Iterator[str]:
+    """
+    Stream the texts of a field of an artefact, in any of the formats written by `write_artefact`.
+
+    Args:
+        file_path: The path of the artefact.
+        field: The field to embed, e.g. "query" or "pos".
+
+    Returns:
+        An iterator over the texts.
+    """
+    file_path = Path(file_path)
+    if file_path.suffix in COLUMNAR_SUFFIXES:
+        # Only reading the embedded column.
+        rows = iter(ArrowRows(read_table(file_path, columns=[field])))
+    else:
+        rows = iter_artefact(file_path)
+    return (row_text(row, field) for row in rows)
+
+
+def write_embeddings(file_path: str | Path, texts: Iterable[str], num_texts: int, encoder,
+                     chunk_size: int = EMBED_CHUNK_SIZE, dtype: str = "float32") -> int:
+    """
+    Stream texts through an encoder into a ".npy" file of embeddings, in the order of the texts.
+
+    The texts are encoded a chunk at a time, so only a chunk of texts is held in memory, and the embeddings are
+    written into a memory mapped array. The file is written to a temporary path then renamed, so it is never partial.
+
+    Args:
+        file_path: The path of the ".npy" file.
+        texts: The texts to encode.
+        num_texts: The number of texts, the number of rows of the array.
+        encoder: The encoder, with an `encode(texts)` method and a `dim` attribute, e.g. `DenseEncoder`.
+        chunk_size: The number of texts encoded at a time.
+        dtype: The dtype of the stored embeddings, "float32" or "float16".
+
+    Returns:
+        The number of embeddings written.
+    """
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.tmp")
+    embeddings = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(num_texts, encoder.dim))
+    start = 0
+    texts = iter(texts)
+    for chunk in iter(lambda: list(islice(texts, chunk_size)), []):
+        if start + len(chunk) > num_texts:
+            raise ValueError(f"Got more than the expected {num_texts} texts.")
+        embeddings[start:start + len(chunk)] = encoder.encode(chunk)
+        start += len(chunk)
+        logger.info(f"Encoded {start}/{num_texts} texts.")
+    if start != num_texts:
+        raise ValueError(f"Expected {num_texts} texts, got {start}.")
+    embeddings.flush()
+    del embeddings
+    os.replace(tmp_path, file_path)
+    return start
+
+
+def embed_artefact(src: str | Path, dst: str | Path, encoder, field: str = "query", chunk_size: int = EMBED_CHUNK_SIZE,
+                   dtype: str = "float32") -> int:
+    """
+    Embed a field of every row of an artefact into a ".npy" file, row i of the array embedding row i of the artefact.
+
+    Args:
+        src: The path of the artefact, JSONL (optionally compressed or sharded), Parquet or Arrow IPC.
+        dst: The path of the ".npy" file.
+        encoder: The encoder, e.g. `DenseEncoder`.
+        field: The field to embed, e.g. "query" or "pos".
+        chunk_size: The number of rows encoded at a time.
+        dtype: The dtype of the stored embeddings, "float32" or "float16".
+
+    Returns:
+        The number of embeddings written.
+    """
+    return write_embeddings(dst, iter_texts(src, field), count_artefact_rows(src), encoder, chunk_size=chunk_size, dtype=dtype)
+
+
+if __name__ == "__main__":
+    from pipeline.export import RUNTIMES, TORCH, load_encoder
+
+    parser = argparse.ArgumentParser(description="Embed a field of an artefact with the BGE-M3 dense encoder.")
+    parser.add_argument("input", type=str, help="The artefact to embed, relative to the artefacts directory or absolute.")
+    parser.add_argument("--output", type=str, default=None, help="The .npy file to write, next to the input by default.")
+    parser.add_argument("--field", choices=["query", "pos"], default="query", help="The field to embed.")
+    parser.add_argument("--model", type=str, default=MODEL_NAME, help="The model name, or the path of a local copy to run offline.")
+    parser.add_argument("--max-length", type=int, default=None, help="The maximum number of tokens of an input, by default 512 for queries and 2048 for passages.")
+    parser.add_argument("--max-tokens", type=int, default=MAX_BATCH_TOKENS, help="The padded tokens budget of a batch.")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--chunk-size", type=int, default=EMBED_CHUNK_SIZE, help="Rows read and sorted by length at a time.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--fp16", action="store_true", help="Run the model in half precision.")
+    parser.add_argument("--runtime", choices=RUNTIMES, default=TORCH, help="The runtime of the encoder, see pipeline.export.")
+    parser.add_argument("--int8", action="store_true", help="Run the int8 model of the onnx runtime.")
+    parser.add_argument("--cache-dir", type=str, default=str(EMBEDDING_CACHE_DIR), help="Directory of the embedding cache, an empty value disables the cache.")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32", help="The dtype of the stored embeddings.")
+    args = parser.parse_args()
+
+    src = Path(args.input) if Path(args.input).is_absolute() else ARTEFACTS_DIR / args.input
+    stem = src.name.split(".")[0]
+    dst = Path(args.output) if args.output else src.with_name(f"{stem}_{args.field}_embeddings.npy")
+    max_length = args.max_length or (QUERY_MAX_LENGTH if args.field == "query" else PASSAGE_MAX_LENGTH)
+
+    encoder = load_encoder(args.runtime, args.model, max_length=max_length, device=args.device, fp16=args.fp16, int8=args.int8,
+                           max_tokens=args.max_tokens, max_batch_size=args.max_batch_size)
+    if args.cache_dir:
+        encoder = CachedEncoder(encoder, EmbeddingCache(args.cache_dir, dim=encoder.dim))
+    start = time.perf_counter()
+    count = embed_artefact(src, dst, encoder, field=args.field, chunk_size=args.chunk_size, dtype=args.dtype)
+    logger.info(f"Embedded {count} rows of {src} into {dst} in {time.perf_counter() - start:.1f}s.")
+    if args.cache_dir:
+        logger.info(encoder.cache.stats())
@@ -0,0 +1,357 @@
+from __future__ import annotations
+
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import unicodedata
+from collections.abc import Iterable
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.constants import ARTEFACTS_DIR
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_DIR = ARTEFACTS_DIR / "embedding_cache"
+# Size of the key of a cached embedding, a 128 bits digest.
+KEY_SIZE = 16
+# The files of a generation of the cache, a compaction writes the next generation then points the metadata at it.
+KEYS_FILE = "keys-{generation:05d}.bin"
+EMBEDDINGS_FILE = "embeddings-{generation:05d}.f16"
+META_FILE = "meta.json"
+LOCK_FILE = "cache.lock"
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a text the way the tokenizer does not tell apart: NFC composed, with runs of whitespace collapsed."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def model_fingerprint(model_name_or_path: str) -> str:
+    """
+    Get the id of a model for the cache keys.
+
+    The files of a local model directory are part of the id, so a model finetuned again into the same directory does not
+    reuse the embeddings of the previous weights.
+
+    Args:
+        model_name_or_path: The model name, or the path of a local copy.
+
+    Returns:
+        The id of the model.
+    """
+    path = Path(model_name_or_path)
+    if not path.is_dir():
+        return str(model_name_or_path)
+    digest = hashlib.sha256()
+    for file_path in sorted(path.rglob("*")):
+        if file_path.is_file():
+            stat = file_path.stat()
+            digest.update(f"{file_path.relative_to(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return f"{path.resolve()}@{digest.hexdigest()[:16]}"
+
+
+def embedding_key(model_id: str, max_length: int, text: str) -> bytes:
+    """
+    Get the content address of an embedding.
+
+    Args:
+        model_id: The id of the model, see `model_fingerprint`.
+        max_length: The maximum number of tokens the text was truncated to.
+        text: The embedded text, normalized with `normalize_text`.
+
+    Returns:
+        The digest identifying the embedding.
+    """
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    for part in (model_id, str(max_length), normalize_text(text)):
+        encoded = part.encode("utf-8")
+        # Length prefixing, so that the parts cannot run into each other.
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.digest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings, keyed by `embedding_key`.
+
+    The embeddings are appended as float16 rows to a file that is read memory mapped, and their keys are appended to a
+    second file in the same order, which is loaded into a key to row dictionary. Rows are written before their keys, so
+    an interrupted append leaves rows without keys, which are dropped on the next sync. Appends are locked, so several
+    processes can share a cache. A compaction writes new files and switches to them by replacing the metadata file.
+
+    Args:
+        cache_dir: The directory holding the cache.
+        dim: The dimension of the embeddings, read from the cache when it exists.
+
+    Example:
+        >>> cache = EmbeddingCache("artefacts/embedding_cache", dim=1024)
+        >>> rows = cache.lookup(keys)
+        >>> cache.append(missing_keys, missing_embeddings)
+    """
+
+    def __init__(self, cache_dir: str | Path = EMBEDDING_CACHE_DIR, dim: int | None = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+        self._rows = {}
+        self._num_rows = 0
+        self._generation = None
+        self._matrix = None
+        with self._lock():
+            if (self.cache_dir / META_FILE).exists():
+                self.dim = self._read_meta()["dim"]
+                if dim is not None and dim != self.dim:
+                    raise ValueError(f"The cache at {self.cache_dir} holds embeddings of dimension {self.dim}, got {dim}.")
+            elif dim is None:
+                raise ValueError(f"No cache at {self.cache_dir}, its embedding dimension must be given.")
+            else:
+                self.dim = dim
+                self._write_meta(0)
+            self._sync()
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float16).itemsize
+
+    def _read_meta(self) -> dict:
+        return json.loads((self.cache_dir / META_FILE).read_text())
+
+    def _write_meta(self, generation: int) -> None:
+        tmp_path = self.cache_dir / f"{META_FILE}.{os.getpid()}.tmp"
+        tmp_path.write_text(json.dumps({"dim": self.dim, "dtype": "float16", "generation": generation}))
+        os.replace(tmp_path, self.cache_dir / META_FILE)
+
+    def _path(self, name: str, generation: int | None = None) -> Path:
+        return self.cache_dir / name.format(generation=self._generation if generation is None else generation)
+
+    @contextmanager
+    def _lock(self):
+        with open(self.cache_dir / LOCK_FILE, "a") as f_:
+            fcntl.flock(f_, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f_, fcntl.LOCK_UN)
+
+    def _sync(self) -> None:
+        # Reading the keys appended since the last sync, by this process or another one.
+        generation = self._read_meta()["generation"]
+        if generation != self._generation:
+            # The cache was compacted, possibly by another process, so its keys are read again.
+            self._rows, self._num_rows, self._generation = {}, 0, generation
+        keys_path = self._path(KEYS_FILE)
+        num_keys = keys_path.stat().st_size // KEY_SIZE if keys_path.exists() else 0
+        if num_keys > self._num_rows:
+            with open(keys_path, "rb") as f_:
+                f_.seek(self._num_rows * KEY_SIZE)
+                data = f_.read((num_keys - self._num_rows) * KEY_SIZE)
+            for row, offset in enumerate(range(0, len(data), KEY_SIZE), start=self._num_rows):
+                self._rows.setdefault(data[offset:offset + KEY_SIZE], row)
+        # Dropping the rows of an interrupted append, which have no keys.
+        embeddings_path = self._path(EMBEDDINGS_FILE)
+        if embeddings_path.exists() and embeddings_path.stat().st_size > num_keys * self.row_bytes:
+            os.truncate(embeddings_path, num_keys * self.row_bytes)
+        self._num_rows = num_keys
+        # Mapping the rows right away, so they stay readable if another process compacts the cache in the meantime.
+        self._matrix = np.memmap(embeddings_path, dtype=np.float16, mode="r", shape=(num_keys, self.dim)) if num_keys else None
+
+    def _embeddings(self) -> np.ndarray:
+        return self._matrix if self._matrix is not None else np.empty((0, self.dim), dtype=np.float16)
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self._rows
+
+    def lookup(self, keys: list[bytes]) -> np.ndarray:
+        """
+        Find the rows of cached embeddings, counting the hits and misses.
+
+        Args:
+            keys: The keys of the embeddings.
+
+        Returns:
+            The row of every key, -1 for the keys that are not cached.
+        """
+        rows = np.fromiter((self._rows.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+        hits = int((rows >= 0).sum())
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return rows
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        """Get the cached embeddings of rows found by `lookup`, as float32."""
+        return np.asarray(self._embeddings()[np.asarray(rows)], dtype=np.float32)
+
+    def append(self, keys: list[bytes], embeddings: np.ndarray) -> None:
+        """
+        Cache embeddings, skipping the keys that are already cached.
+
+        Args:
+            keys: The keys of the embeddings.
+            embeddings: The embeddings, shaped (len(keys), dim), stored as float16.
+        """
+        with self._lock():
+            self._sync()
+            new = {}
+            for idx, key in enumerate(keys):
+                if key not in self._rows:
+                    new.setdefault(key, idx)
+            if not new:
+                return
+            rows = np.ascontiguousarray(np.asarray(embeddings)[list(new.values())], dtype=np.float16)
+            with open(self._path(EMBEDDINGS_FILE), "ab") as f_:
+                f_.write(rows.tobytes())
+                f_.flush()
+                os.fsync(f_.fileno())
+            with open(self._path(KEYS_FILE), "ab") as f_:
+                f_.write(b"".join(new))
+            self._sync()
+
+    def compact(self, keep: Iterable[bytes] | None = None) -> int:
+        """
+        Rewrite the cache without the embeddings that are not kept, e.g. those of texts no longer in any dataset.
+
+        Args:
+            keep: The keys to keep, all of them when None, which only drops the duplicated keys of concurrent appends.
+
+        Returns:
+            The number of embeddings removed.
+        """
+        with self._lock():
+            self._sync()
+            keys = list(self._rows) if keep is None else [key for key in dict.fromkeys(keep) if key in self._rows]
+            rows = np.array([self._rows[key] for key in keys], dtype=np.int64)
+            removed = self._num_rows - len(rows)
+            embeddings = np.asarray(self._embeddings()[np.sort(rows)]) if len(rows) else np.empty((0, self.dim), dtype=np.float16)
+            keys = [keys[idx] for idx in np.argsort(rows, kind="stable")]
+
+            # Writing the next generation, then switching to it at once by replacing the metadata.
+            previous, generation = self._generation, self._generation + 1
+            self._path(EMBEDDINGS_FILE, generation).write_bytes(embeddings.tobytes())
+            self._path(KEYS_FILE, generation).write_bytes(b"".join(keys))
+            self._write_meta(generation)
+            # Processes still reading the previous generation keep their open memory maps.
+            self._path(EMBEDDINGS_FILE, previous).unlink(missing_ok=True)
+            self._path(KEYS_FILE, previous).unlink(missing_ok=True)
+            self._sync()
+        return removed
+
+    def stats(self) -> str:
+        """Get a summary of the cache usage."""
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        size = len(self) * (self.row_bytes + KEY_SIZE)
+        return f"Embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {len(self)} embeddings, {size / 1024 ** 2:.1f} MiB."
+
+
+class CachedEncoder:
+    """
+    Encoder that only runs the wrapped encoder on the texts whose embeddings are not cached.
+
+    The embeddings are returned as stored, rounded to float16, whether they were cached or not, so results do not depend
+    on the state of the cache.
+
+    Args:
+        encoder: The encoder, e.g. `DenseEncoder`.
+        cache: The embedding cache.
+        model_id: The id of the model in the keys, the `model_id` of the encoder by default, or else the
+            `model_fingerprint` of its model.
+
+    Example:
+        >>> encoder = CachedEncoder(DenseEncoder("./bge-finetuned"), EmbeddingCache(dim=1024))
+        >>> embeddings = encoder.encode(texts)
+    """
+
+    def __init__(self, encoder, cache: EmbeddingCache, model_id: str | None = None):
+        self.encoder = encoder
+        self.cache = cache
+        self.model_id = model_id or getattr(encoder, "model_id", None) or model_fingerprint(encoder.model_name_or_path)
+
+    @property
+    def dim(self) -> int:
+        return self.encoder.dim
+
+    @property
+    def max_length(self) -> int:
+        return self.encoder.max_length
+
+    def keys(self, texts: list[str], max_length: int | None = None) -> list[bytes]:
+        """Get the cache keys of texts encoded with a maximum length, the one of the encoder when None."""
+        max_length = max_length or self.encoder.max_length
+        return [embedding_key(self.model_id, max_length, text) for text in texts]
+
+    def encode(self, texts: list[str], max_length: int | None = None) -> np.ndarray:
+        """
+        Encode texts, reading the cached embeddings and caching the new ones.
+
+        Args:
+            texts: The texts to encode.
+            max_length: The maximum number of tokens of a text, the one of the encoder when None.
+
+        Returns:
+            The embeddings, shaped (len(texts), dim) in the order of `texts`.
+        """
+        keys = self.keys(texts, max_length)
+        rows = self.cache.lookup(keys)
+        embeddings = np.empty((len(texts), self.dim), dtype=np.float32)
+        hits = np.flatnonzero(rows >= 0)
+        embeddings[hits] = self.cache.get(rows[hits])
+
+        misses = np.flatnonzero(rows < 0)
+        if len(misses):
+            # Texts repeated within the batch, such as documents shared by several rows, are encoded once.
+            first_idxs = {}
+            for idx in misses.tolist():
+                first_idxs.setdefault(keys[idx], idx)
+            unique_idxs = list(first_idxs.values())
+            new = self.encoder.encode([texts[idx] for idx in unique_idxs], max_length=max_length).astype(np.float16)
+            self.cache.append([keys[idx] for idx in unique_idxs], new)
+            positions = {key: position for position, key in enumerate(first_idxs)}
+            embeddings[misses] = new[[positions[keys[idx]] for idx in misses.tolist()]]
+        return embeddings
+
+
+if __name__ == "__main__":
+    from pipeline.data.utils import load_artefact
+    from pipeline.embed import MODEL_NAME, PASSAGE_MAX_LENGTH, QUERY_MAX_LENGTH
+    from pipeline.eval import build_corpus
+    from pipeline.export import RUNTIMES, TORCH, encoder_model_id
+
+    parser = argparse.ArgumentParser(description="Inspect or compact an embedding cache.")
+    parser.add_argument("command", choices=["stats", "compact"])
+    parser.add_argument("--cache-dir", type=str, default=str(EMBEDDING_CACHE_DIR))
+    parser.add_argument("--keep", nargs="*", default=None, help="Artefacts whose queries and documents are kept when compacting, all embeddings are kept when omitted.")
+    parser.add_argument("--model", type=str, default=MODEL_NAME, help="The model whose embeddings of the artefacts are kept.")
+    parser.add_argument("--max-length", type=int, default=None, help="The maximum number of tokens the texts were embedded with, by default 512 for queries and 2048 for passages.")
+    parser.add_argument("--fp16", action="store_true", help="Keep the embeddings of the model run in half precision.")
+    parser.add_argument("--runtime", choices=RUNTIMES, default=TORCH, help="The runtime of the encoder, see pipeline.export.")
+    parser.add_argument("--int8", action="store_true", help="Keep the embeddings of the int8 model of the onnx runtime.")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.cache_dir)
+    if args.command == "compact":
+        keep = None
+        if args.keep is not None:
+            model_id = encoder_model_id(args.runtime, args.model, fp16=args.fp16, int8=args.int8)
+            query_max_length = args.max_length or QUERY_MAX_LENGTH
+            passage_max_length = args.max_length or PASSAGE_MAX_LENGTH
+            keep = []
+            for key in args.keep:
+                rows = load_artefact(key)
+                keep += [embedding_key(model_id, query_max_length, row["query"]) for row in rows]
+                keep += [embedding_key(model_id, passage_max_length, doc) for doc in build_corpus([rows])[0]]
+        logger.info(f"Removed {cache.compact(keep)} embeddings.")
+    logger.info(cache.stats())
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections.abc import Callable, Sequence
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.constants import ARTEFACTS_DIR
+from pipeline.data.enums import DataSplit, Language
+from pipeline.data.translate import TRANSLATED_LANGUAGES
+from pipeline.data.utils import find_artefact, load_artefact
+from pipeline.embed import MODEL_NAME, PASSAGE_MAX_LENGTH, QUERY_MAX_LENGTH
+from pipeline.embed_cache import EMBEDDING_CACHE_DIR, CachedEncoder, EmbeddingCache
+from pipeline.export import RUNTIMES, TORCH, load_encoder
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EVAL_DIR = ARTEFACTS_DIR / "eval"
+K_VALUES = [1, 5, 10, 100]
+# Queries and documents scored at a time, a tile of scores takes QUERY_TILE_SIZE * DOC_TILE_SIZE * 4 bytes.
+QUERY_TILE_SIZE = 1024
+DOC_TILE_SIZE = 1 << 14
+NATIVE = "native"
+CROSS_LINGUAL = "cross_lingual"
+
+
+def dot_scores(query_tile: np.ndarray, doc_tile: np.ndarray) -> np.ndarray:
+    """Score a tile of queries against a tile of documents by dot product, in float32."""
+    return np.asarray(query_tile, dtype=np.float32) @ np.asarray(doc_tile, dtype=np.float32).T
+
+
+def tiled_top_k(queries: np.ndarray, docs: np.ndarray, k: int, query_tile_size: int = QUERY_TILE_SIZE,
+                doc_tile_size: int = DOC_TILE_SIZE,
+                score_fn: Callable[[np.ndarray, np.ndarray], np.ndarray] = dot_scores) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the documents with the highest dot products with every query, without building the full score matrix.
+
+    Queries and documents are scored a tile at a time. The top k of every tile is selected with `argpartition` and
+    merged with the running top k, so the memory used is bounded by the tile sizes whatever the size of the corpus.
+
+    Args:
+        queries: The query embeddings, shaped (num_queries, dim).
+        docs: The document embeddings, shaped (num_docs, dim), e.g. a memory mapped ".npy" file.
+        k: The number of documents to retrieve per query, capped at the number of documents.
+        query_tile_size: The number of queries scored at a time.
+        doc_tile_size: The number of documents scored at a time.
+        score_fn: The function scoring a tile of queries against a tile of documents, e.g. of quantized embeddings.
+
+    Returns:
+        The scores and the indices of the top k documents of every query, from the highest score.
+    """
+    k = min(k, len(docs))
+    top_scores = np.empty((len(queries), k), dtype=np.float32)
+    top_idxs = np.empty((len(queries), k), dtype=np.int64)
+    for query_start in range(0, len(queries), query_tile_size):
+        query_tile = queries[query_start:query_start + query_tile_size]
+        best_scores = np.empty((len(query_tile), 0), dtype=np.float32)
+        best_idxs = np.empty((len(query_tile), 0), dtype=np.int64)
+        for doc_start in range(0, len(docs), doc_tile_size):
+            doc_tile = docs[doc_start:doc_start + doc_tile_size]
+            scores = np.concatenate([best_scores, score_fn(query_tile, doc_tile)], axis=1)
+            idxs = np.concatenate([best_idxs, np.broadcast_to(np.arange(doc_start, doc_start + len(doc_tile)), (len(query_tile), len(doc_tile)))], axis=1)
+            if scores.shape[1] > k:
+                kept = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores, idxs = np.take_along_axis(scores, kept, axis=1), np.take_along_axis(idxs, kept, axis=1)
+            best_scores, best_idxs = scores, idxs
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        top_scores[query_start:query_start + len(query_tile)] = np.take_along_axis(best_scores, order, axis=1)
+        top_idxs[query_start:query_start + len(query_tile)] = np.take_along_axis(best_idxs, order, axis=1)
+    return top_scores, top_idxs
+
+
+def retrieval_metrics(top_idxs: np.ndarray, relevant: np.ndarray, ks: Sequence[int] = K_VALUES) -> dict[str, float]:
+    """
+    Compute Recall@k, nDCG@k and MRR from the retrieved documents of every query, with binary relevance.
+
+    Args:
+        top_idxs: The indices of the retrieved documents of every query, from the highest score.
+        relevant: The indices of the relevant documents of every query, padded with -1, shaped (num_queries, max_relevant).
+        ks: The cutoffs of the metrics. MRR is computed over all the retrieved documents.
+
+    Returns:
+        The metrics averaged over the queries, e.g. {"recall@10": ..., "ndcg@10": ..., "mrr": ...}.
+    """
+    relevant = np.asarray(relevant, dtype=np.int64).reshape(len(top_idxs), -1)
+    hits = (top_idxs[:, :, None] == relevant[:, None, :]).any(axis=2)
+    num_relevant = np.maximum((relevant >= 0).sum(axis=1), 1)
+    discounts = 1 / np.log2(np.arange(2, hits.shape[1] + 2))
+
+    metrics = {}
+    for k in ks:
+        k_hits = hits[:, :k]
+        metrics[f"recall@{k}"] = float((k_hits.sum(axis=1) / num_relevant).mean())
+        dcg = (k_hits * discounts[:k_hits.shape[1]]).sum(axis=1)
+        ideal_dcg = np.cumsum(discounts[:k_hits.shape[1]])[np.minimum(num_relevant, k_hits.shape[1]) - 1]
+        metrics[f"ndcg@{k}"] = float((dcg / ideal_dcg).mean())
+    first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, np.inf)
+    metrics["mrr"] = float((1 / first_hit).mean())
+    return metrics
+
+
+def _texts(value) -> list[str]:
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple, np.ndarray)) else [value]
+
+
+def build_corpus(rows_groups: Sequence[Sequence[dict]]) -> tuple[list[str], dict[str, int]]:
+    """
+    Gather the distinct positive and negative documents of the rows into a corpus.
+
+    Args:
+        rows_groups: The groups of rows whose documents make up the corpus, e.g. the native and English rows of a language.
+
+    Returns:
+        The documents, and the index of every document in the corpus.
+    """
+    doc_idxs = {}
+    for rows in rows_groups:
+        for row in rows:
+            for doc in _texts(row.get("pos")) + _texts(row.get("neg")):
+                doc_idxs.setdefault(doc, len(doc_idxs))
+    return list(doc_idxs), doc_idxs
+
+
+def relevant_docs(rows: Sequence[dict], doc_idxs: dict[str, int]) -> np.ndarray:
+    """Get the corpus indices of the positive documents of every row, padded with -1."""
+    positives = [[doc_idxs[doc] for doc in _texts(row.get("pos"))] for row in rows]
+    relevant = np.full((len(rows), max((len(docs) for docs in positives), default=1) or 1), -1, dtype=np.int64)
+    for row_idx, docs in enumerate(positives):
+        relevant[row_idx, :len(docs)] = docs
+    return relevant
+
+
+def evaluate(queries: list[str], relevant: np.ndarray, doc_embeddings: np.ndarray, encoder, ks: Sequence[int] = K_VALUES,
+             query_tile_size: int = QUERY_TILE_SIZE, doc_tile_size: int = DOC_TILE_SIZE) -> dict[str, float]:
+    """
+    Embed the queries, retrieve their top documents and score them.
+
+    Args:
+        queries: The query texts.
+        relevant: The relevant documents of every query, see `relevant_docs`.
+        doc_embeddings: The embeddings of the corpus.
+        encoder: The encoder, e.g. `DenseEncoder`.
+        ks: The cutoffs of the metrics.
+        query_tile_size: The number of queries scored at a time.
+        doc_tile_size: The number of documents scored at a time.
+
+    Returns:
+        The metrics, see `retrieval_metrics`.
+    """
+    query_embeddings = encoder.encode(queries, max_length=QUERY_MAX_LENGTH)
+    _, top_idxs = tiled_top_k(query_embeddings, doc_embeddings, max(ks), query_tile_size, doc_tile_size)
+    return retrieval_metrics(top_idxs, relevant, ks)
+
+
+def load_split(language: str, split: str) -> Sequence[dict]:
+    """Load the filtered dataset of a language and split, see `find_artefact`."""
+    return load_artefact(find_artefact(f"filtered_{language}_{split}_dataset"))
+
+
+def evaluate_language(language: str, split: str, encoder, english_rows: Sequence[dict] | None = None,
+                      ks: Sequence[int] = K_VALUES, query_tile_size: int = QUERY_TILE_SIZE,
+                      doc_tile_size: int = DOC_TILE_SIZE) -> dict[str, dict]:
+    """
+    Evaluate the retrieval of the documents of a language, by its native queries and by the English translations of its queries.
+
+    The corpus is made of the documents of the native rows and of the English rows translated from the language, so the
+    documents of both runs are retrieved among the same candidates.
+
+    Args:
+        language: The language of the documents.
+        split: The split of the datasets, e.g. "test".
+        encoder: The encoder, e.g. `DenseEncoder`.
+        english_rows: The rows of the English dataset of the split, the cross-lingual run is skipped when None.
+        ks: The cutoffs of the metrics.
+        query_tile_size: The number of queries scored at a time.
+        doc_tile_size: The number of documents scored at a time.
+
+    Returns:
+        The report of every run, e.g. {"native": {"queries": ..., "docs": ..., "recall@10": ...}, "cross_lingual": {...}}.
+    """
+    rows = load_split(language, split)
+    cross_rows = [row for row in english_rows if row["root_query_language"] == language] if english_rows is not None else []
+    docs, doc_idxs = build_corpus([rows, cross_rows])
+    logger.info(f"Embedding {len(docs)} {language} {split} documents.")
+    doc_embeddings = encoder.encode(docs, max_length=PASSAGE_MAX_LENGTH)
+
+    runs = {NATIVE: rows}
+    if cross_rows:
+        runs[CROSS_LINGUAL] = cross_rows
+    report = {}
+    for run, run_rows in runs.items():
+        metrics = evaluate([row["query"] for row in run_rows], relevant_docs(run_rows, doc_idxs), doc_embeddings, encoder, ks,
+                           query_tile_size, doc_tile_size)
+        report[run] = {"queries": len(run_rows), "docs": len(docs), **metrics}
+        logger.info(f"{language} {run}: " + ", ".join(f"{name}={value:.4f}" for name, value in metrics.items()))
+    return report
+
+
+def format_report(report: dict[str, dict[str, dict]]) -> str:
+    """Format a report as a Markdown table, a line per language and run."""
+    metric_names = [name for name in next(iter(next(iter(report.values())).values())) if name not in {"queries", "docs"}]
+    lines = ["| language | run | queries | docs | " + " | ".join(metric_names) + " |",
+             "|" + " --- |" * (4 + len(metric_names))]
+    for language, runs in report.items():
+        for run, metrics in runs.items():
+            values = " | ".join(f"{metrics[name]:.4f}" for name in metric_names)
+            lines.append(f"| {language} | {run} | {metrics['queries']} | {metrics['docs']} | {values} |")
+    return "\n".join(lines)
+
+
+def write_report(file_path: str | Path, report: dict, table: str | None = None) -> None:
+    """Write a report as JSON, next to a Markdown table of it, see `format_report` by default."""
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(report, indent=2))
+    os.replace(tmp_path, file_path)
+    file_path.with_suffix(".md").write_text((table if table is not None else format_report(report)) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the retrieval of the filtered eval/test datasets with the BGE-M3 dense encoder.")
+    parser.add_argument("--model", type=str, default=MODEL_NAME, help="The model name, or the path of a local copy to run offline.")
+    parser.add_argument("--split", choices=[DataSplit.eval, DataSplit.test], default=DataSplit.test, type=str.lower)
+    parser.add_argument("--languages", nargs="+", choices=TRANSLATED_LANGUAGES, default=TRANSLATED_LANGUAGES, type=str.lower)
+    parser.add_argument("--no-cross-lingual", action="store_true", help="Skip the English queries.")
+    parser.add_argument("--ks", nargs="+", type=int, default=K_VALUES, help="The cutoffs of Recall@k and nDCG@k.")
+    parser.add_argument("--query-tile-size", type=int, default=QUERY_TILE_SIZE)
+    parser.add_argument("--doc-tile-size", type=int, default=DOC_TILE_SIZE)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--fp16", action="store_true", help="Run the model in half precision.")
+    parser.add_argument("--runtime", choices=RUNTIMES, default=TORCH, help="The runtime of the encoder, see pipeline.export.")
+    parser.add_argument("--int8", action="store_true", help="Run the int8 model of the onnx runtime.")
+    parser.add_argument("--cache-dir", type=str, default=str(EMBEDDING_CACHE_DIR), help="Directory of the embedding cache, an empty value disables the cache.")
+    parser.add_argument("--output", type=str, default=None, help="The JSON report to write, in artefacts/eval by default.")
+    args = parser.parse_args()
+
+    encoder = load_encoder(args.runtime, args.model, device=args.device, fp16=args.fp16, int8=args.int8)
+    if args.cache_dir:
+        encoder = CachedEncoder(encoder, EmbeddingCache(args.cache_dir, dim=encoder.dim))
+    english_rows = None if args.no_cross_lingual else load_split(Language.english, args.split)
+
+    start = time.perf_counter()
+    report = {
+        language: evaluate_language(language, args.split, encoder, english_rows, args.ks, args.query_tile_size, args.doc_tile_size)
+        for language in args.languages
+    }
+    model_name = Path(args.model).name if Path(args.model).is_dir() else args.model.replace("/", "_")
+    output = Path(args.output) if args.output else EVAL_DIR / f"{model_name}_{args.split}_report.json"
+    write_report(output, report)
+    logger.info(f"Evaluated in {time.perf_counter() - start:.1f}s, report saved to {output}.\n{format_report(report)}")
+    if args.cache_dir:
+        logger.info(encoder.cache.stats())
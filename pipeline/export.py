@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.embed import MAX_BATCH_SIZE, MAX_BATCH_TOKENS, MODEL_NAME, PASSAGE_MAX_LENGTH, DenseEncoder
+from pipeline.embed_cache import model_fingerprint
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TORCH = "torch"
+TORCH_INT8 = "torch-int8"
+ONNX = "onnx"
+RUNTIMES = [TORCH, TORCH_INT8, ONNX]
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+ONNX_OPSET = 17
+# The lowest cosine similarity with the reference embeddings an exported encoder may have, per text.
+PARITY_MIN_COSINE = {ONNX: 0.9999, TORCH_INT8: 0.98}
+# Texts the parity is checked on when none are given, short and long ones in the three languages.
+PARITY_TEXTS = [
+    "Eyi jẹ́ gbolohun àpẹẹrẹ",
+    "Nke a bụ nkebisiokwu atụ",
+    "Wannan jimla ce ta misali",
+    "Where is the example?",
+    " ".join(["Ìlú Èkó jẹ́ ìlú tí ó tóbi jùlọ ní orílẹ̀-èdè Nàìjíríà."] * 60),
+    " ".join(["Kano birni ne mafi girma a arewacin Najeriya."] * 60),
+]
+
+
+def _dense_module(model):
+    # The encoder as exported: the normalized CLS vector of the last hidden states, as the model was finetuned with
+    # --sentence_pooling_method cls --normalize_embeddings True.
+    import torch
+
+    class DenseModule(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            cls = self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0]
+            return torch.nn.functional.normalize(cls, dim=-1)
+
+    return DenseModule(model).eval()
+
+
+def export_onnx(model_name_or_path: str, output_dir: str | Path, int8: bool = False, opset: int = ONNX_OPSET) -> Path:
+    """
+    Export the dense encoder to ONNX, its output being the normalized CLS embeddings.
+
+    The tokenizer is saved next to the model, so the directory is all `OnnxEncoder` needs. Weights past the 2 GB limit of
+    ONNX files are stored as external data next to the model.
+
+    Args:
+        model_name_or_path: The model name, or the path of a local checkpoint, which is loaded without network access.
+        output_dir: The directory to export into.
+        int8: Whether to also write a dynamically quantized int8 model, with onnxruntime.
+        opset: The ONNX opset.
+
+    Returns:
+        The path of the exported model, the int8 one when `int8` is set.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    local_files_only = Path(model_name_or_path).is_dir()
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, local_files_only=local_files_only)
+    model = AutoModel.from_pretrained(model_name_or_path, local_files_only=local_files_only, torch_dtype=torch.float32)
+    tokenizer.save_pretrained(output_dir)
+    model.config.save_pretrained(output_dir)
+
+    example = tokenizer(PARITY_TEXTS[:2], padding=True, return_tensors="pt")
+    onnx_path = output_dir / ONNX_FILE
+    with torch.no_grad():
+        torch.onnx.export(
+            _dense_module(model), (example["input_ids"], example["attention_mask"]), str(onnx_path),
+            input_names=["input_ids", "attention_mask"], output_names=["embeddings"], opset_version=opset,
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+                          "embeddings": {0: "batch"}},
+        )
+    # Recording the checkpoint the export comes from, as part of the id of its embeddings.
+    (output_dir / "export.json").write_text(json.dumps({"source": model_fingerprint(model_name_or_path), "opset": opset}))
+    logger.info(f"Exported {model_name_or_path} to {onnx_path}.")
+    if not int8:
+        return onnx_path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    int8_path = output_dir / ONNX_INT8_FILE
+    quantize_dynamic(str(onnx_path), str(int8_path), weight_type=QuantType.QInt8)
+    logger.info(f"Quantized {onnx_path} to {int8_path}.")
+    return int8_path
+
+
+class OnnxEncoder(DenseEncoder):
+    """
+    `DenseEncoder` running a model exported by `export_onnx` with onnxruntime on CPU, with the same `encode` contract.
+
+    Example:
+        >>> encoder = OnnxEncoder("./bge-finetuned-onnx", int8=True)
+        >>> embeddings = encoder.encode(["Eyi jẹ́ gbolohun àpẹẹrẹ", "Wannan jimla ce ta misali"])
+    """
+
+    def __init__(self, model_dir: str | Path, max_length: int = PASSAGE_MAX_LENGTH, int8: bool = False,
+                 num_threads: int | None = None, max_tokens: int = MAX_BATCH_TOKENS, max_batch_size: int = MAX_BATCH_SIZE):
+        self.int8 = int8
+        self.num_threads = num_threads
+        super().__init__(model_dir, max_length=max_length, device="cpu", max_tokens=max_tokens, max_batch_size=max_batch_size)
+
+    @property
+    def model_path(self) -> Path:
+        return Path(self.model_name_or_path) / (ONNX_INT8_FILE if self.int8 else ONNX_FILE)
+
+    def load_model(self) -> None:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = self.num_threads or os.cpu_count() or 1
+        self.session = onnxruntime.InferenceSession(str(self.model_path), options, providers=["CPUExecutionProvider"])
+
+    @property
+    def dim(self) -> int:
+        return self.session.get_outputs()[0].shape[-1]
+
+    @property
+    def model_id(self) -> str:
+        return encoder_model_id(ONNX, self.model_name_or_path, int8=self.int8)
+
+    def encode_batch(self, input_ids: list[list[int]]) -> np.ndarray:
+        batch = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="np")
+        inputs = {"input_ids": batch["input_ids"].astype(np.int64), "attention_mask": batch["attention_mask"].astype(np.int64)}
+        return self.session.run(["embeddings"], inputs)[0].astype(np.float32)
+
+
+class TorchInt8Encoder(DenseEncoder):
+    """
+    `DenseEncoder` whose linear layers are dynamically quantized to int8 by torch, for CPU inference.
+
+    Example:
+        >>> encoder = TorchInt8Encoder("./bge-finetuned")
+        >>> embeddings = encoder.encode(["Eyi jẹ́ gbolohun àpẹẹrẹ", "Wannan jimla ce ta misali"])
+    """
+
+    def __init__(self, model_name_or_path: str = MODEL_NAME, max_length: int = PASSAGE_MAX_LENGTH,
+                 max_tokens: int = MAX_BATCH_TOKENS, max_batch_size: int = MAX_BATCH_SIZE):
+        super().__init__(model_name_or_path, max_length=max_length, device="cpu", max_tokens=max_tokens,
+                         max_batch_size=max_batch_size)
+
+    def load_model(self) -> None:
+        super().load_model()
+        self.model = self.torch.ao.quantization.quantize_dynamic(self.model, {self.torch.nn.Linear}, dtype=self.torch.qint8)
+
+    @property
+    def model_id(self) -> str:
+        return encoder_model_id(TORCH_INT8, self.model_name_or_path)
+
+
+def encoder_model_id(runtime: str, model_name_or_path: str = MODEL_NAME, fp16: bool = False, int8: bool = False) -> str:
+    """
+    Get the id the encoder of a runtime stores its embeddings under in an `EmbeddingCache`, without loading the model.
+
+    Args:
+        runtime: "torch", "torch-int8" or "onnx".
+        model_name_or_path: The model, or the directory exported by `export_onnx` for the "onnx" runtime.
+        fp16: Whether the "torch" runtime runs in half precision.
+        int8: Whether the int8 model of the "onnx" runtime runs.
+
+    Returns:
+        The `model_id` of the encoder `load_encoder` loads with the same arguments.
+    """
+    if runtime == TORCH:
+        return model_fingerprint(model_name_or_path) + ("+fp16" if fp16 else "")
+    elif runtime == TORCH_INT8:
+        return model_fingerprint(model_name_or_path) + f"+{TORCH_INT8}"
+    elif runtime == ONNX:
+        return model_fingerprint(model_name_or_path) + f"+{ONNX}" + ("+int8" if int8 else "")
+    raise ValueError(f"Unsupported runtime: {runtime}. Supported runtimes are {RUNTIMES}.")
+
+
+def load_encoder(runtime: str, model_name_or_path: str = MODEL_NAME, max_length: int = PASSAGE_MAX_LENGTH,
+                 device: str = "cpu", fp16: bool = False, int8: bool = False, **kwargs) -> DenseEncoder:
+    """
+    Load the dense encoder of a runtime.
+
+    Args:
+        runtime: "torch", "torch-int8" or "onnx".
+        model_name_or_path: The model, or the directory exported by `export_onnx` for the "onnx" runtime.
+        max_length: The maximum number of tokens of an input.
+        device: The device of the "torch" runtime, the others run on CPU.
+        fp16: Whether to run the "torch" runtime in half precision.
+        int8: Whether to run the int8 model of the "onnx" runtime.
+        kwargs: The batching arguments of `DenseEncoder`.
+
+    Returns:
+        The encoder.
+    """
+    if runtime == TORCH:
+        return DenseEncoder(model_name_or_path, max_length=max_length, device=device, fp16=fp16, **kwargs)
+    elif runtime == TORCH_INT8:
+        return TorchInt8Encoder(model_name_or_path, max_length=max_length, **kwargs)
+    elif runtime == ONNX:
+        return OnnxEncoder(model_name_or_path, max_length=max_length, int8=int8, **kwargs)
+    raise ValueError(f"Unsupported runtime: {runtime}. Supported runtimes are {RUNTIMES}.")
+
+
+def cosine_parity(reference: np.ndarray, candidate: np.ndarray) -> np.ndarray:
+    """Get the cosine similarity of every pair of reference and candidate embeddings."""
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    return (reference * candidate).sum(axis=1) / np.maximum(norms, 1e-12)
+
+
+def parity_check(reference, candidate, texts: list[str] = PARITY_TEXTS, min_cosine: float = PARITY_MIN_COSINE[TORCH_INT8]) -> dict:
+    """
+    Compare the embeddings of an exported encoder with those of the reference encoder.
+
+    Args:
+        reference: The reference encoder, e.g. `DenseEncoder`.
+        candidate: The exported encoder, e.g. `OnnxEncoder`.
+        texts: The texts to embed.
+        min_cosine: The lowest cosine similarity a text may have for the check to pass.
+
+    Returns:
+        The lowest and mean cosine similarities, the encoding times and whether the check passed.
+    """
+    start = time.perf_counter()
+    reference_embeddings = reference.encode(texts)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    candidate_embeddings = candidate.encode(texts)
+    candidate_seconds = time.perf_counter() - start
+
+    cosines = cosine_parity(reference_embeddings, candidate_embeddings)
+    return {"min_cosine": float(cosines.min()), "mean_cosine": float(cosines.mean()), "reference_seconds": reference_seconds,
+            "candidate_seconds": candidate_seconds, "passed": bool(cosines.min() >= min_cosine)}
+
+
+if __name__ == "__main__":
+    from pipeline.data.utils import load_artefact
+
+    parser = argparse.ArgumentParser(description="Export the dense encoder for CPU inference, and check it against the reference model.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    onnx_parser = subparsers.add_parser("onnx", help="Export the encoder to ONNX.")
+    onnx_parser.add_argument("--model", type=str, default=MODEL_NAME, help="The model name, or the path of a local checkpoint to run offline.")
+    onnx_parser.add_argument("--output", type=str, required=True, help="The directory to export into.")
+    onnx_parser.add_argument("--int8", action="store_true", help="Also write a dynamically quantized int8 model.")
+    parity_parser = subparsers.add_parser("parity", help="Compare the embeddings of a runtime with the reference torch model.")
+    parity_parser.add_argument("--model", type=str, default=MODEL_NAME, help="The reference model name, or the path of a local checkpoint.")
+    parity_parser.add_argument("--runtime", choices=[TORCH_INT8, ONNX], default=ONNX)
+    parity_parser.add_argument("--onnx-dir", type=str, default=None, help="The directory exported by the onnx command.")
+    parity_parser.add_argument("--int8", action="store_true", help="Check the int8 ONNX model.")
+    parity_parser.add_argument("--texts", type=str, default=None, help="An artefact whose queries and documents are embedded, the built-in texts by default.")
+    parity_parser.add_argument("--num-texts", type=int, default=64)
+    args = parser.parse_args()
+
+    if args.command == "onnx":
+        export_onnx(args.model, args.output, int8=args.int8)
+    else:
+        texts = PARITY_TEXTS
+        if args.texts:
+            rows = load_artefact(args.texts)
+            rows = [rows[idx] for idx in range(min(len(rows), args.num_texts // 2))]
+            texts = [row["query"] for row in rows] + [row["pos"][0] if isinstance(row["pos"], list) else row["pos"] for row in rows]
+        if args.runtime == ONNX and not args.onnx_dir:
+            parser.error("--onnx-dir is required to check the onnx runtime.")
+        reference = DenseEncoder(args.model)
+        if args.runtime == ONNX:
+            candidate = load_encoder(ONNX, args.onnx_dir, int8=args.int8)
+            min_cosine = PARITY_MIN_COSINE[TORCH_INT8] if args.int8 else PARITY_MIN_COSINE[ONNX]
+        else:
+            candidate = load_encoder(TORCH_INT8, args.model)
+            min_cosine = PARITY_MIN_COSINE[TORCH_INT8]
+        result = parity_check(reference, candidate, texts, min_cosine)
+        logger.info(", ".join(f"{name}={value:.4f}" if isinstance(value, float) else f"{name}={value}" for name, value in result.items()))
+        if not result["passed"]:
+            raise SystemExit(1)
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.constants import SEED
+from pipeline.eval import tiled_top_k
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Vectors sampled per list to train the coarse quantizer, more barely moves the centroids.
+TRAIN_VECTORS_PER_LIST = 256
+KMEANS_ITERATIONS = 20
+# Vectors assigned to their nearest centroid at a time.
+ASSIGN_CHUNK_SIZE = 1 << 15
+# Vectors copied into their list at a time when building an index.
+REORDER_CHUNK_SIZE = 1 << 15
+DEFAULT_NPROBE = 16
+NPROBE_VALUES = [1, 4, 16, 64]
+INDEX_FILES = ["centroids.npy", "vectors.npy", "ids.npy", "offsets.npy"]
+META_FILE = "index.json"
+
+
+def default_nlist(num_vectors: int) -> int:
+    """Get the number of inverted lists of an index, about 4 * sqrt(num_vectors)."""
+    return max(1, min(num_vectors, int(4 * np.sqrt(num_vectors))))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = ASSIGN_CHUNK_SIZE) -> np.ndarray:
+    """Get the centroid with the highest inner product with every vector, a chunk of vectors at a time."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + len(chunk)] = (chunk @ centroids.T).argmax(axis=1)
+    return assignments
+
+
+def take_rows(vectors: np.ndarray, idxs: np.ndarray, out: np.ndarray, chunk_size: int = REORDER_CHUNK_SIZE) -> np.ndarray:
+    """Gather rows of the vectors into `out`, e.g. a memory mapped file, a chunk at a time so only a chunk is held in memory."""
+    for start in range(0, len(idxs), chunk_size):
+        out[start:start + chunk_size] = vectors[idxs[start:start + chunk_size]]
+    return out
+
+
+def replace_dir(tmp_path: str | Path, path: str | Path) -> None:
+    """
+    Move a fully written directory to its final path, replacing the directory there.
+
+    A directory cannot be renamed over a non-empty one, so the old directory is renamed out of the way first and removed
+    last. The path is missing for a moment in between, but it never holds a partly written directory.
+
+    Args:
+        tmp_path: The written directory.
+        path: The final path.
+    """
+    path = Path(path)
+    old_path = path.with_name(f"{path.name}.{os.getpid()}.old")
+    if path.exists():
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, num_iterations: int = KMEANS_ITERATIONS, seed: int = SEED) -> np.ndarray:
+    """
+    Train the coarse quantizer of an index with spherical k-means, on a sample of the vectors.
+
+    The centroids are normalized, as the embeddings are, so vectors are assigned by inner product. Lists left empty by an
+    iteration are moved onto random vectors of the sample.
+
+    Args:
+        vectors: The vectors, shaped (num_vectors, dim).
+        nlist: The number of centroids.
+        num_iterations: The number of k-means iterations.
+        seed: The seed of the sample and of the initial centroids.
+
+    Returns:
+        The centroids, shaped (nlist, dim).
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * TRAIN_VECTORS_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(num_iterations):
+        assignments = nearest_centroids(sample, centroids)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        # Summing the vectors of every list over the sample sorted by list, much faster than `np.add.at`.
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[np.argsort(assignments, kind="stable")], (np.cumsum(counts) - counts)[~empty])
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index over dense vectors, searched by inner product.
+
+    The vectors are split into lists by their nearest centroid, and a search only scores the vectors of the `nprobe`
+    lists whose centroids are the closest to the query: more lists find more of the exact neighbours, fewer are faster.
+    The index is saved as ".npy" files in a directory, which are memory mapped when loading, so loading is instant and
+    only the probed lists are read from disk.
+
+    Example:
+        >>> index = IVFIndex.build(np.load("filtered_yoruba_test_dataset_pos_embeddings.npy", mmap_mode="r"), path="yoruba_test_index")
+        >>> scores, ids = IVFIndex.load("yoruba_test_index").search(query_embeddings, k=10, nprobe=16)
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, ids: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: int | None = None, ids: np.ndarray | None = None,
+              num_iterations: int = KMEANS_ITERATIONS, seed: int = SEED, path: str | Path | None = None) -> IVFIndex:
+        """
+        Build an index over vectors.
+
+        Args:
+            vectors: The vectors, shaped (num_vectors, dim), e.g. a memory mapped ".npy" file of `pipeline.embed`.
+            nlist: The number of lists, see `default_nlist` when None.
+            ids: The ids returned for the vectors, their row indices when None.
+            num_iterations: The number of k-means iterations.
+            seed: The seed of the k-means.
+            path: The directory to save the index into. Its vectors are then written into their lists a chunk at a time
+                and memory mapped, instead of being held in memory.
+
+        Returns:
+            The index.
+        """
+        nlist = nlist or default_nlist(len(vectors))
+        ids = np.arange(len(vectors), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        centroids = train_centroids(vectors, nlist, num_iterations, seed)
+        assignments = nearest_centroids(vectors, centroids)
+        # The vectors of a list are stored contiguously, in their original order.
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))]).astype(np.int64)
+        if path is None:
+            return cls(centroids, take_rows(vectors, order, np.empty(vectors.shape, dtype=vectors.dtype)), ids[order], offsets)
+
+        tmp_path = cls._tmp_path(path)
+        sorted_vectors = np.lib.format.open_memmap(tmp_path / INDEX_FILES[1], mode="w+", dtype=vectors.dtype, shape=vectors.shape)
+        take_rows(vectors, order, sorted_vectors)
+        sorted_vectors.flush()
+        cls(centroids, sorted_vectors, ids[order], offsets)._write(tmp_path, path, vectors_written=True)
+        del sorted_vectors
+        return cls.load(path)
+
+    @staticmethod
+    def _tmp_path(path: str | Path) -> Path:
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        return tmp_path
+
+    def _write(self, tmp_path: Path, path: str | Path, vectors_written: bool = False) -> None:
+        for name, array in zip(INDEX_FILES, [self.centroids, self.vectors, self.ids, self.offsets]):
+            if not (vectors_written and name == INDEX_FILES[1]):
+                np.save(tmp_path / name, array)
+        meta = {"type": "ivf", "num_vectors": len(self), "nlist": self.nlist, "dim": int(self.vectors.shape[1]),
+                "dtype": str(self.vectors.dtype)}
+        (tmp_path / META_FILE).write_text(json.dumps(meta, indent=2))
+        replace_dir(tmp_path, path)
+
+    def save(self, path: str | Path) -> None:
+        """Save the index into a directory, written aside then moved in place, see `replace_dir`."""
+        self._write(self._tmp_path(path), path)
+
+    @classmethod
+    def load(cls, path: str | Path) -> IVFIndex:
+        """Load an index saved by `save`, memory mapping its vectors."""
+        path = Path(path)
+        return cls(*(np.load(path / name, mmap_mode="r") for name in INDEX_FILES))
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: int = DEFAULT_NPROBE) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the vectors with the highest inner products with every query, among the lists of the closest centroids.
+
+        The queries are grouped by probed list, so every list is read and scored once per batch of queries.
+
+        Args:
+            queries: The query vectors, shaped (num_queries, dim).
+            k: The number of vectors to return per query.
+            nprobe: The number of lists scored per query.
+
+        Returns:
+            The scores and the ids of the top k vectors of every query, from the highest score. Missing results,
+            when the probed lists hold fewer than k vectors, have a score of -inf and an id of -1.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe, self.nlist)
+        _, probes = tiled_top_k(queries, self.centroids, nprobe)
+
+        top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        top_idxs = np.full((len(queries), k), -1, dtype=np.int64)
+        probe_queries = np.repeat(np.arange(len(queries)), nprobe)
+        probe_lists = probes.reshape(-1)
+        order = np.argsort(probe_lists, kind="stable")
+        probe_queries, probe_lists = probe_queries[order], probe_lists[order]
+        bounds = np.searchsorted(probe_lists, np.arange(self.nlist + 1))
+        for list_idx in np.flatnonzero(np.diff(bounds)):
+            start, end = self.offsets[list_idx], self.offsets[list_idx + 1]
+            if start == end:
+                continue
+            query_idxs = probe_queries[bounds[list_idx]:bounds[list_idx + 1]]
+            scores = queries[query_idxs] @ np.asarray(self.vectors[start:end], dtype=np.float32).T
+            scores = np.concatenate([top_scores[query_idxs], scores], axis=1)
+            idxs = np.concatenate([top_idxs[query_idxs], np.broadcast_to(np.arange(start, end), (len(query_idxs), end - start))], axis=1)
+            # The running top k is merged with the list, so there are always more than k candidates.
+            kept = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores[query_idxs] = np.take_along_axis(scores, kept, axis=1)
+            top_idxs[query_idxs] = np.take_along_axis(idxs, kept, axis=1)
+
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top_scores, top_idxs = np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top_idxs, order, axis=1)
+        ids = np.where(top_idxs >= 0, np.asarray(self.ids)[np.maximum(top_idxs, 0)], -1)
+        return top_scores, ids
+
+
+def recall_against_exact(index: IVFIndex, queries: np.ndarray, vectors: np.ndarray, k: int = 10,
+                         nprobes: Sequence[int] = NPROBE_VALUES) -> list[dict]:
+    """
+    Measure the share of the exact top k neighbours found by the index, and its speed, for several values of nprobe.
+
+    Args:
+        index: The index, built over `vectors` with their row indices as ids.
+        queries: The query vectors.
+        vectors: The indexed vectors, searched exhaustively for the exact neighbours.
+        k: The number of neighbours.
+        nprobes: The values of nprobe to measure.
+
+    Returns:
+        A record per value of nprobe, e.g. {"nprobe": 16, "recall@10": 0.98, "queries_per_second": ...}.
+    """
+    start = time.perf_counter()
+    _, exact = tiled_top_k(queries, vectors, k)
+    exact_qps = len(queries) / (time.perf_counter() - start)
+
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        _, found = index.search(queries, k, nprobe)
+        qps = len(queries) / (time.perf_counter() - start)
+        recall = (found[:, :, None] == exact[:, None, :]).any(axis=2).sum() / exact.size
+        results.append({"nprobe": nprobe, f"recall@{k}": float(recall), "queries_per_second": qps,
+                        "exact_queries_per_second": exact_qps})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build IVF indices over embeddings, and evaluate them against exact search.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Build an index over a .npy file of embeddings, see pipeline.embed.")
+    build_parser.add_argument("embeddings", type=str)
+    build_parser.add_argument("--output", type=str, required=True, help="The directory of the index.")
+    build_parser.add_argument("--nlist", type=int, default=None, help="The number of lists, about 4 * sqrt(vectors) by default.")
+    evaluate_parser = subparsers.add_parser("evaluate", help="Compare an index against exact search, e.g. with the queries of the test split.")
+    evaluate_parser.add_argument("index", type=str)
+    evaluate_parser.add_argument("--embeddings", type=str, required=True, help="The embeddings the index was built over.")
+    evaluate_parser.add_argument("--queries", type=str, required=True, help="A .npy file of query embeddings.")
+    evaluate_parser.add_argument("--k", type=int, default=10)
+    evaluate_parser.add_argument("--nprobe", type=int, nargs="+", default=NPROBE_VALUES)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        index = IVFIndex.build(np.load(args.embeddings, mmap_mode="r"), nlist=args.nlist, path=args.output)
+        logger.info(f"Indexed {len(index)} vectors into {index.nlist} lists at {args.output} in {time.perf_counter() - start:.1f}s.")
+    else:
+        index = IVFIndex.load(args.index)
+        for result in recall_against_exact(index, np.load(args.queries), np.load(args.embeddings, mmap_mode="r"), args.k, args.nprobe):
+            logger.info(", ".join(f"{name}={value:.4f}" if isinstance(value, float) else f"{name}={value}" for name, value in result.items()))
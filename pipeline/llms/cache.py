@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+
+# Default upper bound on the size of the cached responses, least recently used responses are evicted past it.
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# Share of `max_bytes` kept after an eviction, so that evictions do not happen on every insert once full.
+EVICTION_TARGET_RATIO = 0.9
+
+
+def cache_key(model: str, prompt_version: int | str, prompt: str) -> str:
+    """
+    Get the content address of an LLM request.
+
+    Args:
+        model: The model the prompt is sent to.
+        prompt_version: The version of the prompt template the prompt was built from.
+        prompt: The final prompt.
+
+    Returns:
+        The hex digest identifying the request.
+    """
+    digest = hashlib.sha256()
+    for part in (model, str(prompt_version), prompt):
+        encoded = part.encode("utf-8")
+        # Length prefixing, so that the parts cannot run into each other.
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk cache of LLM responses, stored in SQLite and keyed by `cache_key`.
+
+    The cache is bounded to `max_bytes` of response text, evicting the least recently used responses.
+
+    Args:
+        cache_dir: The directory holding the cache database.
+        max_bytes: The maximum size of the cached responses.
+
+    Example:
+        >>> cache = ResponseCache("artefacts/llm_cache")
+        >>> key = cache_key("gemma3:27b", 1, prompt)
+        >>> cache.get(key) or cache.set(key, response)
+    """
+
+    def __init__(self, cache_dir: str | Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(self.cache_dir / "responses.sqlite3")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> str | None:
+        """
+        Get a cached response.
+
+        Args:
+            key: The key of the request.
+
+        Returns:
+            The response, or None when the request is not cached.
+        """
+        row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._conn.commit()
+        return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        """
+        Cache a response, evicting the least recently used responses if the cache grows past `max_bytes`.
+
+        Args:
+            key: The key of the request.
+            response: The response.
+        """
+        size = len(response.encode("utf-8"))
+        previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, accessed) VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time()),
+        )
+        self._size += size - (previous[0] if previous else 0)
+        if self._size > self.max_bytes:
+            self._evict(int(self.max_bytes * EVICTION_TARGET_RATIO))
+        self._conn.commit()
+
+    def _evict(self, target_bytes: int) -> None:
+        evicted_keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self._size <= target_bytes:
+                break
+            evicted_keys.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> str:
+        """Get a summary of the cache usage."""
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return f"Cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {len(self)} responses, {self._size / 1024 ** 2:.1f} MiB."
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+# Requests currently sent to the model, so that identical prompts in flight at the same time share one request.
+_in_flight = {}
+
+
+async def cached_chat(client, model: str, prompt: str, prompt_version: int | str, cache: ResponseCache | None = None) -> str:
+    """
+    Send a prompt to an Ollama model, unless its response is already cached or already being requested.
+
+    Args:
+        client: The Ollama client.
+        model: The model to send the prompt to.
+        prompt: The prompt.
+        prompt_version: The version of the prompt template the prompt was built from.
+        cache: The response cache, responses are not cached when None.
+
+    Returns:
+        The content of the response message.
+    """
+    if cache is None:
+        response = await client.chat(model=model, messages=[{'role': 'user', 'content': prompt}])
+        return response.message.content
+
+    key = cache_key(model, prompt_version, prompt)
+    content = cache.get(key)
+    if content is not None:
+        return content
+
+    if key in _in_flight:
+        return await asyncio.shield(_in_flight[key])
+
+    async def request():
+        response = await client.chat(model=model, messages=[{'role': 'user', 'content': prompt}])
+        cache.set(key, response.message.content)
+        return response.message.content
+
+    _in_flight[key] = asyncio.ensure_future(request())
+    try:
+        return await asyncio.shield(_in_flight[key])
+    finally:
+        _in_flight.pop(key, None)
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from collections import deque
+from collections.abc import Iterator
+from itertools import islice
+from pathlib import Path
+
+from pipeline.data.jsonl import iter_jsonl, loads
+from pipeline.data.utils import count_artefact_rows, iter_artefact
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def input_fingerprint(path: str | Path) -> str:
+    """
+    Fingerprint a file by hashing its whole content, in one linear read when the checkpoint is opened.
+
+    The manifest of a sharded file records the hash of every shard, so hashing the manifest covers the shards.
+
+    Args:
+        path: The file to fingerprint.
+
+    Returns:
+        The fingerprint.
+    """
+    with open(path, "rb") as f_:
+        return hashlib.file_digest(f_, "sha256").hexdigest()
+
+
+def repair_trailing_line(path: str | Path) -> int:
+    """
+    Truncate a partially written last line from a JSONL file.
+
+    Args:
+        path: The JSONL file to repair.
+
+    Returns:
+        The size of the file after the repair.
+    """
+    with open(path, "rb+") as f_:
+        size = f_.seek(0, os.SEEK_END)
+        end = size
+        # Walking back in blocks to the last newline.
+        while end > 0:
+            start = max(end - 4096, 0)
+            f_.seek(start)
+            newline = f_.read(end - start).rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            logger.warning(f"Removing a partially written line of {size - end} bytes at the end of {path}.")
+            f_.truncate(end)
+    return end
+
+
+class Checkpoint:
+    """
+    Resume manifest of an LLM job, written atomically next to its results file.
+
+    The manifest records how many input rows have results, the byte offset of the next input row,
+    the size of the results file at that point and the fingerprint of the input file.
+    Other inputs than plain JSONL files (compressed, sharded, Parquet or Arrow IPC) are addressed by row instead,
+    their offset is the index of the next input row.
+    Resuming seeks straight to the next pending row, and anything written to the results file after the
+    last manifest update (e.g. a line cut short by a crash) is truncated away, so restarts do not read the results.
+
+    Args:
+        input_path: The input JSONL file of the job.
+        results_path: The results JSONL file of the job.
+
+    Example:
+        >>> checkpoint = Checkpoint("yoruba_train_dataset.jsonl", "yoruba_gemma3_27b_train_results.jsonl")
+        >>> checkpoint.load()
+        >>> for row in checkpoint.rows():
+        ...     ...  # Results are appended in order, then `checkpoint.advance(...)` is called.
+    """
+
+    def __init__(self, input_path: str | Path, results_path: str | Path):
+        self.input_path = Path(input_path)
+        self.results_path = Path(results_path)
+        self.manifest_path = self.results_path.with_name(self.results_path.name + ".checkpoint.json")
+        self.fingerprint = input_fingerprint(self.input_path)
+        self.row_addressed = self.input_path.suffix != ".jsonl"
+        self.next_row = 0
+        self.input_offset = 0
+        self.results_bytes = 0
+        # The input offsets after each of the rows handed out by `rows`, but not yet advanced past.
+        self._row_ends = deque()
+
+    def load(self) -> int:
+        """
+        Load the manifest, repairing the results file so that it matches it.
+
+        Results files from before manifests existed are read once to build the manifest.
+
+        Returns:
+            The index of the next input row to process.
+        """
+        manifest = self._read_manifest()
+        if manifest is not None:
+            if manifest["input_fingerprint"] != self.fingerprint:
+                raise RuntimeError(f"The input file {self.input_path} changed since {self.results_path} was started. "
+                                   f"Move the results file and {self.manifest_path} aside to start over.")
+            self.next_row = manifest["next_row"]
+            self.input_offset = manifest["input_offset"]
+            self.results_bytes = manifest["results_bytes"]
+
+            size = self.results_path.stat().st_size if self.results_path.exists() else 0
+            if size < self.results_bytes:
+                raise RuntimeError(f"{self.results_path} is smaller than recorded in {self.manifest_path}, it might have been modified.")
+            if size > self.results_bytes:
+                logger.warning(f"Removing {size - self.results_bytes} bytes written to {self.results_path} after the last checkpoint.")
+                with open(self.results_path, "rb+") as f_:
+                    f_.truncate(self.results_bytes)
+        elif self.results_path.exists():
+            self._load_legacy()
+            self.save()
+        return self.next_row
+
+    def _read_manifest(self) -> dict | None:
+        return json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else None
+
+    def is_stale(self) -> bool:
+        """Check whether the results were started from a different version of the input file."""
+        manifest = self._read_manifest()
+        return manifest is not None and manifest["input_fingerprint"] != self.fingerprint
+
+    def is_complete(self) -> bool:
+        """Check whether every row of the input file has a result, from the manifest only."""
+        manifest = self._read_manifest()
+        if manifest is None or manifest["input_fingerprint"] != self.fingerprint:
+            return False
+        if self.row_addressed:
+            return manifest["input_offset"] >= count_artefact_rows(self.input_path)
+        # Only blank lines may follow the last row with a result.
+        with open(self.input_path, "rb") as f_:
+            f_.seek(manifest["input_offset"])
+            rest = f_.read(4096)
+            return not rest.strip() and not f_.read(1)
+
+    def discard(self) -> None:
+        """Move the results file and its manifest aside, with a `.stale` suffix, so the job starts over."""
+        for path in (self.results_path, self.manifest_path):
+            if path.exists():
+                logger.warning(f"Moving {path} aside to {path.name}.stale.")
+                os.replace(path, path.with_name(path.name + ".stale"))
+        self.next_row = self.input_offset = self.results_bytes = 0
+
+    def _load_legacy(self) -> None:
+        self.results_bytes = repair_trailing_line(self.results_path)
+        # Skipping None lines is handling a bug in previous processing where some lines were None
+        self.next_row = sum(1 for line in iter_jsonl(self.results_path) if line)
+        if self.row_addressed:
+            self.input_offset = self.next_row
+            return
+        with open(self.input_path, "rb") as f_:
+            skipped = 0
+            while skipped < self.next_row and (line := f_.readline()):
+                skipped += bool(line.strip())
+            self.input_offset = f_.tell()
+
+    def rows(self) -> Iterator:
+        """
+        Stream the pending input rows, starting from the checkpoint.
+
+        Returns:
+            An iterator over the rows.
+        """
+        self._row_ends.clear()
+        if self.row_addressed:
+            for offset, row in enumerate(islice(iter_artefact(self.input_path), self.input_offset, None), self.input_offset + 1):
+                self._row_ends.append(offset)
+                yield row
+            return
+        with open(self.input_path, "rb") as f_:
+            f_.seek(self.input_offset)
+            offset = self.input_offset
+            for line in f_:
+                offset += len(line)
+                if not line.strip():
+                    continue
+                self._row_ends.append(offset)
+                yield loads(line)
+
+    def advance(self, count: int, results_bytes: int) -> None:
+        """
+        Record that the results of the next `count` rows are written, then save the manifest.
+
+        Args:
+            count: The number of rows whose results were appended.
+            results_bytes: The size of the results file after appending them.
+        """
+        for _ in range(count):
+            self.input_offset = self._row_ends.popleft()
+        self.next_row += count
+        self.results_bytes = results_bytes
+        self.save()
+
+    def save(self) -> None:
+        """Write the manifest atomically, by writing a temporary file then renaming it."""
+        manifest = {
+            "input_path": str(self.input_path),
+            "input_fingerprint": self.fingerprint,
+            "next_row": self.next_row,
+            "input_offset": self.input_offset,
+            "results_bytes": self.results_bytes,
+        }
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with open(tmp_path, "w") as f_:
+            json.dump(manifest, f_)
+            f_.flush()
+            os.fsync(f_.fileno())
+        os.replace(tmp_path, self.manifest_path)
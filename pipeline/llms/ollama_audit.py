@@ -1,19 +1,19 @@
 import argparse
 import asyncio
 import re
-import time
-import traceback
-from pathlib import Path
+from functools import partial
 
-import jsonlines
 import ollama
 
 from ollama import AsyncClient
 
 from pipeline.constants import ARTEFACTS_DIR
-from pipeline.data.utils import load_artefact
-from pipeline.text_utils import count_tokens, truncate_text, skip_doc_body
+from pipeline.llms.cache import ResponseCache, cached_chat
+from pipeline.llms.checkpoint import Checkpoint
+from pipeline.llms.scheduler import OrderedJsonlWriter, Request, RequestScheduler, chunked
+from pipeline.text_utils import count_tokens, count_tokens_many, truncate_many, skip_doc_body
 from pipeline.data.enums import DataSplit, Language
+from pipeline.data.utils import find_artefact
 
 
 syntactic = """
@@ -39,106 +39,130 @@ Populate the following tags with your answer:
 <reason></reason>
 """
 
+# Bump when the prompt template changes in a way that should not reuse cached responses.
+PROMPT_VERSION = 1
 PROMPT_TOKEN_SIZE = count_tokens(syntactic)
-
-
-async def chat(language, text, token_limit=2048, model="gemma3:27b"):
-    full_prompt = syntactic.format(language=language.capitalize(), text=text)
-    token_size = count_tokens(full_prompt)
-    if token_size > token_limit:
+# Number of rows whose prompts are tokenized together.
+PROMPT_CHUNK_SIZE = 256
+
+
+def make_prompts(language, texts, token_limit=2048):
+    """
+    Build the audit prompts for the texts, truncating the texts that do not fit in the token limit.
+
+    Args:
+        language: The language of the texts.
+        texts: The texts to build the prompts for.
+        token_limit: The maximum number of tokens in a prompt.
+
+    Returns:
+        The prompts, in the order of `texts`.
+    """
+    full_prompts = [syntactic.format(language=language.capitalize(), text=text) for text in texts]
+    token_sizes = count_tokens_many(full_prompts)
+    long_idxs = [idx for idx, token_size in enumerate(token_sizes) if token_size > token_limit]
+    if long_idxs:
         remaining_tokens = token_limit - PROMPT_TOKEN_SIZE
         gap_size = 500
-        final_text = truncate_text(text, remaining_tokens-gap_size)
-        final_prompt = syntactic.format(language=language.capitalize(), text=final_text)
-    else:
-        final_prompt = full_prompt
+        final_texts = truncate_many([texts[idx] for idx in long_idxs], remaining_tokens-gap_size)
+        for idx, final_text in zip(long_idxs, final_texts):
+            full_prompts[idx] = syntactic.format(language=language.capitalize(), text=final_text)
+    return full_prompts
 
-    message = {'role': 'user', 'content': final_prompt}
-    response = await AsyncClient().chat(model=model, messages=[message])
-    label = re.search(r"<category>(.*?)</category>", response.message.content)
+
+async def chat(prompt, client=None, model="gemma3:27b", cache=None):
+    content = await cached_chat(client or AsyncClient(), model, prompt, PROMPT_VERSION, cache)
+    label = re.search(r"<category>(.*?)</category>", content)
     label = label.group(1) if label else "PARSE_ERROR"
-    reason = re.search(r"<reason>(.*?)</reason>", response.message.content)
+    reason = re.search(r"<reason>(.*?)</reason>", content)
     reason = reason.group(1) if reason else "PARSE_ERROR"
-    return {"category": label, "reason": reason, "message": response.message.content}
+    return {"category": label, "reason": reason, "message": content}
+
+
+def make_jobs(rows, language, client, model, cache=None, chunk_size=PROMPT_CHUNK_SIZE):
+    """
+    Turn the rows into scheduler jobs, building the prompts of `chunk_size` rows at a time.
+
+    Args:
+        rows: The rows to audit.
+        language: The language of the rows.
+        client: The Ollama client shared by the requests.
+        model: The model to audit with.
+        cache: The response cache consulted before sending a prompt.
+        chunk_size: The number of rows whose prompts are built together.
+
+    Returns:
+        An iterator over the jobs, in the order of the rows.
+    """
+    for chunk in chunked(rows, chunk_size):
+        results = [None] * len(chunk)
+        chat_texts = []
+        for idx, line in enumerate(chunk):
+            if isinstance(line["pos"], list):
+                chat_text = line["pos"][0]
+            elif isinstance(line["pos"], str):
+                chat_text = line["pos"]
+            else:
+                raise ValueError("pos must be a string or a list of strings")
+
+            if not chat_text:
+                results[idx] = {"category": "EMPTYTEXT", "reason": "EMPTYTEXT", "message": "EMPTYTEXT"}
+            elif skip_doc_body(chat_text, line["query"]):
+                results[idx] = {"category": "SKIP", "reason": "SKIP", "message": "SKIP"}
+            else:
+                chat_texts.append(chat_text)
+
+        prompts = iter(make_prompts(language, chat_texts))
+        for result in results:
+            if result is not None:
+                yield result
+            else:
+                prompt = next(prompts)
+                yield Request(partial(chat, prompt, client=client, model=model, cache=cache), prompt)
 
 
 async def main(args):
     language = args.language
-    if language.lower() not in DataSplit:
+    if language.lower() not in list(Language):
         raise ValueError(f"Language must be one of {Language}. Got {language.lower()}")
                 
-    if Path(args.output_path).exists():
-        with jsonlines.open(args.output_path) as f:
-            # allow_none is handling a bug in previous processing where some lines were None
-            start_num_rows = sum(1 for line in f.iter(allow_none=True) if line)
-    else:
-        start_num_rows = 0
-
-    results = None
-    retries = 5
-
-    input_rows = load_artefact(args.input_path)
-    num_input_rows = len(input_rows)
-
-    batch = []
-    for count, line in enumerate(input_rows[start_num_rows:], start=start_num_rows+1):
-        batch.append(line)
-        if not (len(batch) == args.batch_size or count == num_input_rows):
-            continue
-
-        # Setting up retries because the run_ollama.sh is set to restart Ollama after some intervals.
-        # Hence, we need to retry the request if it fails on such occassions.
-        last_exc = None
-        for _ in range(retries):
-            try:
-                results = [None] * min(args.batch_size, len(batch))
-                tasks = []
-                for idx, line in enumerate(batch):
-                    if isinstance(line["pos"], list):
-                        chat_text = line["pos"][0]
-                    elif isinstance(line["pos"], str):
-                        chat_text = line["pos"]
-                    else:
-                        raise ValueError("pos must be a string or a list of strings")
-
-                    if not chat_text:
-                        results[idx] = {"category": "EMPTYTEXT", "reason": "EMPTYTEXT", "message": "EMPTYTEXT"}
-                    elif skip_doc_body(chat_text, line["query"]):
-                        results[idx] = {"category": "SKIP", "reason": "SKIP", "message": "SKIP"}
-                    else:
-                        tasks.append(chat(language, chat_text, model=args.model))
-
-                responses = await asyncio.gather(*tasks)
-                for idx, result in enumerate(results):
-                    if result is None:
-                        results[idx] = responses.pop(0)
-                
-                with jsonlines.open(args.output_path, 'a') as f:
-                    f.write_all(results)
-
-                print(f"Done {count}")
-                batch = []
-                break
-            except Exception as exc:
-                print(line)
-                print(f"Error: {traceback.format_exc()}")
-                last_exc = exc
-                time.sleep(10)
-        else:
-            raise Exception("All retries failed") from last_exc
+    # Resuming from the checkpoint manifest written next to the results.
+    checkpoint = Checkpoint(args.input_path, args.output_path)
+    start_num_rows = checkpoint.load()
+
+    # Setting up retries because the run_ollama.sh is set to restart Ollama after some intervals.
+    # Hence, we need to retry the request if it fails on such occassions, and pause until the server is back.
+    client = AsyncClient()
+    cache = ResponseCache(args.cache_dir) if args.cache_dir else None
+    scheduler = RequestScheduler(concurrency=args.concurrency, retries=5, retry_delay=10, health_check=client.ps)
+    writer = OrderedJsonlWriter(args.output_path, start=start_num_rows, checkpoint=checkpoint)
+    jobs = make_jobs(checkpoint.rows(), language, client, args.model, cache=cache)
+    try:
+        await scheduler.run(jobs, writer)
+    finally:
+        print(scheduler.metrics.summary())
+        if cache is not None:
+            print(cache.stats())
+            cache.close()
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the command line arguments, those of `sys.argv` when None."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="gemma3:27b")
+    parser.add_argument("--language", choices=list(Language), default="yoruba", type=str.lower)
+    parser.add_argument("--concurrency", type=int, default=20, help="Number of requests kept in flight.")
+    parser.add_argument("--cache-dir", type=str, default=f"{ARTEFACTS_DIR}/llm_cache", help="Directory of the LLM response cache, an empty value disables the cache.")
+    parser.add_argument("--split", choices=list(DataSplit), default="train", type=str.lower)
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model", type=str, default="gemma3:27b")
-    parser.add_argument("--language", choices=Language, default="yoruba", type=str.lower)
-    parser.add_argument("--batch_size", type=int, default=20)
-    parser.add_argument("--split", choices=DataSplit, default="train", type=str.lower)
-    args = parser.parse_args()
+    args = parse_args()
 
     language = args.language.lower()
-    if args.split in DataSplit:
-        args.input_path = f"{ARTEFACTS_DIR}/{language.lower()}_{args.split}_dataset.jsonl"
+    if args.split in list(DataSplit):
+        args.input_path = f"{ARTEFACTS_DIR}/{find_artefact(f'{language.lower()}_{args.split}_dataset')}"
         args.output_path = f"{ARTEFACTS_DIR}/{language.lower()}_{args.model.replace(':', '_')}_{args.split}_results.jsonl"
     else:
         raise ValueError(f"Split must be one of {DataSplit}. Got {args.split}")
@@ -1,19 +1,20 @@
 import argparse
 import asyncio
 import re
-import shutil
-import time
-import traceback
+from functools import partial
 from pathlib import Path
 
-import jsonlines
 import ollama
 
 from ollama import AsyncClient
 
 from pipeline.constants import ARTEFACTS_DIR
 from pipeline.data.enums import DataSplit
-from pipeline.text_utils import count_tokens, truncate_text
+from pipeline.data.utils import find_artefact
+from pipeline.llms.cache import ResponseCache, cached_chat
+from pipeline.llms.checkpoint import Checkpoint
+from pipeline.llms.scheduler import OrderedJsonlWriter, Request, RequestScheduler, chunked
+from pipeline.text_utils import count_tokens, count_tokens_many, truncate_many
 
 
 syntactic = """
@@ -34,27 +35,70 @@ Give a one sentence explanation of the translation action taken with the followi
 """
 
 
+# Bump when the prompt template changes in a way that should not reuse cached responses.
+PROMPT_VERSION = 1
 PROMPT_TOKEN_SIZE = count_tokens(syntactic)
-
-
-async def chat(language, text, token_limit=2048, model="gemma3:27b"):
-  full_prompt = syntactic.format(language=language.capitalize(), text=text)
-  token_size = count_tokens(full_prompt)
-  if token_size > token_limit:
+# Number of rows whose prompts are tokenized together.
+PROMPT_CHUNK_SIZE = 256
+
+
+def make_prompts(language, texts, token_limit=2048):
+  """
+  Build the translation prompts for the texts, truncating the texts that do not fit in the token limit.
+
+  Args:
+      language: The language of the texts.
+      texts: The texts to build the prompts for.
+      token_limit: The maximum number of tokens in a prompt.
+
+  Returns:
+      The prompts, in the order of `texts`.
+  """
+  full_prompts = [syntactic.format(language=language.capitalize(), text=text) for text in texts]
+  token_sizes = count_tokens_many(full_prompts)
+  long_idxs = [idx for idx, token_size in enumerate(token_sizes) if token_size > token_limit]
+  if long_idxs:
     remaining_tokens = token_limit - PROMPT_TOKEN_SIZE
     gap_size = 500
-    final_text = truncate_text(text, remaining_tokens-gap_size)
-    final_prompt = syntactic.format(language=language, text=final_text)
-  else:
-    final_prompt = full_prompt
-
-  message = {'role': 'user', 'content': final_prompt}
-  response = await AsyncClient().chat(model=model, messages=[message])
-  translation = re.search(r"<translation>(.*?)</translation>", response.message.content)
+    final_texts = truncate_many([texts[idx] for idx in long_idxs], remaining_tokens-gap_size)
+    for idx, final_text in zip(long_idxs, final_texts):
+      full_prompts[idx] = syntactic.format(language=language, text=final_text)
+  return full_prompts
+
+
+async def chat(prompt, client=None, model="gemma3:27b", cache=None):
+  content = await cached_chat(client or AsyncClient(), model, prompt, PROMPT_VERSION, cache)
+  translation = re.search(r"<translation>(.*?)</translation>", content)
   translation = translation.group(1) if translation else "PARSE_ERROR"
-  reason = re.search(r"<reason>(.*?)</reason>", response.message.content)
+  reason = re.search(r"<reason>(.*?)</reason>", content)
   reason = reason.group(1) if reason else "PARSE_ERROR"
-  return {"translation": translation, "reason": reason, "message": response.message.content}
+  return {"translation": translation, "reason": reason, "message": content}
+
+
+def make_jobs(rows, language, client, model, cache=None, chunk_size=PROMPT_CHUNK_SIZE):
+  """
+  Turn the rows into scheduler jobs, building the prompts of `chunk_size` rows at a time.
+
+  Args:
+      rows: The rows whose queries are translated.
+      language: The language of the rows.
+      client: The Ollama client shared by the requests.
+      model: The model to translate with.
+      cache: The response cache consulted before sending a prompt.
+      chunk_size: The number of rows whose prompts are built together.
+
+  Returns:
+      An iterator over the jobs, in the order of the rows.
+  """
+  for chunk in chunked(rows, chunk_size):
+    chat_texts = [line["query"] for line in chunk if line["query"]]
+    prompts = iter(make_prompts(language, chat_texts))
+    for line in chunk:
+      if not line["query"]:
+        yield {"category": "EMPTYTEXT", "reason": "EMPTYTEXT", "message": "EMPTYTEXT"}
+      else:
+        prompt = next(prompts)
+        yield Request(partial(chat, prompt, client=client, model=model, cache=cache), prompt)
 
 
 async def main(args):
@@ -68,77 +112,41 @@ async def main(args):
     if not in_file.exists():
         raise RuntimeError(f"Input file {in_file} does not exist.")
 
-    if out_file.exists():
-        with jsonlines.open(out_file) as f:
-            # allow_none is handling a bug in previous processing where
-            # some lines were None
-            num_results = sum(1 for line in f.iter(allow_none=True) if line)
-    else:
-        num_results = 0
-
-    results = None
-    lines = []
-    count = 0
-    retries = 5
-
-    with jsonlines.open(in_file, 'r') as f:
-        # allow_none is handling a bug in previous processing where
-        # some lines were None
-        num_rows = sum(1 for line in f.iter(allow_none=True) if line)
-
-    with jsonlines.open(in_file, 'r') as f:
-        for line in f.iter(allow_none=True):
-            count += 1
-            if count <= num_results:
-                continue
-
-            lines.append(line)
-            if len(lines) == args.batch_size or count == num_rows:
-                results = [None] * min(args.batch_size, len(lines))
-                error = None
-                for _ in range(retries):
-                    try:
-                        tasks = []
-                        for idx, line in enumerate(lines):
-                            chat_text = line["query"]
-
-                            if not chat_text:
-                                results[idx] = {"category": "EMPTYTEXT", "reason": "EMPTYTEXT", "message": "EMPTYTEXT"}
-                            else:
-                                tasks.append(chat(language, chat_text, model=args.model))
-
-                        responses = await asyncio.gather(*tasks)
-                        for idx, result in enumerate(results):
-                            if result is None:
-                                results[idx] = responses.pop(0)
-                        break
-                    except Exception as exc:
-                        results = [None] * min(args.batch_size, len(lines))
-                        print(line)
-                        print(f"Error: {traceback.format_exc()}")
-                        error = exc
-                        time.sleep(10)
-                else:
-                    raise Exception("All retries failed") from error
-
-                with jsonlines.open(out_file, 'a') as f:
-                    f.write_all(results)
-
-                num_results += len(results)
-                print(f"Done {num_results}")
-                lines = []
-
-if __name__ == "__main__":
+    # Resuming from the checkpoint manifest written next to the results.
+    checkpoint = Checkpoint(in_file, out_file)
+    num_results = checkpoint.load()
+
+    client = AsyncClient()
+    cache = ResponseCache(args.cache_dir) if args.cache_dir else None
+    scheduler = RequestScheduler(concurrency=args.concurrency, retries=5, retry_delay=10, health_check=client.ps)
+    writer = OrderedJsonlWriter(out_file, start=num_results, checkpoint=checkpoint)
+    jobs = make_jobs(checkpoint.rows(), language, client, args.model, cache=cache)
+    try:
+        await scheduler.run(jobs, writer)
+    finally:
+        print(scheduler.metrics.summary())
+        if cache is not None:
+            print(cache.stats())
+            cache.close()
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the command line arguments, those of `sys.argv` when None."""
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", type=str, default="gemma3:27b")
     parser.add_argument("--language", type=str, default="Yoruba")
-    parser.add_argument("--batch_size", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=20, help="Number of requests kept in flight.")
+    parser.add_argument("--cache-dir", type=str, default=f"{ARTEFACTS_DIR}/llm_cache", help="Directory of the LLM response cache, an empty value disables the cache.")
     parser.add_argument("--split", choices=["train", "eval", "test"], default="train")
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
 
     language = args.language.lower()
-    if args.split in DataSplit:
-        args.input_path = f"{ARTEFACTS_DIR}/filtered_{language.lower()}_{args.split}_dataset.jsonl"
+    if args.split in list(DataSplit):
+        args.input_path = f"{ARTEFACTS_DIR}/{find_artefact(f'filtered_{language.lower()}_{args.split}_dataset')}"
         args.output_path = f"{ARTEFACTS_DIR}/{language.lower()}_english_{args.model.replace(':', '_')}_{args.split}_results.jsonl"
     else:
         raise ValueError(f"Split must be one of {DataSplit}. Got {args.split}")
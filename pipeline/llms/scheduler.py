@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import traceback
+from collections.abc import Awaitable, Callable, Iterable, Iterator
+from functools import cached_property
+from itertools import islice
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from pipeline.data.jsonl import write_jsonl
+from pipeline.text_utils import count_tokens
+
+
+if TYPE_CHECKING:
+    from pipeline.llms.checkpoint import Checkpoint
+
+
+# Upper bound, in seconds, of the backoff between two attempts of a request and of the pauses of the circuit breaker.
+MAX_RETRY_DELAY = 300
+# Number of consecutive failed attempts, across all requests, after which requests are paused until the server is back.
+FAILURE_THRESHOLD = 5
+
+# A job is either a ready result, or a callable returning the awaitable result of an LLM request.
+Job = dict | Callable[[], Awaitable[dict]]
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """Split the iterable into lists of `size` items, the last one can be shorter."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class OrderedJsonlWriter:
+    """
+    Appends results to a JSONL file from a background task, in the order of their indexes.
+
+    Results can be submitted in any order, they are held until all of the results before them are written.
+
+    Args:
+        path: The JSONL file to append to.
+        start: The number of results already in the file, only used for progress messages.
+        checkpoint: The checkpoint advanced after every write, if any.
+    """
+
+    def __init__(self, path: str | Path, start: int = 0, checkpoint: Checkpoint | None = None):
+        self.path = path
+        self.start = start
+        self.checkpoint = checkpoint
+        self.next_idx = 0
+        self.advanced = asyncio.Event()
+        self._pending = {}
+        self._queue = asyncio.Queue()
+
+    def submit(self, idx: int, result: dict) -> None:
+        self._queue.put_nowait((idx, result))
+
+    def close(self) -> None:
+        self._queue.put_nowait(None)
+
+    def _append(self, rows: list[dict]) -> None:
+        write_jsonl(self.path, rows, "a")
+        if self.checkpoint is not None:
+            self.checkpoint.advance(len(rows), os.path.getsize(self.path))
+
+    async def run(self) -> None:
+        while (item := await self._queue.get()) is not None:
+            idx, result = item
+            self._pending[idx] = result
+            # Draining what is already queued, so a burst of results is written at once.
+            while not self._queue.empty() and (item := self._queue.get_nowait()) is not None:
+                self._pending[item[0]] = item[1]
+
+            rows = []
+            while self.next_idx in self._pending:
+                rows.append(self._pending.pop(self.next_idx))
+                self.next_idx += 1
+            if rows:
+                await asyncio.to_thread(self._append, rows)
+                print(f"Done {self.start + self.next_idx}")
+                self.advanced.set()
+
+            if item is None:
+                break
+
+
+class Request:
+    """
+    A job sending a prompt to an LLM, keeping the prompt so that the work lost to failed attempts can be measured.
+
+    Args:
+        call: The callable returning the awaitable result of the request.
+        prompt: The prompt sent by the request.
+    """
+
+    def __init__(self, call: Callable[[], Awaitable[dict]], prompt: str):
+        self.call = call
+        self.prompt = prompt
+
+    def __call__(self) -> Awaitable[dict]:
+        return self.call()
+
+    @cached_property
+    def prompt_tokens(self) -> int:
+        return count_tokens(self.prompt)
+
+
+class SchedulerMetrics:
+    """Counters of the requests sent by a `RequestScheduler`."""
+
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        self.failed_attempts = 0
+        self.wasted_tokens = 0
+        self.circuit_opens = 0
+        self.paused_seconds = 0.0
+
+    def summary(self) -> str:
+        return (f"Requests: {self.attempts} attempts, {self.failed_attempts} failed, {self.retries} retries, "
+                f"{self.wasted_tokens} prompt tokens wasted, circuit opened {self.circuit_opens} times ({self.paused_seconds:.0f}s paused).")
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests while the server is down.
+
+    The circuit opens after `failure_threshold` consecutive failed attempts, across all requests. While it is open no
+    request is sent. It closes once `health_check` succeeds, polled with exponential backoff starting at `cooldown` seconds.
+    Without a health check it closes after the cooldown and lets requests probe the server: a single failure then opens it
+    again, with a doubled cooldown.
+
+    Args:
+        failure_threshold: The number of consecutive failures opening the circuit.
+        cooldown: The seconds to wait before checking whether the server is back.
+        max_cooldown: The maximum seconds between two checks.
+        health_check: A callable returning an awaitable that raises while the server is down, e.g. `AsyncClient().ps`.
+        metrics: The metrics to record the pauses in.
+    """
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, cooldown: float = 10, max_cooldown: float = MAX_RETRY_DELAY,
+                 health_check: Callable[[], Awaitable] | None = None, metrics: SchedulerMetrics | None = None):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.health_check = health_check
+        self.metrics = metrics or SchedulerMetrics()
+        self._closed = asyncio.Event()
+        self._closed.set()
+        self._failures = 0
+        # Number of times the circuit opened since the last successful request, doubling the cooldown each time.
+        self._trips = 0
+        self._recovery = None
+
+    @property
+    def is_open(self) -> bool:
+        return not self._closed.is_set()
+
+    async def wait(self) -> None:
+        """Wait until the circuit is closed."""
+        await self._closed.wait()
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._trips = 0
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self.failure_threshold and not self.is_open:
+            self._closed.clear()
+            self.metrics.circuit_opens += 1
+            print(f"Circuit open after {self._failures} consecutive failures, pausing requests.")
+            self._recovery = asyncio.create_task(self._recover())
+
+    async def _recover(self) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        delay = min(self.cooldown * 2 ** self._trips, self.max_cooldown)
+        self._trips += 1
+        await asyncio.sleep(delay)
+        if self.health_check is not None:
+            while True:
+                try:
+                    await self.health_check()
+                    break
+                except Exception:
+                    delay = min(delay * 2, self.max_cooldown)
+                    await asyncio.sleep(delay)
+
+        # Half-open: the next failure opens the circuit again.
+        self._failures = self.failure_threshold - 1
+        self.metrics.paused_seconds += loop.time() - started
+        print("Circuit closed, resuming requests.")
+        self._closed.set()
+
+    def close(self) -> None:
+        if self._recovery is not None:
+            self._recovery.cancel()
+
+
+class RequestScheduler:
+    """
+    Runs jobs with a fixed number of requests in flight, starting a new request as soon as one finishes.
+
+    Unlike sending fixed batches, a slow request only holds up its own slot. To bound memory when a request
+    is very slow, a job is not started while it is more than `window` positions ahead of the writer.
+
+    A failed request is retried on its own, after a jittered exponential backoff, so the other results are kept.
+    Requests are paused by a `CircuitBreaker` while the server is down (e.g. during the restarts of `run_ollama.sh`)
+    and resumed when it is back. Counters of the attempts, retries and wasted prompt tokens are kept in `metrics`.
+
+    Args:
+        concurrency: The number of requests in flight.
+        retries: The number of attempts per request.
+        retry_delay: The base of the backoff between attempts, in seconds.
+        window: The maximum distance between a started job and the next result to write, defaults to 10 x concurrency.
+        max_retry_delay: The maximum backoff between attempts, in seconds.
+        failure_threshold: The number of consecutive failures pausing the requests.
+        health_check: A callable returning an awaitable that raises while the server is down, polled while requests are paused.
+        seed: The seed of the backoff jitter.
+    """
+
+    def __init__(self, concurrency: int = 20, retries: int = 5, retry_delay: float = 10, window: int | None = None,
+                 max_retry_delay: float = MAX_RETRY_DELAY, failure_threshold: int = FAILURE_THRESHOLD,
+                 health_check: Callable[[], Awaitable] | None = None, seed: int | None = None):
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1. Got {concurrency}.")
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.window = window or 10 * concurrency
+        self.max_retry_delay = max_retry_delay
+        self.failure_threshold = failure_threshold
+        self.health_check = health_check
+        self.metrics = SchedulerMetrics()
+        self._random = random.Random(seed)
+        self._breaker = None
+        self._error = None
+
+    def backoff(self, attempt: int) -> float:
+        """Get the seconds to wait after the given failed attempt, with full jitter so that retries do not arrive together."""
+        return self._random.uniform(0, min(self.retry_delay * 2 ** attempt, self.max_retry_delay))
+
+    async def _run_job(self, idx: int, job: Callable[[], Awaitable[dict]], semaphore: asyncio.Semaphore, writer: OrderedJsonlWriter) -> None:
+        try:
+            last_exc = None
+            for attempt in range(self.retries):
+                await self._breaker.wait()
+                self.metrics.attempts += 1
+                try:
+                    result = await job()
+                except Exception as exc:
+                    print(f"Error: {traceback.format_exc()}")
+                    last_exc = exc
+                    self.metrics.failed_attempts += 1
+                    if isinstance(job, Request):
+                        self.metrics.wasted_tokens += job.prompt_tokens
+                    self._breaker.record_failure()
+                    if attempt + 1 < self.retries:
+                        self.metrics.retries += 1
+                        await asyncio.sleep(self.backoff(attempt))
+                    continue
+
+                self._breaker.record_success()
+                writer.submit(idx, result)
+                return
+            self._error = self._error or last_exc
+            # Waking up the dispatcher in case it is waiting on the writer, which can no longer advance.
+            writer.advanced.set()
+        finally:
+            semaphore.release()
+
+    async def run(self, jobs: Iterable[Job], writer: OrderedJsonlWriter) -> None:
+        """
+        Run the jobs, submitting their results to the writer in the order of `jobs`.
+
+        Args:
+            jobs: The jobs to run, consumed lazily.
+            writer: The writer of the results.
+
+        Raises:
+            Exception: When a request fails all of its attempts. Results before it are still written.
+        """
+        self._error = None
+        self.metrics = SchedulerMetrics()
+        self._breaker = CircuitBreaker(self.failure_threshold, cooldown=self.retry_delay, max_cooldown=self.max_retry_delay,
+                                       health_check=self.health_check, metrics=self.metrics)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        writer_task = asyncio.create_task(writer.run())
+        tasks = set()
+        try:
+            for idx, job in enumerate(jobs):
+                if not callable(job):
+                    writer.submit(idx, job)
+                    continue
+
+                await semaphore.acquire()
+                while idx >= writer.next_idx + self.window and self._error is None:
+                    writer.advanced.clear()
+                    await writer.advanced.wait()
+                if self._error is not None:
+                    semaphore.release()
+                    break
+
+                await self._breaker.wait()
+                task = asyncio.create_task(self._run_job(idx, job, semaphore, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            await asyncio.gather(*tasks)
+        finally:
+            self._breaker.close()
+            writer.close()
+            await writer_task
+
+        if self._error is not None:
+            raise Exception("All retries failed") from self._error
@@ -0,0 +1,326 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import time
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.constants import SEED
+from pipeline.data.translate import TRANSLATED_LANGUAGES
+from pipeline.data.enums import DataSplit
+from pipeline.embed import MODEL_NAME, PASSAGE_MAX_LENGTH, QUERY_MAX_LENGTH
+from pipeline.embed_cache import EMBEDDING_CACHE_DIR, CachedEncoder, EmbeddingCache
+from pipeline.eval import (EVAL_DIR, K_VALUES, build_corpus, dot_scores, load_split, relevant_docs, retrieval_metrics,
+                           tiled_top_k, write_report)
+from pipeline.export import RUNTIMES, TORCH, load_encoder
+from pipeline.index import replace_dir
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INT8 = "int8"
+BINARY = "binary"
+QUANTIZATION_MODES = [INT8, BINARY]
+# Share of the values of a dimension within its int8 range, the rest are clipped, so outliers do not waste the range.
+INT8_CLIP_QUANTILE = 0.999
+# Vectors sampled to fit the int8 scales.
+INT8_SAMPLE_SIZE = 1 << 16
+# Vectors quantized at a time.
+QUANTIZE_CHUNK_SIZE = 1 << 15
+# Candidates rescored with the float vectors, per result.
+RESCORE_FACTOR = 10
+# Queries rescored at a time, their candidate vectors take RESCORE_QUERY_CHUNK_SIZE * candidates * dim * 4 bytes.
+RESCORE_QUERY_CHUNK_SIZE = 128
+CODES_FILE = "codes.npy"
+SCALES_FILE = "scales.npy"
+META_FILE = "quantized.json"
+
+
+def fit_int8_scales(vectors: np.ndarray, sample_size: int = INT8_SAMPLE_SIZE, seed: int = SEED) -> np.ndarray:
+    """
+    Fit the scale of every dimension, mapping its `INT8_CLIP_QUANTILE` absolute value to 127.
+
+    Args:
+        vectors: The vectors, shaped (num_vectors, dim).
+        sample_size: The number of vectors the scales are fitted on.
+        seed: The seed of the sample.
+
+    Returns:
+        The scales, shaped (dim,).
+    """
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), sample_size), replace=False))]
+    scales = np.quantile(np.abs(np.asarray(sample, dtype=np.float32)), INT8_CLIP_QUANTILE, axis=0) / 127
+    return np.maximum(scales, np.finfo(np.float32).tiny).astype(np.float32)
+
+
+def quantize_int8(vectors: np.ndarray, scales: np.ndarray, chunk_size: int = QUANTIZE_CHUNK_SIZE) -> np.ndarray:
+    """Quantize vectors to int8 codes with per-dimension scales, a chunk of vectors at a time."""
+    codes = np.empty(vectors.shape, dtype=np.int8)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        codes[start:start + len(chunk)] = np.clip(np.rint(chunk / scales), -127, 127)
+    return codes
+
+
+def pack_binary(vectors: np.ndarray, chunk_size: int = QUANTIZE_CHUNK_SIZE) -> np.ndarray:
+    """
+    Quantize vectors to the signs of their values, packed 64 dimensions to a word.
+
+    Args:
+        vectors: The vectors, shaped (num_vectors, dim).
+        chunk_size: The number of vectors packed at a time.
+
+    Returns:
+        The packed signs, shaped (num_vectors, ceil(dim / 64)), the padding bits being 0.
+    """
+    num_words = -(-vectors.shape[1] // 64)
+    codes = np.zeros((len(vectors), num_words * 8), dtype=np.uint8)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size])
+        packed = np.packbits(chunk > 0, axis=1)
+        codes[start:start + len(chunk), :packed.shape[1]] = packed
+    return codes.view(np.uint64)
+
+
+def int8_scores(query_tile: np.ndarray, code_tile: np.ndarray) -> np.ndarray:
+    """Score queries, already multiplied by the int8 scales, against a tile of int8 codes."""
+    return dot_scores(query_tile, code_tile)
+
+
+def _unpack_signs(codes: np.ndarray) -> np.ndarray:
+    return np.unpackbits(np.ascontiguousarray(codes).view(np.uint8), axis=1).astype(np.float32) * 2 - 1
+
+
+def hamming_scores(query_tile: np.ndarray, code_tile: np.ndarray) -> np.ndarray:
+    """
+    Score packed query signs against a tile of packed signs, by the number of bits they share minus the number they differ by.
+
+    The score is bits - 2 * Hamming distance, the dot product of the signs as -1 and 1, which a matrix product computes
+    faster than numpy popcounts of the XOR of every pair. The padding bits are 0 in both, so they add the same to every score.
+    """
+    return _unpack_signs(query_tile) @ _unpack_signs(code_tile).T
+
+
+class QuantizedIndex:
+    """
+    Exhaustive index over quantized vectors, whose candidates are rescored with the float vectors.
+
+    Int8 codes scale every dimension to [-127, 127], a quarter of the float32 size. Binary codes keep the sign of every
+    dimension, a 32nd of the float32 size, and are scored by Hamming distance. The quantized scores select
+    `RESCORE_FACTOR` candidates per result, which are then scored exactly with the float vectors, memory mapped from
+    the ".npy" file of `pipeline.embed`, so only the candidates are read from disk.
+
+    Example:
+        >>> index = QuantizedIndex.build("filtered_yoruba_test_dataset_pos_embeddings.npy", mode="binary")
+        >>> index.save("yoruba_test_binary")
+        >>> scores, ids = QuantizedIndex.load("yoruba_test_binary").search(query_embeddings, k=10)
+    """
+
+    def __init__(self, mode: str, codes: np.ndarray, scales: np.ndarray | None = None, vectors: np.ndarray | None = None,
+                 vectors_path: str | Path | None = None):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unsupported quantization: {mode}. Supported modes are {QUANTIZATION_MODES}.")
+        self.mode = mode
+        self.codes = codes
+        self.scales = scales
+        self.vectors = vectors
+        self.vectors_path = vectors_path
+
+    @classmethod
+    def build(cls, vectors: np.ndarray | str | Path, mode: str = INT8) -> QuantizedIndex:
+        """
+        Quantize vectors.
+
+        Args:
+            vectors: The float vectors, or the path of their ".npy" file, which is memory mapped and kept for rescoring.
+            mode: The quantization, "int8" or "binary".
+
+        Returns:
+            The index.
+        """
+        vectors_path = None
+        if isinstance(vectors, (str, Path)):
+            vectors_path = Path(vectors).resolve()
+            vectors = np.load(vectors_path, mmap_mode="r")
+        if mode == INT8:
+            scales = fit_int8_scales(vectors)
+            return cls(mode, quantize_int8(vectors, scales), scales, vectors, vectors_path)
+        return cls(mode, pack_binary(vectors), None, vectors, vectors_path)
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return self.codes.shape[1] * self.codes.itemsize
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def save(self, path: str | Path) -> None:
+        """Save the codes into a directory, written aside then moved in place, see `replace_dir`. The float vectors are referred to by their path."""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        np.save(tmp_path / CODES_FILE, self.codes)
+        if self.scales is not None:
+            np.save(tmp_path / SCALES_FILE, self.scales)
+        meta = {"mode": self.mode, "num_vectors": len(self), "bytes_per_vector": self.bytes_per_vector,
+                "vectors_path": str(self.vectors_path) if self.vectors_path else None}
+        (tmp_path / META_FILE).write_text(json.dumps(meta, indent=2))
+        replace_dir(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str | Path) -> QuantizedIndex:
+        """Load an index saved by `save`, memory mapping its codes and float vectors."""
+        path = Path(path)
+        meta = json.loads((path / META_FILE).read_text())
+        scales = np.load(path / SCALES_FILE) if (path / SCALES_FILE).exists() else None
+        vectors_path = meta["vectors_path"]
+        vectors = np.load(vectors_path, mmap_mode="r") if vectors_path and Path(vectors_path).exists() else None
+        return cls(meta["mode"], np.load(path / CODES_FILE, mmap_mode="r"), scales, vectors, vectors_path)
+
+    def candidates(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Find the top k vectors of every query by their quantized scores."""
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.mode == INT8:
+            return tiled_top_k(queries * self.scales, self.codes, k, score_fn=int8_scores)
+        return tiled_top_k(pack_binary(queries), self.codes, k, score_fn=hamming_scores)
+
+    def rescore(self, queries: np.ndarray, candidate_idxs: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Score the candidates of every query exactly with the float vectors, and keep the top k.
+
+        Args:
+            queries: The query vectors.
+            candidate_idxs: The candidates of every query.
+            k: The number of results per query.
+
+        Returns:
+            The scores and the indices of the top k candidates of every query, from the highest score.
+        """
+        k = min(k, candidate_idxs.shape[1])
+        top_scores = np.empty((len(queries), k), dtype=np.float32)
+        top_idxs = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), RESCORE_QUERY_CHUNK_SIZE):
+            query_chunk = np.asarray(queries[start:start + RESCORE_QUERY_CHUNK_SIZE], dtype=np.float32)
+            idxs = candidate_idxs[start:start + RESCORE_QUERY_CHUNK_SIZE]
+            # Reading every candidate vector once, in file order.
+            unique_idxs, inverse = np.unique(idxs, return_inverse=True)
+            vectors = np.asarray(self.vectors[unique_idxs], dtype=np.float32)[inverse.reshape(idxs.shape)]
+            scores = np.einsum("qd,qcd->qc", query_chunk, vectors)
+            order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+            top_scores[start:start + len(idxs)] = np.take_along_axis(scores, order, axis=1)
+            top_idxs[start:start + len(idxs)] = np.take_along_axis(idxs, order, axis=1)
+        return top_scores, top_idxs
+
+    def search(self, queries: np.ndarray, k: int = 10, rescore: bool = True,
+               rescore_factor: int = RESCORE_FACTOR) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the vectors with the highest inner products with every query.
+
+        Args:
+            queries: The query vectors, shaped (num_queries, dim).
+            k: The number of vectors to return per query.
+            rescore: Whether to rescore `rescore_factor * k` candidates with the float vectors, rather than returning
+                the top k by quantized scores.
+            rescore_factor: The number of candidates per result.
+
+        Returns:
+            The scores and the indices of the top k vectors of every query, from the highest score. The scores are the
+            quantized ones when not rescoring.
+        """
+        if not rescore:
+            return self.candidates(queries, k)
+        if self.vectors is None:
+            raise ValueError(f"The float vectors at {self.vectors_path} are needed to rescore the candidates.")
+        _, candidate_idxs = self.candidates(queries, k * rescore_factor)
+        return self.rescore(queries, candidate_idxs, k)
+
+
+def quantization_report(query_embeddings: np.ndarray, doc_embeddings: np.ndarray, relevant: np.ndarray,
+                        ks: Sequence[int] = K_VALUES, rescore_factor: int = RESCORE_FACTOR) -> list[dict]:
+    """
+    Compare the retrieval of quantized embeddings with the float32 one.
+
+    Args:
+        query_embeddings: The query embeddings.
+        doc_embeddings: The document embeddings.
+        relevant: The relevant documents of every query, see `relevant_docs`.
+        ks: The cutoffs of the metrics.
+        rescore_factor: The number of candidates rescored per result.
+
+    Returns:
+        A record per storage, e.g. {"storage": "binary+rescore", "bytes_per_vector": 128, "recall@10": ..., "seconds": ...}.
+    """
+    k = max(ks)
+    start = time.perf_counter()
+    _, top_idxs = tiled_top_k(query_embeddings, doc_embeddings, k)
+    records = [{"storage": "float32", "bytes_per_vector": doc_embeddings.shape[1] * 4, "seconds": time.perf_counter() - start,
+                **retrieval_metrics(top_idxs, relevant, ks)}]
+    for mode in QUANTIZATION_MODES:
+        index = QuantizedIndex.build(doc_embeddings, mode)
+        for rescore in [False, True]:
+            start = time.perf_counter()
+            _, top_idxs = index.search(query_embeddings, k, rescore=rescore, rescore_factor=rescore_factor)
+            records.append({"storage": f"{mode}+rescore" if rescore else mode, "bytes_per_vector": index.bytes_per_vector,
+                            "seconds": time.perf_counter() - start, **retrieval_metrics(top_idxs, relevant, ks)})
+    return records
+
+
+def format_quantization_report(report: dict[str, list[dict]]) -> str:
+    """Format a quantization report as a Markdown table, a line per language and storage."""
+    names = [name for name in next(iter(report.values()))[0] if name != "storage"]
+    lines = ["| language | storage | " + " | ".join(names) + " |", "|" + " --- |" * (2 + len(names))]
+    for language, records in report.items():
+        for record in records:
+            values = " | ".join(f"{record[name]:.4f}" if isinstance(record[name], float) else str(record[name]) for name in names)
+            lines.append(f"| {language} | {record['storage']} | {values} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize embeddings, and compare quantized retrieval with float32 retrieval.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Quantize a .npy file of embeddings, see pipeline.embed.")
+    build_parser.add_argument("embeddings", type=str)
+    build_parser.add_argument("--output", type=str, required=True, help="The directory of the quantized index.")
+    build_parser.add_argument("--mode", choices=QUANTIZATION_MODES, default=INT8)
+    report_parser = subparsers.add_parser("report", help="Compare Recall@k and bytes/vector with float32 on the filtered datasets.")
+    report_parser.add_argument("--model", type=str, default=MODEL_NAME, help="The model name, or the path of a local copy to run offline.")
+    report_parser.add_argument("--split", choices=[DataSplit.eval, DataSplit.test], default=DataSplit.test, type=str.lower)
+    report_parser.add_argument("--languages", nargs="+", choices=TRANSLATED_LANGUAGES, default=TRANSLATED_LANGUAGES, type=str.lower)
+    report_parser.add_argument("--ks", nargs="+", type=int, default=K_VALUES)
+    report_parser.add_argument("--rescore-factor", type=int, default=RESCORE_FACTOR)
+    report_parser.add_argument("--device", type=str, default="cpu")
+    report_parser.add_argument("--runtime", choices=RUNTIMES, default=TORCH, help="The runtime of the encoder, see pipeline.export.")
+    report_parser.add_argument("--int8", action="store_true", help="Run the int8 model of the onnx runtime.")
+    report_parser.add_argument("--cache-dir", type=str, default=str(EMBEDDING_CACHE_DIR), help="Directory of the embedding cache, an empty value disables the cache.")
+    report_parser.add_argument("--output", type=str, default=None, help="The JSON report to write, in artefacts/eval by default.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = QuantizedIndex.build(args.embeddings, args.mode)
+        index.save(args.output)
+        logger.info(f"Quantized {len(index)} vectors to {index.bytes_per_vector} bytes each at {args.output}.")
+    else:
+        encoder = load_encoder(args.runtime, args.model, device=args.device, int8=args.int8)
+        if args.cache_dir:
+            encoder = CachedEncoder(encoder, EmbeddingCache(args.cache_dir, dim=encoder.dim))
+        report = {}
+        for language in args.languages:
+            rows = load_split(language, args.split)
+            docs, doc_idxs = build_corpus([rows])
+            doc_embeddings = encoder.encode(docs, max_length=PASSAGE_MAX_LENGTH)
+            query_embeddings = encoder.encode([row["query"] for row in rows], max_length=QUERY_MAX_LENGTH)
+            report[language] = quantization_report(query_embeddings, doc_embeddings, relevant_docs(rows, doc_idxs), args.ks,
+                                                   args.rescore_factor)
+        model_name = Path(args.model).name if Path(args.model).is_dir() else args.model.replace("/", "_")
+        output = Path(args.output) if args.output else EVAL_DIR / f"{model_name}_{args.split}_quantization.json"
+        table = format_quantization_report(report)
+        write_report(output, report, table)
+        logger.info(f"Report saved to {output}.\n{table}")
@@ -1,6 +1,31 @@
+from functools import lru_cache
+import os
+
 import tiktoken
 
 
+ENCODING_NAME = "gpt2"
+# Number of threads used by tiktoken when encoding/decoding batches.
+NUM_THREADS = min(8, os.cpu_count() or 1)
+# Generous characters-per-token ratio used to size the prefix encoded by `truncate_text`.
+# If the prefix turns out too short for the budget it is grown, so this only affects speed.
+PREFIX_CHARS_PER_TOKEN = 8
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = ENCODING_NAME) -> tiktoken.Encoding:
+    """
+    Get the tokenizer encoding, loading it once per process.
+
+    Args:
+        name: The name of the tiktoken encoding.
+
+    Returns:
+        The encoding.
+    """
+    return tiktoken.get_encoding(name)
+
+
 def count_tokens(text: str) -> int:
     """
     Count the number of tokens in the text using the GPT-2 tokenizer.
@@ -11,15 +36,59 @@ def count_tokens(text: str) -> int:
     Returns:
         The number of tokens in the text.
     """
-    encoding = tiktoken.get_encoding("gpt2")
-    token_ids = encoding.encode(text)
+    token_ids = get_encoding().encode(text)
     return len(token_ids)
 
 
+def count_tokens_many(texts: list[str], num_threads: int = NUM_THREADS) -> list[int]:
+    """
+    Count the number of tokens in each of the texts using the GPT-2 tokenizer.
+
+    Args:
+        texts: The texts to count the tokens of.
+        num_threads: The number of threads to encode with.
+
+    Returns:
+        The number of tokens in each text, in the order of `texts`.
+    """
+    batch_token_ids = get_encoding().encode_batch(list(texts), num_threads=num_threads)
+    return [len(token_ids) for token_ids in batch_token_ids]
+
+
+def _prefix_end(text: str, max_tokens: int, scale: int = 1) -> int:
+    """
+    Get the end index of the character prefix to encode when truncating the text.
+
+    The prefix is cut right before a run of whitespace characters, the GPT-2 pre-tokenizer never merges
+    across that boundary, so the tokens of the prefix are the same as the leading tokens of the full text.
+    Cutting inside a run would not do, as the end of the run is split differently once the rest of it is gone.
+
+    Args:
+        text: The text to be truncated.
+        max_tokens: The maximum number of tokens to truncate to.
+        scale: Multiplier on the prefix size, used to grow the prefix on retries.
+
+    Returns:
+        The end index of the prefix, or the length of the text if the whole text should be encoded.
+    """
+    end = max(max_tokens, 1) * PREFIX_CHARS_PER_TOKEN * scale
+    if end >= len(text):
+        return len(text)
+
+    while end > 0 and not text[end].isspace():
+        end -= 1
+    # Moving back to the start of the whitespace run.
+    while end > 0 and text[end - 1].isspace():
+        end -= 1
+    return end if end > 0 else len(text)
+
+
 def truncate_text(text: str, max_tokens: int) -> str:
     """
     Truncate the text to the desired number of tokens using the GPT-2 tokenizer.
 
+    Only a bounded prefix of the text is encoded when the budget is far below the document length.
+
     Args:
         text: The text to truncate.
         max_tokens: The maximum number of tokens to truncate to.
@@ -27,12 +96,56 @@ def truncate_text(text: str, max_tokens: int) -> str:
     Returns:
         The truncated text.
     """
-    encoding = tiktoken.get_encoding("gpt2")
-    token_ids = encoding.encode(text)
+    encoding = get_encoding()
+    scale = 1
+    while True:
+        end = _prefix_end(text, max_tokens, scale)
+        token_ids = encoding.encode(text[:end])
+        if len(token_ids) >= max_tokens or end == len(text):
+            break
+        scale *= 2
+
     truncated_token_ids = token_ids[:max_tokens]
     truncated_text = encoding.decode(truncated_token_ids)
     return truncated_text
 
+
+def truncate_many(texts: list[str], max_tokens: int, num_threads: int = NUM_THREADS) -> list[str]:
+    """
+    Truncate each of the texts to the desired number of tokens using the GPT-2 tokenizer.
+
+    Works like `truncate_text`, but encodes and decodes the texts in multithreaded batches.
+
+    Args:
+        texts: The texts to truncate.
+        max_tokens: The maximum number of tokens to truncate to.
+        num_threads: The number of threads to encode and decode with.
+
+    Returns:
+        The truncated texts, in the order of `texts`.
+    """
+    encoding = get_encoding()
+    texts = list(texts)
+    batch_token_ids = [None] * len(texts)
+    pending = list(range(len(texts)))
+    scale = 1
+    while pending:
+        ends = [_prefix_end(texts[idx], max_tokens, scale) for idx in pending]
+        encoded = encoding.encode_batch([texts[idx][:end] for idx, end in zip(pending, ends)], num_threads=num_threads)
+
+        # Prefixes that came out shorter than the budget are grown and encoded again.
+        still_pending = []
+        for idx, end, token_ids in zip(pending, ends, encoded):
+            if len(token_ids) >= max_tokens or end == len(texts[idx]):
+                batch_token_ids[idx] = token_ids[:max_tokens]
+            else:
+                still_pending.append(idx)
+        pending = still_pending
+        scale *= 2
+
+    return encoding.decode_batch(batch_token_ids, num_threads=num_threads)
+
+
 def skip_doc_body(text, query=None):
     # "plánẹ́tì kékeré" is some weird text that appears in Wura's Yoruba wiki
     if ("plánẹ́tì kékeré" in text) or (not text.strip()):
@@ -43,4 +156,4 @@ def skip_doc_body(text, query=None):
             return True
     elif len(text.split()) < 5:
         return True
-    return False
\ No newline at end of file
+    return False
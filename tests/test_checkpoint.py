@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from pipeline.data.columnar import write_table
+from pipeline.data.jsonl import JsonlRows, write_jsonl
+from pipeline.llms.checkpoint import Checkpoint
+from pipeline.llms.scheduler import OrderedJsonlWriter, RequestScheduler
+
+
+def run_jobs(input_path, results_path, fail_at=None):
+    checkpoint = Checkpoint(input_path, results_path)
+    start = checkpoint.load()
+
+    def make_job(row):
+        async def job():
+            if row["idx"] == fail_at:
+                raise ConnectionError("Ollama is down")
+            return {"idx": row["idx"]}
+        return job
+
+    async def run():
+        writer = OrderedJsonlWriter(results_path, start=start, checkpoint=checkpoint)
+        await RequestScheduler(concurrency=4, retries=1, retry_delay=0).run(map(make_job, checkpoint.rows()), writer)
+
+    asyncio.run(run())
+    return start
+
+
+def test_checkpoint_resumes_after_a_crash(tmp_path):
+    input_path, results_path = tmp_path / "input.jsonl", tmp_path / "results.jsonl"
+    write_jsonl(input_path, [{"idx": idx} for idx in range(50)])
+
+    with pytest.raises(Exception, match="All retries failed"):
+        run_jobs(input_path, results_path, fail_at=20)
+    # A line cut short by the crash, written after the last checkpoint.
+    with open(results_path, "ab") as f_:
+        f_.write(b'{"idx": 2')
+
+    assert run_jobs(input_path, results_path) == 20
+    assert list(JsonlRows(results_path)) == [{"idx": idx} for idx in range(50)]
+
+
+def test_checkpoint_migrates_results_without_a_manifest(tmp_path):
+    input_path, results_path = tmp_path / "input.jsonl", tmp_path / "results.jsonl"
+    write_jsonl(input_path, [{"idx": idx} for idx in range(30)])
+    with open(results_path, "wb") as f_:
+        f_.write(b"".join(b'{"idx": %d}\n' % idx for idx in range(12)) + b'{"idx"')
+
+    assert run_jobs(input_path, results_path) == 12
+    assert list(JsonlRows(results_path)) == [{"idx": idx} for idx in range(30)]
+
+
+def test_checkpoint_rejects_a_changed_input(tmp_path):
+    input_path, results_path = tmp_path / "input.jsonl", tmp_path / "results.jsonl"
+    write_jsonl(input_path, [{"idx": idx} for idx in range(10)])
+    run_jobs(input_path, results_path)
+
+    write_jsonl(input_path, [{"idx": idx} for idx in range(20)])
+    with pytest.raises(RuntimeError, match="changed"):
+        Checkpoint(input_path, results_path).load()
+
+
+def test_checkpoint_rejects_an_input_changed_in_the_middle(tmp_path):
+    input_path, results_path = tmp_path / "input.jsonl", tmp_path / "results.jsonl"
+    write_jsonl(input_path, [{"text": "a" * 100_000, "idx": idx} for idx in range(30)])
+    run_jobs(input_path, results_path)
+
+    # Same size, same first and last MiB, only a row in the middle differs.
+    data = bytearray(input_path.read_bytes())
+    middle = data.index(b'"idx":15')
+    data[middle:middle + 8] = b'"idx":51'
+    input_path.write_bytes(bytes(data))
+    with pytest.raises(RuntimeError, match="changed"):
+        Checkpoint(input_path, results_path).load()
+
+
+def test_checkpoint_completeness(tmp_path):
+    input_path = tmp_path / "igbo_test_dataset.jsonl"
+    input_path.write_text('{"query": "a"}\n{"query": "b"}\n\n')
+    results_path = tmp_path / "results.jsonl"
+    checkpoint = Checkpoint(input_path, results_path)
+    checkpoint.load()
+    assert not checkpoint.is_complete()
+
+    rows = list(checkpoint.rows())
+    results_path.write_text('{"category": "X"}\n{"category": "X"}\n')
+    checkpoint.advance(len(rows), results_path.stat().st_size)
+    assert checkpoint.is_complete() and not checkpoint.is_stale()
+
+    input_path.write_text('{"query": "a"}\n{"query": "c"}\n')
+    checkpoint = Checkpoint(input_path, results_path)
+    assert checkpoint.is_stale() and not checkpoint.is_complete()
+    checkpoint.discard()
+    assert not results_path.exists() and checkpoint.load() == 0
+
+
+def test_checkpoint_resumes_columnar_inputs(tmp_path):
+    input_path = tmp_path / "hausa_test_dataset.parquet"
+    write_table(input_path, [{"query": f"Labari {i}", "pos": [f"Rubutu {i}"]} for i in range(10)])
+    results_path = tmp_path / "results.jsonl"
+
+    checkpoint = Checkpoint(input_path, results_path)
+    checkpoint.load()
+    rows = checkpoint.rows()
+    first = [next(rows) for _ in range(4)]
+    results_path.write_text("".join('{"category": "X"}\n' for _ in first))
+    checkpoint.advance(len(first), results_path.stat().st_size)
+    assert not checkpoint.is_complete()
+
+    resumed = Checkpoint(input_path, results_path)
+    assert resumed.load() == 4
+    rest = list(resumed.rows())
+    assert [row["query"] for row in rest] == [f"Labari {i}" for i in range(4, 10)]
+    resumed.advance(len(rest), results_path.stat().st_size)
+    assert resumed.is_complete()
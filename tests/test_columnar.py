@@ -0,0 +1,68 @@
+import pickle
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from pipeline.data.columnar import convert_artefact, read_table, text_word_counts, write_table
+from pipeline.data.enums import DataSource
+from pipeline.data.jsonl import write_jsonl
+from pipeline.data.utils import load_artefact, write_artefact
+
+
+def make_rows(n=200):
+    return [
+        {
+            "query": f"Ìbéèrè {i}",
+            "pos": [" ".join(["ọ̀rọ̀"] * (i % 9)) + (" 　" if i % 4 == 0 else "")],
+            "neg": [f"Àkọsílẹ̀ {(i + j) % 20}" for j in range(7)],
+            "url": f"https://bbc.com/yoruba/{i}/",
+            "source": "wura" if i % 3 else "mato",
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".arrow"])
+def test_columnar_round_trip(tmp_path, suffix):
+    rows = make_rows()
+    path = tmp_path / f"yoruba_train_dataset{suffix}"
+    assert write_table(path, rows) == len(rows)
+
+    table = read_table(path)
+    assert pa.types.is_dictionary(table.schema.field("source").type)
+    assert pa.types.is_dictionary(table.schema.field("neg").type.value_type)
+    assert not pa.types.is_dictionary(table.schema.field("url").type)
+
+    loaded = load_artefact(path)
+    assert list(loaded) == rows
+    assert loaded[3] == rows[3] and loaded[-1] == rows[-1]
+    assert list(pickle.loads(pickle.dumps(loaded[50:60]))) == rows[50:60]
+    assert load_artefact(path, columns=["query", "pos"]).column_names == ["query", "pos"]
+
+
+def test_text_word_counts_match_split(tmp_path):
+    rows = make_rows() + [{"query": "", "pos": [""], "neg": [], "url": None, "source": "wura"}]
+    table = pa.Table.from_pylist(rows)
+    assert text_word_counts(table.column("pos")).tolist() == [len(row["pos"][0].split()) for row in rows]
+    assert text_word_counts(table.column("query")).tolist() == [len(row["query"].split()) for row in rows]
+
+
+def test_convert_artefact_round_trip(tmp_path):
+    rows = make_rows()
+    # A date-like query must stay a text.
+    rows[0]["query"] = "2024-01-01"
+    write_jsonl(tmp_path / "rows.jsonl", rows)
+
+    assert convert_artefact(tmp_path / "rows.jsonl", tmp_path / "rows.parquet") == len(rows)
+    assert list(load_artefact(tmp_path / "rows.parquet")) == rows
+    convert_artefact(tmp_path / "rows.parquet", tmp_path / "back.jsonl")
+    assert (tmp_path / "back.jsonl").read_bytes() == (tmp_path / "rows.jsonl").read_bytes()
+
+
+def test_write_artefact_frames(tmp_path):
+    df = pd.DataFrame({"query": ["Labarai", "Wasanni"], "pos": [["Rubutu"], ["Kwallo"]], "source": [DataSource.mato, DataSource.wura]})
+    write_artefact(tmp_path / "hausa.parquet", df)
+    write_artefact(tmp_path / "hausa.jsonl", df)
+
+    assert list(load_artefact(tmp_path / "hausa.parquet")) == list(load_artefact(tmp_path / "hausa.jsonl"))
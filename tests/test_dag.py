@@ -0,0 +1,82 @@
+import importlib
+import threading
+import time
+
+import pytest
+
+from pipeline.data.dag import BUILT, FAILED, SKIPPED, UP_TO_DATE, Node, build_graph, run_graph, select_nodes
+from pipeline.text_utils import get_encoding
+
+
+def test_select_nodes_pulls_in_the_dependencies():
+    graph = build_graph()
+    names = select_nodes(graph, ["postprocess:hausa:test"])
+
+    assert names == ["create:hausa:eval", "create:hausa:test", "audit:hausa:test", "postprocess:hausa:test"]
+    english = select_nodes(graph, ["translate:english:train"])
+    assert {"translation:yoruba:train", "translation:igbo:train", "translation:hausa:train", "create:igbo:train"} <= set(english)
+    assert not any(name.endswith(":eval") for name in english)
+    assert len(select_nodes(graph, ["create"])) == 9
+
+
+def test_run_graph_runs_independent_nodes_in_parallel():
+    lock = threading.Lock()
+    active = {"nodes": 0, "max": 0, "llm": 0, "max_llm": 0}
+    order = []
+
+    def action(name, llm=False):
+        with lock:
+            active["nodes"] += 1
+            active["max"] = max(active["max"], active["nodes"])
+            active["llm"] += llm
+            active["max_llm"] = max(active["max_llm"], active["llm"])
+        time.sleep(0.05)
+        with lock:
+            active["nodes"] -= 1
+            active["llm"] -= llm
+            order.append(name)
+
+    graph = {}
+    for language in ("yoruba", "igbo", "hausa"):
+        graph[f"create:{language}"] = Node(f"create:{language}", lambda language=language: action(f"create:{language}"))
+        graph[f"audit:{language}"] = Node(f"audit:{language}", lambda language=language: action(f"audit:{language}", llm=True),
+                                          deps=[f"create:{language}"], resource="ollama")
+    graph["create:yoruba"].is_fresh = lambda: True
+
+    results = run_graph(graph, jobs=4)
+
+    assert results["create:yoruba"][0] == UP_TO_DATE
+    assert all(results[name][0] == BUILT for name in graph if name != "create:yoruba")
+    assert active["max"] >= 2 and active["max_llm"] == 1
+    for language in ("igbo", "hausa"):
+        assert order.index(f"create:{language}") < order.index(f"audit:{language}")
+
+
+def test_run_graph_skips_the_dependents_of_failed_nodes():
+    def fail():
+        raise RuntimeError("Ollama is down")
+
+    graph = {
+        "audit:igbo": Node("audit:igbo", fail),
+        "postprocess:igbo": Node("postprocess:igbo", lambda: None, deps=["audit:igbo"]),
+        "create:hausa": Node("create:hausa", lambda: None),
+    }
+    results = run_graph(graph, jobs=2)
+
+    assert results["audit:igbo"][0] == FAILED
+    assert results["postprocess:igbo"][0] == SKIPPED
+    assert results["create:hausa"][0] == BUILT
+
+
+
+def test_llm_nodes_pass_arguments_their_modules_accept():
+    try:
+        get_encoding()
+    except Exception:
+        pytest.skip("The GPT-2 encoding the LLM modules count prompt tokens with cannot be downloaded.")
+    for name, node in build_graph().items():
+        command = node.action.args[0]
+        if command[2].startswith("pipeline.llms."):
+            stage, language, split = name.split(":")
+            args = importlib.import_module(command[2]).parse_args(command[3:])
+            assert (args.language.lower(), args.split) == (language, split)
@@ -0,0 +1,50 @@
+import random
+
+import numpy as np
+
+from pipeline.data.dedup import MinHasher, deduplicate, find_near_duplicates
+
+
+def make_docs(num_docs, seed=0):
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("abdegiklmnorstuwyẹọṣ") for _ in range(rng.randint(2, 8))) for _ in range(5000)]
+    return [" ".join(rng.choice(words) for _ in range(rng.randint(60, 200))) for _ in range(num_docs)]
+
+
+def test_minhash_estimates_the_jaccard_similarity_of_shingles():
+    docs = make_docs(2)
+    words = docs[0].split()
+    # Changing one word in ten changes about half of the 5-word shingles.
+    edited = " ".join("xyz" if idx % 10 == 0 else word for idx, word in enumerate(words))
+    shingles = [{tuple(doc.split()[i:i + 5]) for i in range(len(doc.split()) - 4)} for doc in (docs[0], edited)]
+    jaccard = len(shingles[0] & shingles[1]) / len(shingles[0] | shingles[1])
+
+    signatures = MinHasher(num_perm=512).signatures([docs[0], edited, docs[1]])
+    assert abs((signatures[0] == signatures[1]).mean() - jaccard) < 0.08
+    assert (signatures[0] == signatures[2]).mean() < 0.05
+    # Tones and case do not change the signature.
+    assert (MinHasher().signatures(["Ọ̀rọ̀ àti ìwé", "oro ati iwe"])[0] == MinHasher().signatures(["oro ati iwe"])[0]).all()
+
+
+def test_find_near_duplicates_within_and_across_splits():
+    docs = make_docs(300)
+    near_copies = [doc.replace(doc.split()[3], "yàtọ̀", 1) for doc in docs[:20]]
+    texts = docs[:250] + near_copies + [None, ""]
+    reference = docs[250:] + [docs[40] + " (BBC Yoruba)"]
+
+    duplicate_of, leaked = find_near_duplicates(texts, reference)
+
+    assert duplicate_of[250:270].tolist() == list(range(20))
+    assert (duplicate_of[:250] == -1).all() and (duplicate_of[270:] == -1).all()
+    assert np.flatnonzero(leaked).tolist() == [40]
+
+
+def test_deduplicate_drops_the_later_copies():
+    docs = make_docs(50)
+    rows = [{"query": str(idx), "pos": [doc]} for idx, doc in enumerate(docs + docs[:5])]
+
+    kept, report = deduplicate(rows, [{"pos": docs[10]}])
+
+    assert [row["query"] for row in kept] == [str(idx) for idx in range(50) if idx != 10]
+    assert report[0] == {"idx": 10, "duplicate_of": None, "leaked": True}
+    assert [entry["duplicate_of"] for entry in report[1:]] == list(range(5))
@@ -0,0 +1,34 @@
+import numpy as np
+
+from pipeline.data.utils import write_artefact
+from pipeline.embed import embed_artefact, padding_ratio, token_budget_batches
+
+
+class WordCountEncoder:
+    # Stands in for `DenseEncoder`, embedding a text as its number of words and characters.
+    dim = 2
+
+    def encode(self, texts, max_length=None):
+        return np.array([[len(text.split()), len(text)] for text in texts], dtype=np.float32)
+
+
+def test_token_budget_batches_fit_the_budget():
+    rng = np.random.default_rng(0)
+    lengths = np.concatenate([rng.integers(5, 30, size=900), rng.integers(1000, 2048, size=100)])
+    rng.shuffle(lengths)
+    batches = token_budget_batches(lengths, max_tokens=8192, max_batch_size=64)
+
+    assert sorted(np.concatenate(batches).tolist()) == list(range(len(lengths)))
+    assert all(len(batch) * lengths[batch].max() <= 8192 for batch in batches)
+    naive = [np.arange(start, min(start + 64, len(lengths))) for start in range(0, len(lengths), 64)]
+    assert padding_ratio(lengths, batches) < 0.1 < padding_ratio(lengths, naive)
+    assert [len(batch) for batch in token_budget_batches([5000, 3], max_tokens=4096)] == [1, 1]
+
+
+def test_embed_artefact_keeps_the_row_order(tmp_path):
+    rows = [{"query": "q " * (idx % 7), "pos": ["p " * idx]} for idx in range(50)]
+    expected = WordCountEncoder().encode([row["pos"][0] for row in rows])
+    for name in ["rows.jsonl", "rows.jsonl.gz", "rows.parquet"]:
+        write_artefact(tmp_path / name, rows)
+        assert embed_artefact(tmp_path / name, tmp_path / "pos.npy", WordCountEncoder(), field="pos", chunk_size=8) == 50
+        np.testing.assert_array_equal(np.load(tmp_path / "pos.npy"), expected)
@@ -0,0 +1,63 @@
+import numpy as np
+
+from pipeline.embed_cache import CachedEncoder, EmbeddingCache, embedding_key
+
+
+class CountingEncoder:
+    # Stands in for `DenseEncoder`, counting the texts it encodes.
+    model_name_or_path = "test-model"
+    max_length = 2048
+    dim = 4
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, max_length=None):
+        self.encoded += texts
+        return np.array([[len(text), text.count("a"), max_length or self.max_length, 1] for text in texts], dtype=np.float32)
+
+
+def test_cached_encoder_only_encodes_misses(tmp_path):
+    encoder = CountingEncoder()
+    cached = CachedEncoder(encoder, EmbeddingCache(tmp_path, dim=4))
+    first = cached.encode(["ab", "ba", "ab", "Ọba"])
+    assert encoder.encoded == ["ab", "ba", "Ọba"]
+
+    # Reopening the cache, as a later run would, with a text only differing by whitespace.
+    reopened = CachedEncoder(encoder, EmbeddingCache(tmp_path))
+    second = reopened.encode(["Ọba", " ab  ", "new"])
+    assert encoder.encoded == ["ab", "ba", "Ọba", "new"]
+    np.testing.assert_array_equal(second[:2], first[[3, 0]])
+    assert (reopened.cache.hits, reopened.cache.misses) == (2, 1)
+    assert "66.7% hit rate" in reopened.cache.stats()
+
+    # The maximum length is part of the key.
+    reopened.encode(["ab"], max_length=512)
+    assert encoder.encoded[-1] == "ab"
+
+
+def test_compaction_keeps_the_kept_embeddings(tmp_path):
+    cache = EmbeddingCache(tmp_path, dim=4)
+    keys = [embedding_key("m", 512, str(idx)) for idx in range(10)]
+    embeddings = np.arange(40, dtype=np.float32).reshape(10, 4)
+    cache.append(keys, embeddings)
+    other = EmbeddingCache(tmp_path)
+
+    assert cache.compact(keys[5:]) == 5
+    assert len(cache) == len(EmbeddingCache(tmp_path)) == 5
+    np.testing.assert_array_equal(cache.get(cache.lookup(keys[5:])), embeddings[5:])
+    assert (cache.lookup(keys[:5]) == -1).all()
+    # A process opened before the compaction reads the new generation on its next append.
+    other.append(keys[:1], embeddings[:1])
+    np.testing.assert_array_equal(other.get(other.lookup(keys[:1] + keys[9:])), embeddings[[0, 9]])
+
+
+def test_interrupted_append_is_dropped(tmp_path):
+    cache = EmbeddingCache(tmp_path, dim=4)
+    cache.append([embedding_key("m", 512, "a")], np.ones((1, 4)))
+    with open(next(tmp_path.glob("embeddings-*.f16")), "ab") as f_:
+        f_.write(np.zeros(4, dtype=np.float16).tobytes())
+    reopened = EmbeddingCache(tmp_path)
+    assert len(reopened) == 1
+    reopened.append([embedding_key("m", 512, "b")], np.full((1, 4), 2))
+    np.testing.assert_array_equal(reopened.get(np.array([0, 1])), [[1] * 4, [2] * 4])
@@ -0,0 +1,65 @@
+import numpy as np
+
+from pipeline.data.enums import Language
+from pipeline.embed_cache import CachedEncoder, EmbeddingCache
+from pipeline.eval import evaluate_language, format_report, retrieval_metrics, tiled_top_k
+
+
+class WordHashEncoder:
+    # Stands in for `DenseEncoder`, embedding a text as its normalized bag of hashed words.
+    dim = 64
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, max_length=None):
+        self.encoded += texts
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for idx, text in enumerate(texts):
+            for word in text.split():
+                embeddings[idx, sum(word.encode()) % self.dim] += 1
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-6)
+
+
+def test_tiled_top_k_matches_exact_search():
+    rng = np.random.default_rng(0)
+    queries, docs = rng.normal(size=(37, 8)).astype(np.float32), rng.normal(size=(501, 8)).astype(np.float32)
+    scores, idxs = tiled_top_k(queries, docs, k=10, query_tile_size=16, doc_tile_size=64)
+    exact = queries @ docs.T
+    np.testing.assert_array_equal(idxs, np.argsort(-exact, axis=1)[:, :10])
+    np.testing.assert_allclose(scores, np.take_along_axis(exact, idxs, axis=1), rtol=1e-6)
+    assert tiled_top_k(queries, docs[:3], k=10)[1].shape == (37, 3)
+
+
+def test_retrieval_metrics():
+    top_idxs = np.array([[3, 1, 2], [0, 1, 2], [5, 6, 7]])
+    metrics = retrieval_metrics(top_idxs, np.array([[3], [2], [0]]), ks=[1, 3])
+    assert metrics["recall@1"] == 1 / 3
+    assert metrics["recall@3"] == 2 / 3
+    assert np.isclose(metrics["mrr"], (1 + 1 / 3) / 3)
+    assert np.isclose(metrics["ndcg@3"], (1 + 0.5) / 3)
+
+
+def test_evaluate_language_reports_native_and_cross_lingual_runs(monkeypatch):
+    rows = [{"query": f"ibeere {idx} oro{idx}", "pos": [f"iwe oro{idx} " * 3], "neg": [f"iwe oro{idx + 1}"]} for idx in range(20)]
+    english_rows = [{"query": f"question oro{idx}", "pos": [f"iwe oro{idx} " * 3], "root_query_language": Language.yoruba} for idx in range(5)]
+    english_rows.append({"query": "question", "pos": ["hausa doc"], "root_query_language": Language.hausa})
+    monkeypatch.setattr("pipeline.eval.load_split", lambda language, split: rows)
+
+    report = evaluate_language(Language.yoruba, "test", WordHashEncoder(), english_rows, ks=[1, 10])
+    assert report["native"]["queries"] == 20 and report["cross_lingual"]["queries"] == 5
+    assert report["native"]["docs"] == report["cross_lingual"]["docs"] == 40
+    assert report["native"]["recall@10"] > 0.5
+    assert "| yoruba | cross_lingual | 5 | 40 |" in format_report({Language.yoruba: report})
+
+
+def test_query_only_changes_do_not_embed_documents_again(tmp_path, monkeypatch):
+    rows = [{"query": f"ibeere oro{idx}", "pos": [f"iwe oro{idx}"]} for idx in range(10)]
+    monkeypatch.setattr("pipeline.eval.load_split", lambda language, split: rows)
+    encoder = WordHashEncoder()
+    evaluate_language(Language.yoruba, "test", CachedEncoder(encoder, EmbeddingCache(tmp_path, dim=64), model_id="m"))
+
+    rows = [{**row, "query": row["query"] + " ?"} for row in rows]
+    encoder.encoded = []
+    evaluate_language(Language.yoruba, "test", CachedEncoder(encoder, EmbeddingCache(tmp_path), model_id="m"))
+    assert encoder.encoded == [row["query"] for row in rows]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from pipeline.embed import DenseEncoder
+from pipeline.export import (ONNX, PARITY_MIN_COSINE, TORCH, TORCH_INT8, OnnxEncoder, TorchInt8Encoder, cosine_parity,
+                             encoder_model_id, load_encoder, parity_check)
+
+
+class RandomEncoder:
+    # Stands in for `DenseEncoder`, embedding a text as a seeded random unit vector, perturbed by some noise.
+    dim = 32
+
+    def __init__(self, noise=0.0):
+        self.noise = noise
+
+    def encode(self, texts, max_length=None):
+        embeddings = np.stack([np.random.default_rng(len(text)).standard_normal(self.dim) for text in texts])
+        embeddings += self.noise * np.random.default_rng(1).standard_normal(embeddings.shape)
+        return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_cosine_parity():
+    reference = np.array([[1, 0], [0, 2], [1, 1]], dtype=np.float32)
+    candidate = np.array([[2, 0], [0, -1], [1, 0]], dtype=np.float32)
+    np.testing.assert_allclose(cosine_parity(reference, candidate), [1, -1, np.sqrt(0.5)], rtol=1e-6)
+
+
+def test_parity_check():
+    result = parity_check(RandomEncoder(), RandomEncoder(noise=0.1), min_cosine=PARITY_MIN_COSINE[ONNX])
+    assert not result["passed"] and result["min_cosine"] > 0.99
+    assert parity_check(RandomEncoder(), RandomEncoder(noise=0.1))["passed"]
+    assert parity_check(RandomEncoder(), RandomEncoder(noise=0.0), min_cosine=PARITY_MIN_COSINE[ONNX])["passed"]
+    with pytest.raises(ValueError):
+        load_encoder("tensorrt")
+
+
+def test_encoder_model_id_matches_the_encoders():
+    # The encoders are made without loading a model, which needs torch.
+    def make(encoder_class, **attributes):
+        encoder = encoder_class.__new__(encoder_class)
+        encoder.__dict__.update({"model_name_or_path": "bge-m3", "fp16": False, "int8": False, **attributes})
+        return encoder
+
+    assert make(DenseEncoder).model_id == encoder_model_id(TORCH, "bge-m3") == "bge-m3"
+    assert make(DenseEncoder, fp16=True).model_id == encoder_model_id(TORCH, "bge-m3", fp16=True)
+    assert make(TorchInt8Encoder).model_id == encoder_model_id(TORCH_INT8, "bge-m3")
+    assert make(OnnxEncoder, int8=True).model_id == encoder_model_id(ONNX, "bge-m3", int8=True)
+    assert len({encoder_model_id(TORCH, "bge-m3", fp16=True), encoder_model_id(TORCH_INT8, "bge-m3"),
+                encoder_model_id(ONNX, "bge-m3"), encoder_model_id(ONNX, "bge-m3", int8=True), "bge-m3"}) == 5
+
+
+def test_onnx_export_parity(tmp_path):
+    # Exports a small randomly initialized model from a local checkpoint, so the test runs offline.
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    transformers = pytest.importorskip("transformers")
+    from pipeline.embed import DenseEncoder
+    from pipeline.export import TORCH_INT8, export_onnx
+
+    checkpoint = tmp_path / "checkpoint"
+    config = transformers.BertConfig(vocab_size=128, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    transformers.BertModel(config).save_pretrained(checkpoint)
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + [chr(code) for code in range(ord("a"), ord("z") + 1)]
+    (tmp_path / "vocab.txt").write_text("\n".join(vocab))
+    transformers.BertTokenizerFast(str(tmp_path / "vocab.txt")).save_pretrained(checkpoint)
+
+    export_onnx(str(checkpoint), tmp_path / "onnx", int8=True)
+    reference = DenseEncoder(str(checkpoint), max_length=64)
+    assert parity_check(reference, load_encoder(ONNX, str(tmp_path / "onnx"), max_length=64), min_cosine=PARITY_MIN_COSINE[ONNX])["passed"]
+    assert parity_check(reference, load_encoder(TORCH_INT8, str(checkpoint), max_length=64))["min_cosine"] > 0.9
@@ -0,0 +1,57 @@
+import numpy as np
+
+from pipeline.index import IVFIndex, recall_against_exact
+
+
+def make_vectors(size, dim=16, seed=0):
+    # Clustered vectors, like embeddings of documents on a few topics.
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(20, dim))
+    vectors = centers[rng.integers(0, 20, size=size)] + 0.3 * rng.normal(size=(size, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_ivf_index_matches_exact_search_when_probing_every_list(tmp_path):
+    vectors, queries = make_vectors(2000), make_vectors(50, seed=1)
+    index = IVFIndex.build(vectors, nlist=32)
+    assert index.offsets[-1] == len(index) == 2000
+    index.save(tmp_path / "index")
+    loaded = IVFIndex.load(tmp_path / "index")
+    assert isinstance(loaded.vectors, np.memmap)
+
+    scores, ids = loaded.search(queries, k=10, nprobe=32)
+    exact = queries @ vectors.T
+    np.testing.assert_array_equal(ids, np.argsort(-exact, axis=1)[:, :10])
+    np.testing.assert_allclose(scores, np.take_along_axis(exact, ids, axis=1), rtol=1e-5)
+
+
+def test_ivf_recall_grows_with_nprobe():
+    vectors, queries = make_vectors(5000), make_vectors(100, seed=1)
+    results = recall_against_exact(IVFIndex.build(vectors), queries, vectors, k=10, nprobes=[1, 8, 64])
+    recalls = [result["recall@10"] for result in results]
+    assert recalls == sorted(recalls)
+    assert recalls[-1] > 0.95
+
+
+def test_ivf_search_pads_missing_results():
+    vectors = make_vectors(30)
+    scores, ids = IVFIndex.build(vectors, nlist=10).search(vectors[:2], k=40, nprobe=1)
+    assert (ids[:, -1] == -1).all() and np.isneginf(scores[:, -1]).all()
+    assert ids[0, 0] == 0 and ids[1, 0] == 1
+
+
+def test_ivf_index_built_into_a_directory_matches_the_in_memory_build(tmp_path, monkeypatch):
+    # Small chunks, so the lists are gathered over many chunks.
+    monkeypatch.setattr("pipeline.index.take_rows.__defaults__", (64,))
+    np.save(tmp_path / "vectors.npy", make_vectors(1000))
+    vectors = np.load(tmp_path / "vectors.npy", mmap_mode="r")
+    (tmp_path / "index").mkdir()
+    (tmp_path / "index" / "stale.npy").write_bytes(b"")
+
+    built = IVFIndex.build(vectors, nlist=16, path=tmp_path / "index")
+    expected = IVFIndex.build(np.asarray(vectors), nlist=16)
+    assert isinstance(built.vectors, np.memmap)
+    for name in ["centroids", "vectors", "ids", "offsets"]:
+        np.testing.assert_array_equal(getattr(built, name), getattr(expected, name))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["index", "vectors.npy"]
+    assert not (tmp_path / "index" / "stale.npy").exists()
@@ -0,0 +1,77 @@
+import pickle
+
+import pandas as pd
+import pytest
+
+from pipeline.data.jsonl import WRITE_BUFFER_LINES, JsonlRows, dumps, iter_jsonl, read_manifest, write_jsonl
+from pipeline.data.utils import load_artefact, write_artefact
+
+
+def test_jsonl_rows_round_trip(tmp_path):
+    path = tmp_path / "rows.jsonl"
+    rows = [{"query": f"Ìbéèrè {i}", "pos": [f"Ọ̀rọ̀ {i}"]} for i in range(10)] + [None]
+    assert write_jsonl(path, rows) == len(rows)
+
+    view = JsonlRows(path)
+    assert len(view) == len(rows)
+    assert list(view) == rows
+    assert view[3] == rows[3]
+    assert view[-1] is None
+    assert list(view[2:8:2]) == rows[2:8:2]
+    assert list(pickle.loads(pickle.dumps(view[5:]))) == rows[5:]
+    assert list(iter_jsonl(path)) == rows
+
+
+def test_jsonl_rows_handles_missing_trailing_newline_and_empty_lines(tmp_path):
+    path = tmp_path / "rows.jsonl"
+    path.write_bytes(b'{"a": 1}\n\n{"a": 2}')
+
+    view = JsonlRows(path)
+    assert list(view) == [{"a": 1}, {"a": 2}]
+    assert view[1] == {"a": 2}
+
+
+@pytest.mark.parametrize("suffix", [".jsonl.gz", ".jsonl.zst"])
+def test_compressed_jsonl_round_trip(tmp_path, suffix):
+    rows = [{"query": f"Ìbéèrè {i}", "pos": ["ọ̀rọ̀ " * (i % 50)]} for i in range(3000)]
+    path = tmp_path / f"yoruba_train_dataset{suffix}"
+
+    assert write_jsonl(path, iter(rows)) == len(rows)
+    assert path.stat().st_size < len(b"".join(dumps(row) for row in rows))
+    assert list(iter_jsonl(path)) == rows
+    assert load_artefact(path) == rows
+    with pytest.raises(ValueError):
+        write_jsonl(path, rows, mode="a")
+
+
+def test_sharded_jsonl_keeps_the_row_order(tmp_path):
+    rows = [{"query": f"Labari {i}", "pos": [f"Rubutu {i}"]} for i in range(5000)]
+    manifest_path = tmp_path / "hausa_train_dataset.manifest.json"
+
+    assert write_artefact(manifest_path, rows, num_shards=3, compression="zstd") == len(rows)
+    manifest = read_manifest(manifest_path)
+    assert manifest["num_rows"] == len(rows)
+    assert [shard["path"] for shard in manifest["shards"]] == [f"hausa_train_dataset-0000{idx}-of-00003.jsonl.zst" for idx in range(3)]
+    assert sum(shard["rows"] for shard in manifest["shards"]) == len(rows)
+    assert list(iter_jsonl(tmp_path / manifest["shards"][1]["path"]))[0] == rows[WRITE_BUFFER_LINES]
+    assert load_artefact(manifest_path) == rows
+
+    # Rewriting with fewer shards removes the shards the manifest no longer lists.
+    write_artefact(manifest_path, rows[:10], num_shards=2)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "hausa_train_dataset-00000-of-00002.jsonl", "hausa_train_dataset-00001-of-00002.jsonl", "hausa_train_dataset.manifest.json",
+    ]
+    assert load_artefact(manifest_path) == rows[:10]
+
+
+def test_frames_are_streamed_like_to_json(tmp_path):
+    df = pd.DataFrame({
+        "query": ["Labarai", None, "Wasanni"],
+        "pos": [["Rubutu"], ["Kwallo"], ["Gasar"]],
+        "url": ["https://bbc.com/hausa/1/", float("nan"), "https://bbc.com/hausa/3/"],
+        "count": [1, 2, 3],
+    })
+    df.to_json(tmp_path / "expected.jsonl", orient="records", lines=True)
+    write_artefact(tmp_path / "streamed.jsonl", df)
+
+    assert list(iter_jsonl(tmp_path / "streamed.jsonl")) == list(iter_jsonl(tmp_path / "expected.jsonl"))
@@ -0,0 +1,44 @@
+import asyncio
+from types import SimpleNamespace
+
+from pipeline.llms.cache import ResponseCache, cache_key, cached_chat
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def chat(self, model, messages):
+        self.calls += 1
+        await asyncio.sleep(0)
+        return SimpleNamespace(message=SimpleNamespace(content=f"<translation>{messages[0]['content']}</translation>"))
+
+
+def test_response_cache_counts_hits_and_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=30)
+    cache.set("a", "x" * 10)
+    cache.set("b", "y" * 10)
+    assert cache.get("a") == "x" * 10
+    cache.set("c", "z" * 15)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "x" * 10
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.close()
+    assert ResponseCache(tmp_path).get("c") == "z" * 15
+
+
+def test_cached_chat_only_sends_new_prompts(tmp_path):
+    cache = ResponseCache(tmp_path)
+    client = FakeClient()
+
+    async def run(prompts):
+        return await asyncio.gather(*(cached_chat(client, "gemma3:27b", prompt, 1, cache) for prompt in prompts))
+
+    first = asyncio.run(run(["Ìlú Èkó", "Ìlú Èkó", "Kano"]))
+    second = asyncio.run(run(["Kano", "Ìlú Èkó"]))
+
+    assert client.calls == 2
+    assert second == [first[2], first[0]]
+    assert cache_key("gemma3:27b", 1, "Kano") != cache_key("gemma3:27b", 2, "Kano")
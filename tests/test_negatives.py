@@ -0,0 +1,73 @@
+import numpy as np
+
+from pipeline.data.negatives import BM25Index, mine_hard_negatives
+from pipeline.data.utils import add_negatives, sample_negative_idxs
+
+
+def test_sample_negative_idxs_excludes_self_and_duplicates():
+    neg_idxs = sample_negative_idxs(50, size=7)
+
+    assert neg_idxs.shape == (50, 7)
+    for row_idx, row_neg_idxs in enumerate(neg_idxs):
+        assert row_idx not in row_neg_idxs
+        assert len(set(row_neg_idxs)) == 7
+
+
+def test_sample_negative_idxs_is_deterministic_across_workers(monkeypatch):
+    monkeypatch.setattr("pipeline.data.utils.NEGATIVES_CHUNK_SIZE", 16)
+
+    serial = sample_negative_idxs(100, seed=7, workers=1)
+    parallel = sample_negative_idxs(100, seed=7, workers=4)
+
+    assert np.array_equal(serial, parallel)
+    assert not np.array_equal(serial, sample_negative_idxs(100, seed=8))
+
+
+def test_add_negatives_uses_the_positive_documents():
+    rows = [{"query": str(i), "pos": [f"doc {i}"]} for i in range(20)]
+
+    rows = add_negatives(rows, size=3)
+
+    for row in rows:
+        assert len(row["neg"]) == 3
+        assert row["pos"][0] not in row["neg"]
+        assert all(neg.startswith("doc ") for neg in row["neg"])
+
+
+def test_mine_hard_negatives_prefers_lexical_matches_over_the_positive_and_its_copies():
+    docs = [
+        "Ọ̀rọ̀ nípa ìjọba àpapọ̀ àti ètò ìdìbò",
+        "ìjọba àpapọ̀ kéde ètò tuntun",
+        "Ọ̀rọ̀ nípa ìjọba àpapọ̀ àti ètò ìdìbò",
+        "bọ́ọ̀lù àfẹsẹ̀gbá ní Èkó",
+        "ojú ọjọ́ ní ìlú Ìbàdàn",
+        "orin tuntun láti ọ̀dọ̀ olórin",
+        "ètò ẹ̀kọ́ ní ilé ìwé",
+        "ọjà epo rọ̀bì",
+        "àwọn ọmọ ilé ìwé",
+        "ìròyìn eré ìdárayá",
+    ]
+    queries = ["ijoba apapo" for _ in docs]
+
+    neg_idxs = mine_hard_negatives(queries, docs, size=3, workers=1)
+
+    # Document 2 is a copy of document 0, neither can be a negative of the other.
+    assert 2 not in neg_idxs[0] and 0 not in neg_idxs[2]
+    assert neg_idxs[0][0] == 1
+    for row_idx, row_neg_idxs in enumerate(neg_idxs):
+        assert row_idx not in row_neg_idxs
+        assert len(set(row_neg_idxs)) == 3
+
+
+def test_bm25_top_k_matches_the_full_ranking():
+    rng = np.random.default_rng(0)
+    words = [f"w{idx}" for idx in range(30)]
+    docs = [" ".join(rng.choice(words, size=rng.integers(1, 12))) for _ in range(300)]
+    queries = [" ".join(rng.choice(words, size=3)) for _ in range(50)]
+    index = BM25Index(docs)
+
+    full = index.search(queries)
+    for k in [1, 5, 40]:
+        for top, ranking in zip(index.search(queries, k=k), full):
+            assert top.tolist() == ranking[:k].tolist()
+
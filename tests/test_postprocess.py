@@ -0,0 +1,67 @@
+import random
+import re
+from functools import reduce
+
+from pipeline.data.enums import Language
+from pipeline.data.jsonl import JsonlRows, write_jsonl
+from pipeline.data.postprocess import fix_wiki_pos, postprocess_dataset, remove_query_sentences
+
+
+def legacy_remove_query_sentences(text, query):
+    # The regex based implementation that `remove_query_sentences` replaced, kept as the reference behaviour.
+    query_split = [re.escape(q) for q in query.split()]
+    re_pattern = reduce(lambda a, b: a + r"\s*" + r"([^\s]+\s*){,2}" + b, query_split)
+    re_sentence = r"[^\.]*" + re_pattern + r"[^\.]*."
+    return re.compile(re_sentence, re.IGNORECASE).sub("", text)
+
+
+def make_regression_corpus(size=5000, seed=42):
+    pieces = ["ab", "Ab", "b", "c", "abc", ".", " ", "  ", "\n", "\n\n", "x.", "a", "B.", "ọ̀", "Ọ̀", "ba", "\t", "cab", "a.b"]
+    query_words = ["ab", "b", "c", "a", "ọ̀", "a.b", "x.", "ba", "AB"]
+    rng = random.Random(seed)
+    for _ in range(size):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+        query = " ".join(rng.choice(query_words) for _ in range(rng.randint(1, 4)))
+        yield text, query
+
+
+def test_remove_query_sentences_matches_the_regex_implementation():
+    for text, query in make_regression_corpus():
+        assert remove_query_sentences(text, query) == legacy_remove_query_sentences(text, query), (text, query)
+
+
+def test_fix_wiki_pos_removes_the_header_and_query_sentences():
+    query = "Bookshop House"
+    text = "Bookshop House\n\nBookshop House jẹ́ ilé kan ní Èkó. Wọ́n kọ́ ọ ní ọdún 1927. Ilé bookshop ti àwọn house yìí dára."
+    row = fix_wiki_pos({"query": query, "pos": [text]})
+
+    assert row["pos"] == ["Wọ́n kọ́ ọ ní ọdún 1927."]
+    assert row["root_text"] == [text]
+    assert row["pos"][0] == legacy_remove_query_sentences(text[len(query) + 2:], query).strip()
+
+
+def make_rows(count):
+    rng = random.Random(0)
+    words = ["ìlú", "Èkó", "jẹ́", "ńlá", "ní", "Nàìjíríà", "àwọn", "ènìyàn", "púpọ̀", "ọjà"]
+    rows = []
+    for i in range(count):
+        query = " ".join(rng.choice(words) for _ in range(3))
+        text = " ".join(rng.choice(words) + ("." if rng.random() < 0.1 else "") for _ in range(rng.randint(0, 60)))
+        domain = "yo.wikipedia.org" if i % 3 == 0 else "www.bbc.com"
+        source = "mato" if i % 2 else "wura"
+        rows.append({"query": query, "pos": [f"{query} {text}"], "neg": [], "url": f"https://{domain}/{i}", "source": source})
+    return rows
+
+
+def test_postprocess_dataset_parallel_output_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr("pipeline.data.postprocess.POSTPROCESS_CHUNK_SIZE", 25)
+    path = tmp_path / "hausa_train_dataset.jsonl"
+    write_jsonl(path, make_rows(300))
+    audits = [{"category": random.Random(i).choice(["X", "NLC", "SKIP"])} for i in range(220)]
+
+    serial_path, parallel_path = tmp_path / "serial.jsonl", tmp_path / "parallel.jsonl"
+    write_jsonl(serial_path, postprocess_dataset(JsonlRows(path), audits, Language.hausa))
+    write_jsonl(parallel_path, postprocess_dataset(JsonlRows(path), audits, Language.hausa, workers=3))
+
+    assert serial_path.read_bytes() == parallel_path.read_bytes()
+    assert len(JsonlRows(serial_path)) > 0
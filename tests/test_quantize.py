@@ -0,0 +1,43 @@
+import numpy as np
+
+from pipeline.quantize import QuantizedIndex, hamming_scores, pack_binary, quantization_report
+
+
+def make_vectors(size, dim=96, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(30, dim))
+    vectors = centers[rng.integers(0, 30, size=size)] + 0.5 * rng.normal(size=(size, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_hamming_scores_count_the_differing_signs():
+    vectors = make_vectors(20, dim=70)
+    codes = pack_binary(vectors)
+    assert codes.shape == (20, 2)
+    distances = np.bitwise_count(codes[:5, None, :] ^ codes[None, :, :]).sum(axis=2)
+    np.testing.assert_array_equal(hamming_scores(codes[:5], codes), 128 - 2 * distances)
+
+
+def test_rescored_search_finds_the_exact_neighbours(tmp_path):
+    docs, queries = make_vectors(3000), make_vectors(40, seed=1)
+    np.save(tmp_path / "docs.npy", docs)
+    exact = np.argsort(-(queries @ docs.T), axis=1)[:, :10]
+    # Signs are a coarse proxy of noisy synthetic vectors, so binary codes need more candidates.
+    for mode, bytes_per_vector, rescore_factor in [("int8", 96, 10), ("binary", 16, 100)]:
+        QuantizedIndex.build(tmp_path / "docs.npy", mode).save(tmp_path / mode)
+        index = QuantizedIndex.load(tmp_path / mode)
+        assert index.bytes_per_vector == bytes_per_vector
+        scores, idxs = index.search(queries, k=10, rescore_factor=rescore_factor)
+        recall = (idxs[:, :, None] == exact[:, None, :]).any(axis=2).mean()
+        _, candidate_idxs = index.search(queries, k=10, rescore=False)
+        assert recall > 0.95 and recall > (candidate_idxs[:, :, None] == exact[:, None, :]).any(axis=2).mean(), mode
+        np.testing.assert_allclose(scores, np.take_along_axis(queries @ docs.T, idxs, axis=1), rtol=1e-5)
+
+
+def test_quantization_report_compares_with_float32():
+    docs = make_vectors(1000)
+    queries = docs[:50] + 0.05 * make_vectors(50, seed=2)
+    records = quantization_report(queries, docs, np.arange(50)[:, None], ks=[1, 10])
+    assert [record["storage"] for record in records] == ["float32", "int8", "int8+rescore", "binary", "binary+rescore"]
+    assert [record["bytes_per_vector"] for record in records] == [384, 96, 96, 16, 16]
+    assert records[2]["recall@10"] == records[0]["recall@10"]
@@ -0,0 +1,50 @@
+import numpy as np
+
+from pipeline.data.columnar import ArrowRows, to_table
+from pipeline.data.enums import Language
+from pipeline.data.postprocess import sample_data_by_language, sample_data_by_text_length
+from pipeline.data.sampling import allocate_quotas, nested_quotas, text_length_bins, text_lengths
+
+
+def make_rows(size=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    languages = [Language.yoruba, Language.igbo, Language.hausa]
+    lengths = rng.choice([100, 800, 1500, 3000], size=size, p=[0.85, 0.1, 0.04, 0.01])
+    return [
+        {"id": idx, "pos": ["w " * int(length)], "root_query_language": languages[int(rng.choice(3, p=[0.7, 0.2, 0.1]))]}
+        for idx, length in enumerate(lengths)
+    ]
+
+
+def test_allocate_quotas_reallocates_small_strata():
+    quotas = allocate_quotas(np.array([3, 100, 0, 50]), 40)
+    assert quotas.tolist() == [3, 19, 0, 18]
+    assert allocate_quotas(np.array([3, 5]), 10).tolist() == [3, 5]
+    assert nested_quotas(np.array([[1, 10], [30, 30]]), 20).sum() == 20
+
+
+def test_sample_data_by_text_length_balances_bins():
+    rows = make_rows()
+    sampled = sample_data_by_text_length(rows, n=400)
+    assert len(sampled) == 400
+    assert [row["id"] for row in sampled] == sorted(row["id"] for row in sampled)
+    counts = np.bincount(text_length_bins(text_lengths(sampled)), minlength=4)
+    available = np.bincount(text_length_bins(text_lengths(rows)), minlength=4)
+    assert counts.tolist() == allocate_quotas(available, 400).tolist()
+    assert sampled == sample_data_by_text_length(rows, n=400)
+
+
+def test_streaming_and_columnar_samples_match_in_memory():
+    rows = make_rows()
+    expected = sample_data_by_language(rows, n=300)
+    assert sample_data_by_language(iter(rows), n=300) == expected
+    assert sample_data_by_language(ArrowRows(to_table(rows)), n=300) == expected
+
+    expected = sample_data_by_text_length(rows, n=300)
+    assert sample_data_by_text_length((row for row in rows), n=300) == expected
+
+
+def test_sample_data_by_language_balances_languages():
+    sampled = sample_data_by_language(make_rows(), n=300)
+    languages = [row["root_query_language"] for row in sampled]
+    assert all(languages.count(language) == 100 for language in [Language.yoruba, Language.igbo, Language.hausa])
@@ -0,0 +1,85 @@
+import asyncio
+import random
+
+import pytest
+
+from pipeline.data.jsonl import JsonlRows
+from pipeline.llms.scheduler import OrderedJsonlWriter, RequestScheduler
+
+
+def test_scheduler_keeps_requests_in_flight_and_writes_in_order(tmp_path):
+    path = tmp_path / "results.jsonl"
+    in_flight, max_in_flight = 0, 0
+
+    def make_job(idx):
+        async def job():
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(random.Random(idx).random() / 100)
+            in_flight -= 1
+            return {"idx": idx}
+        return job
+
+    jobs = [{"idx": idx} if idx % 7 == 0 else make_job(idx) for idx in range(100)]
+
+    async def run():
+        await RequestScheduler(concurrency=5).run(jobs, OrderedJsonlWriter(path))
+
+    asyncio.run(run())
+
+    assert list(JsonlRows(path)) == [{"idx": idx} for idx in range(100)]
+    assert max_in_flight == 5
+
+
+def test_scheduler_writes_the_results_before_a_failed_request(tmp_path):
+    path = tmp_path / "results.jsonl"
+
+    def make_job(idx):
+        async def job():
+            if idx == 10:
+                raise ConnectionError("Ollama is down")
+            return {"idx": idx}
+        return job
+
+    async def run():
+        await RequestScheduler(concurrency=3, retries=2, retry_delay=0).run(map(make_job, range(30)), OrderedJsonlWriter(path))
+
+    with pytest.raises(Exception, match="All retries failed"):
+        asyncio.run(run())
+
+    assert list(JsonlRows(path)) == [{"idx": idx} for idx in range(10)]
+
+
+def test_scheduler_pauses_while_the_server_is_down_and_only_resends_failed_requests(tmp_path):
+    path = tmp_path / "results.jsonl"
+    calls = [0] * 60
+    server = {"down": False}
+
+    def make_job(idx):
+        async def job():
+            calls[idx] += 1
+            if idx == 20 and calls[idx] == 1:
+                server["down"] = True
+                asyncio.get_running_loop().call_later(0.05, server.update, {"down": False})
+            await asyncio.sleep(0.001)
+            if server["down"]:
+                raise ConnectionError("Ollama is restarting")
+            return {"idx": idx}
+        return job
+
+    async def health_check():
+        if server["down"]:
+            raise ConnectionError("Ollama is restarting")
+
+    scheduler = RequestScheduler(concurrency=8, retries=3, retry_delay=0.01, failure_threshold=3, health_check=health_check, seed=0)
+
+    async def run():
+        await scheduler.run(map(make_job, range(60)), OrderedJsonlWriter(path))
+
+    asyncio.run(run())
+
+    assert list(JsonlRows(path)) == [{"idx": idx} for idx in range(60)]
+    assert scheduler.metrics.circuit_opens == 1
+    assert scheduler.metrics.retries == scheduler.metrics.failed_attempts == sum(calls) - 60
+    assert all(count <= 2 for count in calls)
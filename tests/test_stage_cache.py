@@ -0,0 +1,57 @@
+import pandas as pd
+
+from pipeline.data.enums import DataSource
+from pipeline.data.stage_cache import StageCache, module_dependencies, stage_key
+
+
+def test_stage_cache_computes_a_stage_once_per_key(tmp_path):
+    stage_cache = StageCache(tmp_path / "cache")
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return pd.DataFrame({"title": ["Labarai", "Ìròyìn"], "category": [None, "sport"], "source": DataSource.wura}, index=[3, 3])
+
+    key = stage_key("prepare_wura", {"config": "hau"}, modules=["pipeline.data.wura"])
+    first = stage_cache.frame("prepare_wura", key, compute)
+    second = stage_cache.frame("prepare_wura", key, compute)
+
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, second, check_dtype=False)
+    assert second.index.tolist() == [3, 3]
+
+
+def test_stage_key_changes_with_the_inputs(tmp_path):
+    source = tmp_path / "hausa_mato_81k.tsv"
+    source.write_text("title\ttext\n")
+    key = stage_key("create", {"language": "hausa"}, files=[source], modules=["pipeline.data.train_data"])
+
+    assert stage_key("create", {"language": "hausa"}, files=[source], modules=["pipeline.data.train_data"]) == key
+    assert stage_key("create", {"language": "igbo"}, files=[source], modules=["pipeline.data.train_data"]) != key
+    assert stage_key("create", {"language": "hausa"}, files=[source], modules=["pipeline.data.wura"]) != key
+    source.write_text("title\ttext\nLabarai\tRubutu\n")
+    assert stage_key("create", {"language": "hausa"}, files=[source], modules=["pipeline.data.train_data"]) != key
+
+
+def test_stage_cache_tracks_the_outputs_of_a_key(tmp_path):
+    stage_cache = StageCache(tmp_path / "cache")
+    output = tmp_path / "hausa_train_dataset.jsonl"
+
+    assert not stage_cache.is_fresh(output, "a")
+    output.write_text("{}\n")
+    stage_cache.mark_fresh(output, "a")
+    assert stage_cache.is_fresh(output, "a")
+    assert not stage_cache.is_fresh(output, "b")
+    assert not StageCache(tmp_path / "cache", enabled=False).is_fresh(output, "a")
+
+
+def test_module_dependencies_follow_the_imports():
+    modules = module_dependencies(["pipeline.data.postprocess"])
+
+    # Imported by postprocess directly, and through pipeline.data.columnar.
+    assert {"pipeline.text_utils", "pipeline.data.sampling", "pipeline.data.jsonl"} <= set(modules)
+    assert "pipeline.data.translate" not in modules
+    # Imported inside a function.
+    assert "pipeline.llms.checkpoint" in module_dependencies(["pipeline.llms.scheduler"])
+    assert set(module_dependencies(["pipeline.data.train_data"])) >= {"pipeline.data.jsonl", "pipeline.data.wura", "pipeline.data.urls"}
+
@@ -0,0 +1,33 @@
+import numpy as np
+
+from pipeline.data.enums import Language
+from pipeline.data.postprocess import fix_wiki_pos
+from pipeline.data.sampling import text_length_bins, text_lengths
+from pipeline.data.synthetic import SYNTHETIC_LANGUAGES, synthetic_frame, synthetic_rows, synthetic_wura
+from pipeline.data.wura import prepare_wura, wura_remove_validation_rows
+
+
+def test_synthetic_rows_are_seeded_and_realistic():
+    rows = synthetic_rows(3000)
+    assert rows == synthetic_rows(3000)
+    assert [row["url"] for row in synthetic_rows(100)] == [row["url"] for row in rows[:100]]
+    assert rows[0]["pos"] != synthetic_rows(1, seed=0)[0]["pos"]
+
+    assert {row["root_query_language"] for row in rows} == set(SYNTHETIC_LANGUAGES)
+    assert np.bincount(text_length_bins(text_lengths(rows)), minlength=4).min() > 0
+    wiki_rows = [row for row in rows if "wikipedia.org" in row["url"]]
+    assert 0 < len(wiki_rows) < len(rows) / 2
+    for row in wiki_rows[:50]:
+        header = row["query"] + "\n\n"
+        assert row["pos"][0].startswith(header)
+        assert len(fix_wiki_pos(dict(row))["pos"][0]) < len(row["pos"][0]) - len(header)
+
+
+def test_synthetic_wura():
+    wura = synthetic_wura(2000, Language.hausa)
+    df = prepare_wura(wura["train"])
+    assert 0.9 * len(wura["train"]) < len(df) < len(wura["train"])
+    assert not df["url"].str.contains("jw.org|blog", regex=True).any()
+
+    collected_df = synthetic_frame(2000, Language.hausa)
+    assert len(wura_remove_validation_rows(collected_df, wura["validation"])) == len(collected_df) - len(wura["validation"])
@@ -0,0 +1,39 @@
+import random
+
+import pytest
+import regex
+from tiktoken_ext.openai_public import r50k_pat_str
+
+from pipeline import text_utils
+from pipeline.text_utils import _prefix_end, count_tokens_many, get_encoding, truncate_many, truncate_text
+
+
+def make_texts(size=5000, seed=0):
+    pieces = ["ọmọ", "abc", "Èkó", "123", "!!", "'s", " ", "  ", "   ", "\n", "\n\n", "\t", ".", "jẹ́"]
+    rng = random.Random(seed)
+    return ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 40))) for _ in range(size)]
+
+
+def test_prefix_pre_tokens_are_a_prefix_of_the_text_pre_tokens(monkeypatch):
+    # Checks the pre-tokenizer of GPT-2 directly, so it runs without downloading the encoding.
+    monkeypatch.setattr(text_utils, "PREFIX_CHARS_PER_TOKEN", 2)
+    pattern = regex.compile(r50k_pat_str)
+    assert _prefix_end("ọmọ abc   !!", 4) == 7
+    for text in make_texts():
+        for max_tokens in [1, 3, 7]:
+            pre_tokens = pattern.findall(text[:_prefix_end(text, max_tokens)])
+            assert pre_tokens == pattern.findall(text)[:len(pre_tokens)], (text, max_tokens)
+
+
+def test_truncation_matches_encoding_the_whole_text(monkeypatch):
+    try:
+        encoding = get_encoding()
+    except Exception:
+        pytest.skip("The GPT-2 encoding cannot be downloaded.")
+    monkeypatch.setattr(text_utils, "PREFIX_CHARS_PER_TOKEN", 2)
+    texts = make_texts(1000)
+    assert count_tokens_many(texts) == [len(encoding.encode(text)) for text in texts]
+    for max_tokens in [1, 5, 20]:
+        expected = [encoding.decode(encoding.encode(text)[:max_tokens]) for text in texts]
+        assert truncate_many(texts, max_tokens) == expected
+        assert [truncate_text(text, max_tokens) for text in texts] == expected
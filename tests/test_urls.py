@@ -0,0 +1,54 @@
+import pandas as pd
+from datasets import Dataset, DatasetDict
+
+from pipeline.data.enums import DataSource, Language
+from pipeline.data.urls import canonicalize_urls, url_keys
+from pipeline.data.utils import extract_domain_name
+from pipeline.data.wura import align_with_wura, wura_remove_validation_rows
+
+
+def test_extract_domain_name_only_removes_the_www_prefix():
+    assert extract_domain_name("https://www.bbc.com/yoruba") == "bbc.com"
+    assert extract_domain_name("https://web.wowwiki.com/") == "web.wowwiki.com"
+    assert extract_domain_name("https://www.news.w/") == "news.w"
+
+
+def test_url_keys_match_the_variants_of_a_url():
+    urls = pd.Series(["https://www.BBC.com/yoruba/123/", " http://bbc.com/yoruba/123", "bbc.com/yoruba/123#top", "https://bbc.com/yoruba/124", None])
+
+    keys = url_keys(urls)
+
+    assert keys.tolist() == ["bbc.com/yoruba/123"] * 3 + ["bbc.com/yoruba/124", ""]
+    assert canonicalize_urls(urls).tolist()[:2] == ["https://www.BBC.com/yoruba/123/", " http://bbc.com/yoruba/123/"]
+    assert canonicalize_urls(urls).tolist()[-1] == ""
+
+
+def test_wura_remove_validation_rows_matches_the_variants_of_the_urls():
+    df = pd.DataFrame({
+        "url": ["https://bbc.com/yoruba/1", "http://www.bbc.com/yoruba/2/", "https://www.bbc.com/hausa/1", None, "https://legit.ng/3"],
+        "views": [1, 2, 3, 4, 5],
+    })
+
+    kept = wura_remove_validation_rows(df, Dataset.from_dict({"url": ["https://bbc.com/yoruba/2", "bbc.com/hausa/1#top"]}))
+
+    assert kept.to_dict("list") == {"url": ["https://bbc.com/yoruba/1/", "", "https://legit.ng/3/"], "views": [1, 4, 5]}
+
+
+def test_align_with_wura_backfills_the_wura_categories():
+    wura_urls = [f"https://www.bbc.com/yoruba/{idx}" for idx in range(12)]
+    wura_data = DatasetDict({
+        "train": Dataset.from_dict({
+            "headline": ["Ìròyìn tuntun"] * 12, "content": ["Ọ̀rọ̀"] * 12, "category": ["sport"] * 11 + [None], "url": wura_urls,
+        }),
+        "validation": Dataset.from_dict({"headline": ["Ìròyìn"], "content": ["Ọ̀rọ̀"], "category": ["sport"], "url": ["https://bbc.com/yoruba/val"]}),
+    })
+    df = pd.DataFrame({
+        "title": ["A b", "C d", "E f"], "text": ["x", "y", "z"], "source": DataSource.mato,
+        "url": ["http://bbc.com/yoruba/0/", "https://bbc.com/yoruba/val", "https://alaroye.org/1"],
+    })
+
+    aligned = align_with_wura(df, wura_data, Language.yoruba)
+
+    assert aligned["url"].tolist() == ["http://bbc.com/yoruba/0/", "https://alaroye.org/1/"] + [url + "/" for url in wura_urls[1:]]
+    assert aligned["category"].isna().tolist() == [False, True] + [False] * 10 + [True]
+
@@ -0,0 +1,59 @@
+import random
+
+import pandas as pd
+from datasets import Dataset
+
+from pipeline.data.enums import DataSource
+from pipeline.data.utils import extract_domain_name
+from pipeline.data.wura import prepare_wura
+
+
+def legacy_prepare_wura(dataset):
+    """The row by row implementation `prepare_wura` replaced, kept as a reference."""
+    domain_counts = {}
+    for row in dataset:
+        domain = extract_domain_name(row["url"])
+        domain_counts[domain] = domain_counts.get(domain, 0) + 1
+
+    data = []
+    for row in dataset:
+        domain = extract_domain_name(row["url"])
+        if not (len((row["headline"] or " ").split()) > 1
+                and len((row["url"] or " ").strip()) > 5
+                and domain_counts[domain] > 10 and domain not in {"jw.org"}):
+            continue
+        data.append({
+            "title": row["headline"],
+            "url": row["url"].strip("/") + "/", "text": row["content"],
+            "category": row["category"],
+            "source": DataSource.wura,
+        })
+    return pd.DataFrame(data)
+
+
+def make_wura_dataset(num_rows, seed=0):
+    rng = random.Random(seed)
+    domains = ["https://www.bbc.com/yoruba", "http://alaroye.org", "https://www.jw.org/yo", "https://wwwhausa.w.com",
+               "https://legit.ng", "http://rare-site.com", " https://www.voahausa.com", "https://[broken"]
+    headlines = ["Ìròyìn tuntun lónìí", "Labarai", "", None, "  Ọba\xa0Akure ", "Gwamna  ya  yi magana", "\u2003one\u2003", "Labarai\x1c"]
+    rows = {"headline": [], "content": [], "category": [], "url": []}
+    for idx in range(num_rows):
+        url = rng.choice(domains) + "/" + str(idx) + rng.choice(["", "/", "//"])
+        rows["url"].append(rng.choice([url] * 20 + ["", None, "short", "x.yz/"]))
+        rows["headline"].append(rng.choice(headlines))
+        rows["content"].append(f"Ọ̀rọ̀ {idx}")
+        rows["category"].append(rng.choice(["politics", "sport", None]))
+    return Dataset.from_dict(rows)
+
+
+def test_prepare_wura_matches_the_row_by_row_implementation():
+    dataset = make_wura_dataset(2000)
+
+    expected = legacy_prepare_wura(dataset)
+    prepared = prepare_wura(dataset)
+
+    assert len(prepared) > 0
+    pd.testing.assert_frame_equal(prepared, expected)
+    # Rows selected or shuffled after loading go through the indices mapping of the dataset.
+    shuffled = dataset.shuffle(seed=0).select(range(1500))
+    pd.testing.assert_frame_equal(prepare_wura(shuffled), legacy_prepare_wura(shuffled))